@@ -1,3 +1,4 @@
+import multiprocessing
 from flask import Flask
 from flask_cors import CORS
 from config import Config
@@ -15,8 +16,34 @@ def create_app(config_class=Config):
     # 初始化配置目錄
     config_class.init_app(app)
     
+    # 成本記錄（背景批次寫入）
+    from .utils import configure_cost_ledger
+    configure_cost_ledger(
+        app.config['COST_DB_PATH'],
+        flush_interval=app.config.get('COST_LOG_FLUSH_INTERVAL', 1.0),
+        batch_size=app.config.get('COST_LOG_BATCH_SIZE', 500),
+        retention_days=app.config.get('COST_LOG_RETENTION_DAYS', 90),
+        legacy_csv_path=app.config.get('COST_LEGACY_CSV_PATH')
+    )
+
+    # 圖片優化（插入 PPTX 前按顯示尺寸縮小 / 重新壓縮）
+    from .services.image_optimizer import configure_image_optimizer
+    configure_image_optimizer(
+        app.config['IMAGE_OPTIMIZE_CACHE_FOLDER'],
+        dpi=app.config.get('IMAGE_OPTIMIZE_DPI', 150),
+        jpeg_quality=app.config.get('IMAGE_OPTIMIZE_JPEG_QUALITY', 85),
+        max_workers=app.config.get('IMAGE_OPTIMIZE_WORKERS', 4),
+        enabled=app.config.get('IMAGE_OPTIMIZE_ENABLED', True)
+    )
+
     # 註冊藍圖
-    from .routes import bp as main_bp
+    from .routes import bp as main_bp, init_job_queue
     app.register_blueprint(main_bp)
+
+    # 啟動背景生成任務 worker 並接手上次中斷的任務
+    # （測試時不啟動；文件解析進程池的子進程也會導入應用，不在其中啟動）
+    if app.config.get('JOB_QUEUE_AUTOSTART') and not app.config.get('TESTING') \
+            and multiprocessing.parent_process() is None:
+        init_job_queue(app)
     
     return app
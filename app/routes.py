@@ -1,10 +1,22 @@
 import os
 import json
 import time
-from flask import Blueprint, render_template, request, jsonify, send_file, current_app
+import shutil
+import zipfile
+import threading
+import mimetypes
+from flask import Blueprint, render_template, request, jsonify, send_file, current_app, Response, stream_with_context
 from werkzeug.utils import secure_filename
 from .utils.helpers import safe_filename
+from .utils.cost_ledger import get_cost_ledger
 from .services import FileProcessor, FormatConverter, AIService
+from .services.job_service import JobQueue, JobStore
+from .services.section_service import SectionGenerator, ChunkedSOPOptimizer
+from .services.prompt_service import PromptRegistry, ProfileLoader
+from .services.template_cache import TemplateTextCache
+from .services.ingest_service import TemplateIngestor
+from .services.ooxml_service import ingest_pptx, OOXML_ERRORS
+from .services.image_store import ImageStore, ImageManifest
 
 bp = Blueprint('main', __name__)
 
@@ -12,11 +24,87 @@ bp = Blueprint('main', __name__)
 # 由於 Blueprint 在應用創建前定義，我們這裡使用延遲初始化或在視圖函數中獲取配置
 # 為了簡單起見，我們在視圖函數中實例化 AIService，或者在 app context 中存儲
 
+_job_queue_lock = threading.Lock()
+
 def get_ai_service():
     if not hasattr(current_app, 'ai_service'):
         current_app.ai_service = AIService(current_app.config)
     return current_app.ai_service
 
+def get_prompt_registry():
+    if not hasattr(current_app, 'prompt_registry'):
+        current_app.prompt_registry = PromptRegistry(ProfileLoader(
+            current_app.config.get('PROFILE_FOLDER', current_app.config['BASE_DIR']),
+            reload_interval=current_app.config.get('PROFILE_RELOAD_INTERVAL', 2.0)
+        ))
+    return current_app.prompt_registry
+
+def get_template_text_cache():
+    if not hasattr(current_app, 'template_text_cache'):
+        current_app.template_text_cache = TemplateTextCache(
+            current_app.config['TEMPLATE_TEXT_CACHE_DB_PATH'],
+            max_memory_entries=current_app.config.get('TEMPLATE_TEXT_CACHE_MEMORY_ENTRIES', 32)
+        )
+    return current_app.template_text_cache
+
+def get_image_store():
+    if not hasattr(current_app, 'image_store'):
+        current_app.image_store = ImageStore(
+            current_app.config['IMAGE_STORE_FOLDER'],
+            near_duplicate_threshold=current_app.config.get('IMAGE_NEAR_DUPLICATE_THRESHOLD', 5)
+        )
+    return current_app.image_store
+
+def get_template_ingestor():
+    if not hasattr(current_app, 'template_ingestor'):
+        current_app.template_ingestor = TemplateIngestor(
+            current_app.config['TEMPLATE_TEXT_CACHE_DB_PATH'],
+            get_template_text_cache(),
+            current_app.config['TEMPLATE_ASSET_FOLDER'],
+            image_store=get_image_store(),
+            lazy_images=current_app.config.get('IMAGE_EXTRACTION_MODE', 'store') == 'lazy'
+        )
+    return current_app.template_ingestor
+
+def get_section_generator():
+    return SectionGenerator(
+        get_ai_service(),
+        max_workers=current_app.config.get('SECTION_GENERATION_WORKERS', 4),
+        min_sections=current_app.config.get('SECTION_GENERATION_MIN_SECTIONS', 2),
+        max_sections=current_app.config.get('SECTION_GENERATION_MAX_SECTIONS', 16)
+    )
+
+def get_sop_chunk_optimizer():
+    return ChunkedSOPOptimizer(
+        get_ai_service(),
+        slides_per_window=current_app.config.get('SOP_CHUNK_SLIDES', 5),
+        max_chars=current_app.config.get('SOP_CHUNK_MAX_CHARS', 6000),
+        max_workers=current_app.config.get('SOP_CHUNK_WORKERS', 4),
+        max_retries=current_app.config.get('SOP_CHUNK_MAX_RETRIES', 2),
+        template_excerpt_chars=current_app.config.get('SOP_CHUNK_TEMPLATE_EXCERPT_CHARS', 1500)
+    )
+
+def get_job_queue():
+    with _job_queue_lock:
+        if not hasattr(current_app, 'job_queue'):
+            queue = JobQueue(
+                current_app._get_current_object(),
+                current_app.config['JOB_DB_PATH'],
+                workers=current_app.config.get('JOB_WORKERS', 4),
+                stale_seconds=current_app.config.get('JOB_STALE_SECONDS', 120),
+                max_attempts=current_app.config.get('JOB_MAX_ATTEMPTS', 3)
+            )
+            queue.register('generate', _run_generation)
+            queue.register('ingest_template', _run_template_ingest)
+            queue.start()
+            current_app.job_queue = queue
+    return current_app.job_queue
+
+def init_job_queue(app):
+    """應用啟動時啟動任務 worker，接手上次運行中未完成的任務"""
+    with app.app_context():
+        get_job_queue()
+
 @bp.route('/')
 def index():
     return render_template('index_v3_daisy.html')
@@ -29,7 +117,54 @@ def api_config():
         ai_service.save_api_config(config)
         return jsonify({"success": True, "message": "配置已保存"})
     else:
-        return jsonify(ai_service.load_api_config())
+        return jsonify(dict(ai_service.load_api_config()))
+
+@bp.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """LLM 響應快取的命中統計"""
+    cache = get_ai_service().cache
+    if cache is None:
+        return jsonify({"success": True, "enabled": False})
+    return jsonify({"success": True, "enabled": True, "stats": cache.stats()})
+
+@bp.route('/api/cache', methods=['DELETE'])
+def clear_cache():
+    """清空 LLM 響應快取"""
+    cache = get_ai_service().cache
+    if cache is not None:
+        cache.clear()
+    return jsonify({"success": True, "message": "快取已清空"})
+
+@bp.route('/api/providers/status', methods=['GET'])
+def provider_status():
+    """各 LLM 供應商 / 模型的熔斷器狀態與延遲分位數"""
+    return jsonify({"success": True, "providers": get_ai_service().router.stats()})
+
+@bp.route('/api/telemetry', methods=['GET'])
+def telemetry_stats():
+    """各模型最近調用的延遲、首字延遲、輸出速度、錯誤與重試統計"""
+    return jsonify({"success": True, "models": get_ai_service().telemetry.stats()})
+
+@bp.route('/api/costs', methods=['GET'])
+def cost_summary():
+    """
+    成本彙總查詢
+
+    Query 參數: start / end（含，例如 2025-11-01 或 2025-11-01 08:00），
+    granularity=day|hour（預設 day），model（可選）
+    """
+    ledger = get_cost_ledger()
+    ledger.flush(timeout=1.0)
+    try:
+        result = ledger.query(
+            start=request.args.get('start'),
+            end=request.args.get('end'),
+            granularity=request.args.get('granularity', 'day'),
+            model=request.args.get('model')
+        )
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    return jsonify(dict(result, success=True))
 
 @bp.route('/api/verify-password', methods=['POST'])
 def verify_password():
@@ -74,18 +209,38 @@ def upload_template():
             
         save_path = os.path.join(folder, filename)
         file.save(save_path)
+
+        # 在背景預處理模板（提取文字、標題骨架、圖片），生成時直接使用結果
+        processing = _submit_template_ingest(filename)
         
         return jsonify({
             "success": True, 
             "filename": filename,
             "path": save_path,
+            "processing": processing,
             "message": "上傳成功"
         })
 
+def _submit_template_ingest(filename):
+    """將模板預處理排入背景任務佇列，返回處理狀態"""
+    ingestor = get_template_ingestor()
+    ingestor.mark_queued(filename)
+    job = get_job_queue().submit('ingest_template', {"filename": filename})
+    ingestor.attach_job(filename, job['id'])
+    return {"status": TemplateIngestor.STATUS_QUEUED, "job_id": job['id']}
+
+def _run_template_ingest(payload):
+    """背景任務：預處理模板"""
+    path = os.path.join(current_app.config['TEMPLATE_STORAGE_FOLDER'], payload['filename'])
+    if not os.path.exists(path):
+        raise GenerationError("模板文件不存在", 404)
+    return get_template_ingestor().ingest(path)
+
 @bp.route('/api/templates', methods=['GET'])
 def list_templates():
     templates = []
     folder = current_app.config['TEMPLATE_STORAGE_FOLDER']
+    statuses = get_template_ingestor().statuses()
     if os.path.exists(folder):
         for filename in os.listdir(folder):
             file_path = os.path.join(folder, filename)
@@ -98,11 +253,22 @@ def list_templates():
                     "filename": filename,
                     "type": ext.upper(),
                     "size": stats.st_size,
-                    "modified": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stats.st_mtime))
+                    "modified": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stats.st_mtime)),
+                    # 背景預處理狀態：queued / processing / ready / failed，未經上傳接口的文件為 unprocessed
+                    "processing": statuses.get(filename) or {"status": "unprocessed"}
                 })
     return jsonify(templates)
 
 
+@bp.route('/api/templates/<filename>/status', methods=['GET'])
+def template_status(filename):
+    """模板背景預處理的狀態、文件資訊與標題骨架"""
+    status = get_template_ingestor().status(safe_filename(filename))
+    if status is None:
+        return jsonify({"success": False, "error": "沒有此模板的預處理記錄"}), 404
+    return jsonify(dict(status, success=True))
+
+
 @bp.route('/api/download_template/<filename>', methods=['GET'])
 def download_template(filename):
     """下載模板原始檔案"""
@@ -128,6 +294,7 @@ def delete_template(filename):
         
         if os.path.exists(file_path):
             os.remove(file_path)
+            get_template_ingestor().remove(filename)
             return jsonify({"success": True, "message": "模板已刪除"})
         else:
             return jsonify({"success": False, "error": "文件不存在"}), 404
@@ -149,117 +316,13 @@ def optimize_requirements():
         # 獲取 AI 服務
         ai_service = get_ai_service()
 
-        # 1.5 讀取 Profile (角色設定)
-        profile_content = ""
-        try:
-            # 根據文檔類型選擇 Profile
-            if doc_type in ['sop', 'sop_optimize']:
-                profile_path = 'PTT_PROFILE.md'
-            else:
-                profile_path = 'SYS_PROFILE.md'
-            
-            # 讀取 Profile 內容
-            if os.path.exists(profile_path):
-                with open(profile_path, 'r', encoding='utf-8') as f:
-                    profile_content = f.read()
-                # 添加分隔線，確保 AI 區分角色設定與具體指令
-                profile_content = f"{profile_content}\n\n=== Role Definition End ===\n\n"
-                print(f"[INFO] Loaded profile from {profile_path}")
-            else:
-                print(f"[WARNING] Profile {profile_path} not found")
-                
-        except Exception as e:
-            print(f"[ERROR] Failed to read profile: {e}")
-
-        # 根據文檔類型構建優化提示詞
-        if doc_type == 'sop':
-            # SOP 專用的優化提示詞
-            role_def = "你現在是一位企業內部系統的 SOP 工程師，熟悉採購/廠商報價/審核流程。"
-            if profile_content:
-                role_def = "" # 使用 Profile 中的角色設定
-            
-            optimize_prompt = f"""
-{profile_content}
-{role_def}
-輸出語言：繁體中文。
-
-請依照我提供的功能模組，產生標準 SOP 文件。
-
-規則：
-1. SOP 請保持明確、實務、不要誇大或補造不存在的功能。
-2. 每段 SOP 都需包含以下章節：
-   (A) 作業目的
-   (B) 使用角色
-   (C) 系統流程圖（文字描述即可）
-   (D) 作業流程步驟（逐步條列）
-   (E) 異常處理 / 錯誤訊息處理
-   (F) 注意事項
-3. 若流程中涉及 UI 操作，請加入畫面邏輯（例如：點選「新增報價」、輸入欄位、按下儲存）。
-4. 內容需保持一致性、準確描述流程，不可幻想不存在的系統功能。
-5. 使用 Markdown 格式輸出。
-
-原始需求：
-{requirements}
-
-請依照上述規則，產生標準 SOP 文件："""
-
-        elif doc_type == 'system_doc':
-            # 系統文檔的優化提示詞
-            optimize_prompt = f"""
-{profile_content}
-請優化以下系統文檔的需求描述，使其更加清晰、完整、專業。
-
-原始需求：
-{requirements}
-
-請提供優化後的需求描述，要求：
-1. 補充系統架構資訊（前端、後端、資料庫）
-2. 明確功能模組劃分
-3. 列出技術棧需求
-4. 包含部署和維護說明
-5. 使用專業術語，結構清晰
-6. 使用 Markdown 格式輸出
-
-優化後的需求描述："""
-
-        elif doc_type == 'technical_report':
-            # 技術報告的優化提示詞
-            optimize_prompt = f"""
-{profile_content}
-請優化以下技術報告的需求描述，使其更加清晰、完整、專業。
-
-原始需求：
-{requirements}
-
-請提供優化後的需求描述，要求：
-1. 補充背景資訊和問題陳述
-2. 列出技術方案和分析方法
-3. 包含數據分析和實施細節
-4. 提供結論和建議
-5. 使用專業術語，結構清晰
-6. 使用 Markdown 格式輸出
-
-優化後的需求描述："""
-
-        else:
-            # 預設的優化提示詞
-            optimize_prompt = f"""
-{profile_content}
-請優化以下需求描述，使其更加清晰、完整、專業。
-
-原始需求：
-{requirements}
-
-請提供優化後的需求描述，要求：
-1. 保持原意，補充必要的細節
-2. 使用專業術語
-3. 結構清晰，分點說明
-4. 使用 Markdown 格式輸出
-
-優化後的需求描述："""
+        # 構建優化提示詞（Profile 由快取提供）
+        optimize_prompt = get_prompt_registry().build_optimize(doc_type, requirements)
 
-        # 調用 AI API
-        optimized_text, usage_info = ai_service.generate_content(optimize_prompt)
+        # 調用 AI API（輕量任務，使用觀測到最快的合適模型）
+        optimized_text, usage_info = ai_service.generate_content(
+            optimize_prompt, use_cache=not data.get('no_cache'), route='fast'
+        )
 
         return jsonify({
             "success": True,
@@ -271,254 +334,392 @@ def optimize_requirements():
         current_app.logger.error(f"優化需求失敗: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+class GenerationError(Exception):
+    """生成流程中可預期的錯誤（參數錯誤、模板不存在等），附帶 HTTP 狀態碼"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _validate_generation_params(data):
+    """檢查生成請求的必要參數，返回模板路徑"""
+    doc_type = data.get('doc_type')
+    template_file = data.get('template') # 前端傳過來的是 template
+    user_requirements = data.get('requirements')
+
+    if not all([doc_type, template_file, user_requirements]):
+        raise GenerationError("缺少必要參數", 400)
+
+    template_path = os.path.join(current_app.config['TEMPLATE_STORAGE_FOLDER'], template_file)
+    if not os.path.exists(template_path):
+        raise GenerationError("模板文件不存在", 404)
+    return template_path
+
+
 @bp.route('/api/generate', methods=['POST'])
 def generate_document():
+    """
+    生成文檔
+
+    預設只排入任務佇列並立即返回 job_id (202)，
+    之後透過 /api/jobs/<job_id> 查詢狀態、/api/jobs/<job_id>/result 取得結果；
+    請求中帶 "async": false 時在請求內同步完成生成（保留給舊客戶端）。
+
+    "generation_mode": "sections" 時（system_doc / sop / tech_report），
+    模板按標題切分為章節並發生成，適合超過單次輸出上限的長文檔；
+    "generation_mode": "chunked" 時（sop_optimize），舊 SOP 按投影片分段並發優化。
+    """
     try:
-        data = request.json
-        doc_type = data.get('doc_type')
-        template_file = data.get('template') # 前端傳過來的是 template
-        user_requirements = data.get('requirements')
-        output_format = data.get('output_format', 'pptx')
-        image_folder_name = data.get('image_folder')  # 從前端獲取圖片文件夾名稱
-        
-        if not all([doc_type, template_file, user_requirements]):
-            return jsonify({"error": "缺少必要參數"}), 400
-            
-        # 1. 讀取模板內容
-        template_path = os.path.join(current_app.config['TEMPLATE_STORAGE_FOLDER'], template_file)
-        if not os.path.exists(template_path):
-            return jsonify({"error": "模板文件不存在"}), 404
-            
-        template_content = FileProcessor.extract_text(template_path)
-        
-        # 1.5 讀取 Profile (角色設定)
-        profile_content = ""
+        data = request.json or {}
+        _validate_generation_params(data)
+
+        if data.get('async', True):
+            job = get_job_queue().submit('generate', data)
+            return jsonify({
+                "success": True,
+                "job_id": job['id'],
+                "status": job['status'],
+                "status_url": f"/api/jobs/{job['id']}",
+                "result_url": f"/api/jobs/{job['id']}/result"
+            }), 202
+
+        return jsonify(_run_generation(data))
+
+    except GenerationError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+@bp.route('/api/estimate', methods=['POST'])
+def estimate_generation():
+    """
+    試算生成請求（不調用模型）
+
+    參數與 /api/generate 相同，返回本次生成會發出的請求數、輸入 token、
+    預估輸出 token、成本與耗時，以及輸入是否會被截斷。
+    """
+    try:
+        data = request.json or {}
+        doc_config = _prepare_generation(data)
+
+        if doc_config.get('sections'):
+            generator = get_section_generator()
+            sections = doc_config['sections']
+            prompts = [
+                generator.build_prompt(data.get('doc_type'), doc_config['name'], doc_config['profile'],
+                                       data.get('requirements'), sections, index)
+                for index in range(len(sections))
+            ]
+            mode, workers = 'sections', generator.max_workers
+        elif doc_config.get('chunks'):
+            optimizer = get_sop_chunk_optimizer()
+            prompts = optimizer.build_prompts(doc_config['profile'], doc_config['template_content'],
+                                              doc_config['chunks'], doc_config.get('template_skeleton'))
+            mode, workers = 'chunked', optimizer.max_workers
+        else:
+            prompts = [doc_config['prompt']]
+            mode, workers = 'single', 1
+
+        estimate = get_ai_service().estimate(prompts, workers=workers)
+        return jsonify({
+            "success": True,
+            "mode": mode,
+            "estimate": estimate,
+            "token_budget": doc_config.get('token_budget')
+        })
+
+    except GenerationError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+def _serialize_job(job):
+    return {
+        "success": True,
+        "job_id": job['id'],
+        "kind": job['kind'],
+        "status": job['status'],
+        "attempts": job['attempts'],
+        "error": job['error'],
+        "created": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['created_at'])),
+        "updated": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['updated_at']))
+    }
+
+
+@bp.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """查詢任務狀態"""
+    job = get_job_queue().get(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "任務不存在"}), 404
+    return jsonify(_serialize_job(job))
+
+
+@bp.route('/api/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """取得任務結果：完成返回生成結果，未完成返回 202"""
+    job = get_job_queue().get(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "任務不存在"}), 404
+    if job['status'] == JobStore.STATUS_DONE:
+        return jsonify(job['result'])
+    if job['status'] == JobStore.STATUS_FAILED:
+        return jsonify({"success": False, "status": job['status'], "error": job['error']}), 500
+    return jsonify(_serialize_job(job)), 202
+
+
+@bp.route('/api/generate/stream', methods=['POST'])
+def generate_document_stream():
+    """
+    串流生成文檔 (Server-Sent Events)
+
+    事件格式：
+        event: chunk  data: {"text": "..."}      模型輸出的片段
+        event: done   data: {生成結果}            與 /api/generate 響應相同
+        event: error  data: {"error": "..."}
+    """
+    try:
+        data = request.json or {}
+        doc_config = _prepare_generation(data)
+        if doc_config.get('sections') or doc_config.get('chunks'):
+            stream = _stream_parts(data, doc_config)
+        else:
+            stream = get_ai_service().stream_content(doc_config['prompt'], use_cache=not data.get('no_cache'))
+    except GenerationError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    def sse(event, payload):
+        return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    def event_stream():
+        chunks = []
+        usage_info = {}
         try:
-            # 根據文檔類型選擇 Profile
-            if doc_type in ['sop', 'sop_optimize']:
-                profile_path = 'PTT_PROFILE.md'
-            else:
-                profile_path = 'SYS_PROFILE.md'
-            
-            # 讀取 Profile 內容
-            if os.path.exists(profile_path):
-                with open(profile_path, 'r', encoding='utf-8') as f:
-                    profile_content = f.read()
-                # 添加分隔線，確保 AI 區分角色設定與具體指令
-                profile_content = f"{profile_content}\n\n=== Role Definition End ===\n\n"
-                print(f"[INFO] Loaded profile from {profile_path}")
-            else:
-                print(f"[WARNING] Profile {profile_path} not found")
-                
+            for kind, value in stream:
+                if kind == 'chunk':
+                    chunks.append(value)
+                    yield sse('chunk', {"text": value})
+                elif kind == 'usage':
+                    usage_info = value
+            result = _save_generation(data, doc_config, ''.join(chunks), usage_info)
+            yield sse('done', result)
         except Exception as e:
-            print(f"[ERROR] Failed to read profile: {e}")
-
-        # 2. 構建 Prompt
-        prompts = {
-            "system_doc": {
-                "name": "系統文檔",
-                "prompt": f"""
-{profile_content}
-請根據以下模板結構和用戶需求，生成一份專業的系統文檔。
-
-模板內容：
-{template_content}
-
-用戶需求：
-{user_requirements}
-
-要求：
-1. 保持專業的技術文檔風格
-2. 包含系統架構、功能模組、技術棧等內容
-3. 確保文檔結構清晰、邏輯嚴謹
-4. 使用標準的技術術語
-5. 根據模板格式調整輸出格式
-6. 請生成完整的系統文檔內容，使用Markdown格式輸出。
-                """,
-                "title": "系統設計文檔"
-            },
-            "sop": {
-                "name": "SOP標準作業程序",
-                "prompt": f"""
-{profile_content}
-請根據以下模板結構和用戶需求，生成一份標準作業程序(SOP)文檔。
-
-模板內容：
-{template_content}
-
-用戶需求：
-{user_requirements}
-
-要求：
-1. 步驟清晰明確
-2. 包含目的、範圍、職責、流程圖（文字描述）、詳細步驟
-3. 注意事項和異常處理
-4. 語言簡練、指令性強
-5. 根據模板格式調整輸出格式
-6. 請生成完整的SOP內容，使用Markdown格式輸出。
-                """,
-                "title": "標準作業程序(SOP)"
-            },
-            "tech_report": {
-                "name": "技術報告",
-                "prompt": f"""
-{profile_content}
-請根據以下模板結構和用戶需求，生成一份技術分析報告。
-
-模板內容：
-{template_content}
-
-用戶需求：
-{user_requirements}
-
-要求：
-1. 數據準確、分析深入
-2. 包含背景、方法、結果、結論等部分
-3. 圖表說明清晰
-4. 技術細節完整
-5. 根據模板格式調整輸出格式
-6. 請生成完整的技術報告內容，使用Markdown格式輸出。
-                """,
-                "title": "技術分析報告"
-            },
-            "sop_optimize": {
-                "name": "SOP優化",
-                "prompt": f"""
-{profile_content}
-你是一位專業的 SOP 文檔優化專家。請將以下舊的 SOP 文檔優化為統一、專業的標準作業程序。
-
-=== 原始 SOP 內容 ===
-{user_requirements}
-
-=== 參考模板風格 ===
-{template_content}
-
-=== 優化要求 ===
-
-**1. 內容處理原則**：
-- **保留所有關鍵信息**：所有操作步驟、設定值、路徑、注意事項都必須保留
-- **保留所有圖片標記**：格式為 [圖片 X-Y: 來自投影片 Z]，必須完整保留
-- **允許合理整合**：可以整合重複或相似的內容，使文檔更簡潔
-- **保留業務邏輯**：確保所有業務流程和邏輯關係都清晰呈現
-
-**2. 圖片標記處理**：
-- 所有 [圖片 X-Y: 來自投影片 Z] 標記必須保留
-- 圖片標記應放在相關內容的適當位置
-- 不要刪除任何圖片標記
-
-**3. 格式優化**：
-- 參考模板的章節結構（目的、範圍、職責、流程等）
-- 使用清晰的標題層級（#, ##, ###）
-- 使用列表和表格提高可讀性
-- 統一術語和表達方式
-
-**4. 內容組織**：
-- 將內容按照標準 SOP 結構重新組織
-- 合併重複的說明，但保留所有獨特的信息
-- 確保邏輯清晰、步驟連貫
-- 使用適當的章節劃分
-
-**5. 語言優化**：
-- 使用專業、簡練的語言
-- 統一術語
-- 改善可讀性
-- 消除冗餘表達
-
-**輸出格式**：
-- 使用 Markdown 格式
-- 清晰的標題層級
-- 適當使用列表和表格
-
-請生成優化後的 SOP 文檔，確保所有關鍵信息和圖片標記都被保留。
-                """,
-                "title": "SOP優化文檔"
-            }
-        }
-        
-        doc_config = prompts.get(doc_type)
-        if not doc_config:
-            return jsonify({"error": "不支持的文檔類型"}), 400
-            
-        # 3. 調用 AI 生成內容
+            import traceback
+            traceback.print_exc()
+            yield sse('error', {"error": str(e)})
+
+    headers = {
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # 避免反向代理緩衝導致無法即時輸出
+    }
+    return Response(stream_with_context(event_stream()), mimetype='text/event-stream', headers=headers)
+
+
+def _run_generation(data):
+    """
+    執行完整的生成流程：讀取模板 → 構建 Prompt → 調用 AI → 格式轉換與保存
+
+    同步請求與背景任務共用此函數，需在應用上下文中調用。
+
+    Returns:
+        dict: 與 /api/generate 同步響應相同的結果
+    """
+    doc_config = _prepare_generation(data)
+
+    # 3. 調用 AI 生成內容
+    if doc_config.get('sections'):
+        generated_content, usage_info = get_section_generator().generate(
+            data.get('doc_type'), doc_config['name'], doc_config['profile'],
+            data.get('requirements'), doc_config['sections'], use_cache=not data.get('no_cache')
+        )
+    elif doc_config.get('chunks'):
+        generated_content, usage_info = get_sop_chunk_optimizer().generate(
+            doc_config['profile'], doc_config['template_content'], doc_config['chunks'],
+            use_cache=not data.get('no_cache'), skeleton=doc_config.get('template_skeleton')
+        )
+    else:
         ai_service = get_ai_service()
-        generated_content, usage_info = ai_service.generate_content(doc_config['prompt'])
+        generated_content, usage_info = ai_service.generate_content(
+            doc_config['prompt'], use_cache=not data.get('no_cache')
+        )
+
+    return _save_generation(data, doc_config, generated_content, usage_info)
+
+
+def _stream_parts(data, doc_config):
+    """
+    分段生成 / 分段 SOP 優化的串流：各段按順序完成後整段輸出
+
+    與 AIService.stream_content 相同，產出 ('chunk', text) 及最後的 ('usage', usage_info)。
+    """
+    use_cache = not data.get('no_cache')
+    if doc_config.get('sections'):
+        generator = get_section_generator()
+        usages = []
+        for index, content, usage_info in generator.iter_sections(
+                data.get('doc_type'), doc_config['name'], doc_config['profile'],
+                data.get('requirements'), doc_config['sections'], use_cache=use_cache):
+            usages.append(usage_info)
+            yield 'chunk', f"\n\n{content}" if index else content
+        yield 'usage', generator.merge_usage(usages)
+    else:
+        optimizer = get_sop_chunk_optimizer()
+        usages = []
+        retries = 0
+        for index, content, window_usages, window_retries in optimizer.iter_windows(
+                doc_config['profile'], doc_config['template_content'], doc_config['chunks'],
+                use_cache=use_cache, skeleton=doc_config.get('template_skeleton')):
+            usages.extend(window_usages)
+            retries += window_retries
+            yield 'chunk', f"\n\n{content}" if index else content
+        yield 'usage', optimizer.merge_usage(usages, len(doc_config['chunks']), retries)
+
+
+def _prepare_generation(data):
+    """讀取模板與 Profile 並構建 Prompt，返回所選文檔類型的配置"""
+    doc_type = data.get('doc_type')
+    user_requirements = data.get('requirements')
+
+    # 1. 讀取模板內容（上傳時已提取，通常直接命中快取）
+    template_path = _validate_generation_params(data)
+    template_content = get_template_text_cache().get_text(template_path)
+    
+    # 2. 取得文檔類型與 Profile（Prompt 只在需要時構建）
+    registry = get_prompt_registry()
+    doc_config = registry.doc_config(doc_type)
+    if not doc_config:
+        raise GenerationError("不支持的文檔類型", 400)
+    profile_content = registry.profile(doc_type)
+
+    # 分段生成：模板可按標題切分時，各章節並發生成後再拼接
+    if data.get('generation_mode') == 'sections' and doc_type in SectionGenerator.SUPPORTED_DOC_TYPES:
+        generator = get_section_generator()
+        sections = generator.split_sections(template_content)
+        if len(sections) >= generator.min_sections:
+            doc_config['sections'] = sections
+            doc_config['profile'] = profile_content
+        else:
+            print(f"[INFO] 模板只有 {len(sections)} 個章節，改用整份生成")
+
+    # 分段 SOP 優化：舊 SOP 按投影片切分為窗口並發優化，逐段檢查圖片標記
+    if data.get('generation_mode') == 'chunked' and doc_type == 'sop_optimize':
+        windows = get_sop_chunk_optimizer().split_windows(user_requirements)
+        if len(windows) >= 2:
+            doc_config['chunks'] = windows
+            doc_config['profile'] = profile_content
+            doc_config['template_content'] = template_content
+            # 上傳時預處理產生的標題骨架；尚未完成時由優化器從模板文字產生
+            doc_config['template_skeleton'] = get_template_ingestor().skeleton(os.path.basename(template_path))
+        else:
+            print("[INFO] 舊 SOP 內容只需一段，改用整份優化")
+
+    # 整份生成時控制輸入 token：超出上限時依序截斷模板、Profile、用戶需求
+    if not doc_config.get('sections') and not doc_config.get('chunks'):
+        parts = {'template': template_content, 'profile': profile_content, 'requirements': user_requirements}
+        prompt, _, report = get_ai_service().fit_prompt(
+            parts, PROMPT_TRIM_PRIORITY,
+            lambda p: registry.build(doc_type, p['profile'], p['template'], p['requirements'])
+        )
+        if report['trimmed']:
+            print(f"[WARNING] Prompt 超出輸入上限 {report['budget']} tokens，已截斷: {report['trimmed']}")
+        doc_config['prompt'] = prompt
+        doc_config['token_budget'] = report
+    return doc_config
+
+
+# 超出輸入上限時截斷的順序（優先級由低到高）
+PROMPT_TRIM_PRIORITY = ('template', 'profile', 'requirements')
+
+
+def _save_generation(data, doc_config, generated_content, usage_info):
+    """將生成的 Markdown 保存並轉換為請求的輸出格式，返回生成結果"""
+    doc_type = data.get('doc_type')
+    template_file = data.get('template')
+    output_format = data.get('output_format', 'pptx')
+    image_folder_name = data.get('image_folder')  # 從前端獲取圖片文件夾名稱
+
+    # 4. 格式轉換與保存
+    from datetime import datetime
+    datetime_str = datetime.now().strftime('%Y%m%d%H%M%S')  # 格式：YYYYMMDDHHMMSS
+    
+    # 生成文件名：如果是 SOP 優化，保留原文件名
+    if doc_type == 'sop_optimize':
+        # 從 template_file 提取原始文件名（去除擴展名）
+        original_name = os.path.splitext(template_file)[0]
+        base_filename = f"{original_name}_{datetime_str}"
+    else:
+        # 其他類型使用日期時間格式
+        base_filename = f"generated_{doc_type}_{datetime_str}"
+    
+    output_folder = current_app.config['OUTPUT_FOLDER']
+    
+    result_files = {}
+    
+    # 始終保存 Markdown 原文
+    md_filename = f"{base_filename}.md"
+    md_path = os.path.join(output_folder, md_filename)
+    with open(md_path, 'w', encoding='utf-8') as f:
+        f.write(generated_content)
+    result_files['md'] = md_filename
+    
+    # 根據請求的格式轉換
+    if output_format == 'docx':
+        docx_filename = f"{base_filename}.docx"
+        docx_path = os.path.join(output_folder, docx_filename)
+        doc = FormatConverter.markdown_to_docx(generated_content, doc_config)
+        doc.save(docx_path)
+        result_files['docx'] = docx_filename
+        download_file = docx_filename
         
-        # 4. 格式轉換與保存
-        from datetime import datetime
-        datetime_str = datetime.now().strftime('%Y%m%d%H%M%S')  # 格式：YYYYMMDDHHMMSS
+    elif output_format == 'pptx':
+        pptx_filename = f"{base_filename}.pptx"
+        pptx_path = os.path.join(output_folder, pptx_filename)
         
-        # 生成文件名：如果是 SOP 優化，保留原文件名
-        if doc_type == 'sop_optimize':
-            # 從 template_file 提取原始文件名（去除擴展名）
-            original_name = os.path.splitext(template_file)[0]
-            base_filename = f"{original_name}_{datetime_str}"
+        # 如果有圖片文件夾，傳遞給轉換器
+        image_folder_path = None
+        if image_folder_name:
+            image_folder_path = os.path.join(output_folder, 'temp_images', image_folder_name)
+            print(f"[DEBUG] 圖片文件夾路徑: {image_folder_path}")
+            print(f"[DEBUG] 文件夾是否存在: {os.path.exists(image_folder_path)}")
         else:
-            # 其他類型使用日期時間格式
-            base_filename = f"generated_{doc_type}_{datetime_str}"
-        
-        output_folder = current_app.config['OUTPUT_FOLDER']
-        
-        result_files = {}
-        
-        # 始終保存 Markdown 原文
-        md_filename = f"{base_filename}.md"
-        md_path = os.path.join(output_folder, md_filename)
-        with open(md_path, 'w', encoding='utf-8') as f:
-            f.write(generated_content)
-        result_files['md'] = md_filename
-        
-        # 根據請求的格式轉換
-        if output_format == 'docx':
-            docx_filename = f"{base_filename}.docx"
-            docx_path = os.path.join(output_folder, docx_filename)
-            doc = FormatConverter.markdown_to_docx(generated_content, doc_config)
-            doc.save(docx_path)
-            result_files['docx'] = docx_filename
-            download_file = docx_filename
-            
-        elif output_format == 'pptx':
-            pptx_filename = f"{base_filename}.pptx"
-            pptx_path = os.path.join(output_folder, pptx_filename)
-            
-            # 如果有圖片文件夾，傳遞給轉換器
-            image_folder_path = None
-            if image_folder_name:
-                image_folder_path = os.path.join(output_folder, 'temp_images', image_folder_name)
-                print(f"[DEBUG] 圖片文件夾路徑: {image_folder_path}")
-                print(f"[DEBUG] 文件夾是否存在: {os.path.exists(image_folder_path)}")
-            else:
-                print(f"[DEBUG] 沒有收到 image_folder_name")
-            
-            prs = FormatConverter.markdown_to_pptx(generated_content, doc_config, image_folder_path)
-            prs.save(pptx_path)
-            result_files['pptx'] = pptx_filename
-            download_file = pptx_filename
-            
-        elif output_format == 'pdf':
-            pdf_filename = f"{base_filename}.pdf"
-            pdf_path = os.path.join(output_folder, pdf_filename)
-            FormatConverter.markdown_to_pdf(generated_content, doc_config, pdf_path)
-            result_files['pdf'] = pdf_filename
-            download_file = pdf_filename
-            
-        else: # 默認 Markdown
-            download_file = md_filename
-            
-        return jsonify({
-            "success": True,
-            "message": "文檔生成成功",
-            "filename": download_file,
-            "format": output_format,
-            "files": result_files,
-            "usage": usage_info,
-            "download_url": f"/api/download/{download_file}",
-            "preview": generated_content[:500] + "..."
-        })
+            print(f"[DEBUG] 沒有收到 image_folder_name")
         
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+        prs = FormatConverter.markdown_to_pptx(generated_content, doc_config, image_folder_path)
+        prs.save(pptx_path)
+        result_files['pptx'] = pptx_filename
+        download_file = pptx_filename
+        
+    elif output_format == 'pdf':
+        pdf_filename = f"{base_filename}.pdf"
+        pdf_path = os.path.join(output_folder, pdf_filename)
+        FormatConverter.markdown_to_pdf(generated_content, doc_config, pdf_path)
+        result_files['pdf'] = pdf_filename
+        download_file = pdf_filename
+        
+    else: # 默認 Markdown
+        download_file = md_filename
+        
+    result = {
+        "success": True,
+        "message": "文檔生成成功",
+        "filename": download_file,
+        "format": output_format,
+        "files": result_files,
+        "usage": usage_info,
+        "download_url": f"/api/download/{download_file}",
+        "preview": generated_content[:500] + "..."
+    }
+    if doc_config.get('token_budget'):
+        result['token_budget'] = doc_config['token_budget']
+    return result
+
 
 @bp.route('/api/download/<filename>')
 def download_file(filename):
@@ -666,33 +867,50 @@ def extract_text():
             content = ""
             image_info = None
             
-            # 如果是 PPTX，提取圖片
+            # 如果是 PPTX，一次遍歷同時提取文本（包含圖片標記）與圖片（存入圖片存放區，臨時文件夾只有清單）
+            # 延遲模式 (IMAGE_EXTRACTION_MODE = 'lazy') 不讀取圖片，保留上傳的 PPTX，需要時再從中讀取
             if ext == 'pptx':
                 from app.services.image_service import ImageExtractor
                 
-                # 提取文本（包含圖片標記）
-                content, image_count = FileProcessor.extract_text_from_pptx(temp_path, include_image_markers=True)
+                base_image_folder = os.path.join(current_app.config['OUTPUT_FOLDER'], 'temp_images')
+                image_folder = ImageExtractor.create_temp_image_folder(base_image_folder)
+                lazy = current_app.config.get('IMAGE_EXTRACTION_MODE', 'store') == 'lazy'
+                try:
+                    image_store = get_image_store()
+                    ingested = ingest_pptx(temp_path, image_folder, store=image_store, lazy=lazy)
+                except OOXML_ERRORS as e:
+                    # 文件結構不符預期：改用 python-pptx 只提取文字
+                    print(f"[WARNING] PPTX 單次解析失敗，改用 python-pptx: {e}")
+                    content, _ = FileProcessor.extract_text_from_pptx(
+                        temp_path, include_image_markers=True, include_slide_markers=True
+                    )
+                    ingested = {'images': []}
+                else:
+                    content = ingested['text']
                 
-                # 如果有圖片，提取並保存
-                if image_count > 0:
-                    # 創建臨時圖片文件夾
-                    base_image_folder = os.path.join(current_app.config['OUTPUT_FOLDER'], 'temp_images')
-                    image_folder = ImageExtractor.create_temp_image_folder(base_image_folder)
-                    
-                    # 提取圖片
-                    images = ImageExtractor.extract_images_from_pptx(temp_path, image_folder)
-                    
+                if ingested['images']:
+                    if lazy:
+                        package_path = os.path.join(image_folder, 'source.pptx')
+                        shutil.move(temp_path, package_path)
+                        manifest = ImageManifest.for_package(image_folder, package_path, ingested['images'])
+                    else:
+                        manifest = image_store.write_manifest(image_folder, ingested['images'])
                     image_info = {
-                        'count': image_count,
+                        'count': ingested['image_count'],
                         'folder': image_folder,
-                        'images': images
+                        'images': ingested['images'],
+                        'unique': manifest.unique_count(),
+                        'near_duplicates': manifest.near_duplicate_count()
                     }
+                else:
+                    ImageExtractor.cleanup_temp_images(image_folder)
             else:
                 # 其他格式使用原有邏輯
                 content = FileProcessor.extract_text(temp_path)
             
-            # 刪除臨時文件
-            os.remove(temp_path)
+            # 刪除臨時文件（延遲模式下已移入圖片文件夾）
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
             
             response_data = {
                 "success": True,
@@ -704,7 +922,9 @@ def extract_text():
             if image_info:
                 response_data['images'] = {
                     'count': image_info['count'],
-                    'folder': os.path.basename(image_info['folder'])  # 只返回文件夾名稱
+                    'folder': os.path.basename(image_info['folder']),  # 只返回文件夾名稱
+                    'unique': image_info['unique'],
+                    'near_duplicates': image_info['near_duplicates']
                 }
             
             return jsonify(response_data)
@@ -718,6 +938,24 @@ def extract_text():
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@bp.route('/api/images/<folder>/<key>', methods=['GET'])
+def extracted_image(folder, key):
+    """讀取 /api/extract_text 提取出的圖片（延遲模式下直接從上傳的 PPTX 串流讀取）"""
+    image_folder = os.path.join(current_app.config['OUTPUT_FOLDER'], 'temp_images', secure_filename(folder))
+    manifest = ImageManifest.load(image_folder)
+    if manifest is None or key not in manifest.images:
+        return jsonify({"success": False, "error": "圖片不存在"}), 404
+
+    ext = manifest.images[key]['ext']
+    try:
+        stream = manifest.open(key)
+    except (OSError, KeyError, zipfile.BadZipFile) as e:
+        return jsonify({"success": False, "error": f"讀取圖片失敗: {e}"}), 404
+    finally:
+        manifest.close()
+    return send_file(stream, mimetype=mimetypes.guess_type(f"image{ext}")[0] or 'application/octet-stream',
+                     download_name=f"{key}{ext}")
+
 @bp.route('/api/stage_image', methods=['POST'])
 def stage_image():
     """暫存圖片用於後續注入"""
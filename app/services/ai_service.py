@@ -1,119 +1,194 @@
 import os
 import json
+import math
 import time
-import requests
-import google.generativeai as genai
+import threading
 from datetime import datetime
 from ..utils.helpers import log_cost_to_file
+from .cache_service import ResponseCache
+from .provider_clients import ProviderClients
+from .config_store import ConfigStore
+from .coalesce_service import SingleFlight
+from .token_service import TokenCounter, PromptBudget
+from .router_service import ProviderRouter, ModelRoutingPolicy, NoAvailableProviderError
+from .telemetry_service import Telemetry
+from .retry_service import RetryPolicy, RateLimiter, ProviderHTTPError, parse_retry_after
 
 class AIService:
     """AI 服務 - 處理與 LLM 的交互"""
     
     def __init__(self, app_config):
         self.config = app_config
+        self.config_store = ConfigStore(os.path.join('config', 'api_config.json'))
         self.api_config = self.load_api_config()
         self.api_type = self.api_config.get('api_type', 'gemini')
+        self.cache = self._create_cache(app_config)
+        self.clients = ProviderClients(
+            connect_timeout=app_config.get('LLM_CONNECT_TIMEOUT', 10),
+            read_timeout=app_config.get('LLM_READ_TIMEOUT', 120),
+            pool_maxsize=app_config.get('LLM_HTTP_POOL_SIZE', 32)
+        )
+        self.retry_policy = RetryPolicy(
+            max_attempts=app_config.get('LLM_RETRY_MAX_ATTEMPTS', 4),
+            base_delay=app_config.get('LLM_RETRY_BASE_DELAY', 1.0),
+            max_delay=app_config.get('LLM_RETRY_MAX_DELAY', 30.0),
+            deadline=app_config.get('LLM_RETRY_DEADLINE', 180.0)
+        )
+        self.rate_limiter = RateLimiter(app_config.get('LLM_RATE_LIMITS'))
+        self.singleflight = SingleFlight(
+            db_path=app_config.get('LLM_SINGLEFLIGHT_DB_PATH'),
+            lease_seconds=app_config.get('LLM_SINGLEFLIGHT_LEASE_SECONDS', 300)
+        ) if app_config.get('LLM_SINGLEFLIGHT_ENABLED', True) else None
+        self.router = ProviderRouter(
+            hedge_percentile=app_config.get('LLM_HEDGE_PERCENTILE', 0.95),
+            hedge_min_samples=app_config.get('LLM_HEDGE_MIN_SAMPLES', 20),
+            hedge_default_delay=app_config.get('LLM_HEDGE_DEFAULT_DELAY', 30.0),
+            hedge_min_delay=app_config.get('LLM_HEDGE_MIN_DELAY', 2.0),
+            hedge_max_delay=app_config.get('LLM_HEDGE_MAX_DELAY', 60.0),
+            failure_threshold=app_config.get('LLM_BREAKER_FAILURE_THRESHOLD', 3),
+            slo_seconds=app_config.get('LLM_BREAKER_SLO_SECONDS'),
+            slo_breaches=app_config.get('LLM_BREAKER_SLO_BREACHES', 3),
+            reset_timeout=app_config.get('LLM_BREAKER_RESET_SECONDS', 30.0),
+            max_workers=app_config.get('LLM_ROUTER_WORKERS', 16)
+        )
+        self.telemetry = Telemetry(window=app_config.get('LLM_TELEMETRY_WINDOW', 500))
+        self.model_policy = ModelRoutingPolicy(
+            self.telemetry,
+            candidates=app_config.get('LLM_ROUTING_CANDIDATES'),
+            short_prompt_tokens=app_config.get('LLM_ROUTING_SHORT_PROMPT_TOKENS', 1500),
+            min_samples=app_config.get('LLM_ROUTING_MIN_SAMPLES', 5),
+            max_error_rate=app_config.get('LLM_ROUTING_MAX_ERROR_RATE', 0.2)
+        ) if app_config.get('LLM_ADAPTIVE_ROUTING_ENABLED', False) else None
+        # 記錄當前線程正在進行的供應商調用的重試次數
+        self._call_state = threading.local()
+        self.tokens = TokenCounter()
+        self.prompt_budget = PromptBudget(
+            self.tokens,
+            budgets=app_config.get('LLM_INPUT_TOKEN_BUDGETS'),
+            default_budget=app_config.get('LLM_INPUT_TOKEN_BUDGET', 100000)
+        )
+
+    @staticmethod
+    def _create_cache(app_config):
+        """根據應用配置建立響應快取，未啟用時返回 None"""
+        if not app_config.get('LLM_CACHE_ENABLED', True):
+            return None
+        return ResponseCache(
+            db_path=app_config.get('LLM_CACHE_DB_PATH'),
+            max_memory_entries=app_config.get('LLM_CACHE_MEMORY_ENTRIES', 256),
+            ttl_seconds=app_config.get('LLM_CACHE_TTL_SECONDS', 7 * 24 * 3600),
+            max_disk_bytes=app_config.get('LLM_CACHE_MAX_DISK_MB', 200) * 1024 * 1024
+        )
 
     def load_api_config(self):
-        """加載 API 配置 - 優先從環境變數讀取"""
-        config_path = os.path.join('config', 'api_config.json')
-        config = {}
-        
-        # 先從 JSON 文件讀取
-        if os.path.exists(config_path):
-            try:
-                with open(config_path, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-            except:
-                config = {}
-        
-        # 環境變數優先級更高，會覆蓋 JSON 文件中的配置
-        if os.environ.get('GEMINI_API_KEY'):
-            config['gemini_api_key'] = os.environ.get('GEMINI_API_KEY')
-        if os.environ.get('OPENAI_API_KEY'):
-            config['openai_api_key'] = os.environ.get('OPENAI_API_KEY')
-        if os.environ.get('API_TYPE'):
-            config['api_type'] = os.environ.get('API_TYPE')
-        if os.environ.get('OPENAI_MODEL'):
-            config['openai_model'] = os.environ.get('OPENAI_MODEL')
-        
-        return config
+        """
+        加載 API 配置 - 優先從環境變數讀取
+
+        返回快取的不可變快照，只有配置文件變更時才會重新解析。
+        """
+        return self.config_store.snapshot()
 
     def save_api_config(self, config):
         """保存 API 配置"""
-        config_path = os.path.join('config', 'api_config.json')
-        os.makedirs('config', exist_ok=True)
-        with open(config_path, 'w', encoding='utf-8') as f:
-            json.dump(config, f, indent=4)
-        self.api_config = config
-        self.api_type = config.get('api_type', 'gemini')
-
-    def call_gemini_api(self, prompt):
-        """調用 Gemini API（帶重試機制）"""
-        api_key = self.api_config.get('gemini_api_key')
+        previous = self.config_store.snapshot()
+        snapshot = self.config_store.save(config)
+
+        # 只有憑證或服務位址變更時才重建客戶端，其餘設定不影響已建立的連線
+        credential_keys = ('gemini_api_key', 'openai_api_key', 'openai_base_url')
+        if any(snapshot.get(k) != previous.get(k) for k in credential_keys):
+            self.clients.reset()
+
+        self.api_config = snapshot
+        self.api_type = snapshot.get('api_type', 'gemini')
+
+    GEMINI_GENERATION_CONFIG = {
+        "temperature": 0.7,
+        "top_p": 0.95,
+        "top_k": 40,
+        "max_output_tokens": 8192,
+        "response_mime_type": "text/plain",
+    }
+
+    OPENAI_SYSTEM_PROMPT = "你是一個專業的文檔生成助手，擅長撰寫各種技術文檔、報告和 SOP。"
+    OPENAI_DEFAULT_BASE_URL = "https://api.openai.com/v1"
+
+    def _build_gemini_model(self, api_config):
+        """取得重用的 Gemini 模型，返回 (model, model_name)"""
+        api_key = api_config.get('gemini_api_key')
         if not api_key:
             raise Exception("未配置 Gemini API Key")
-
-        genai.configure(api_key=api_key)
         
         # 使用 Gemini 2.0 Flash (速度快且免費額度高)
-        model_name = self.api_config.get('gemini_model', 'gemini-2.0-flash-exp')
+        model_name = api_config.get('gemini_model', 'gemini-2.0-flash-exp')
+
+        model = self.clients.gemini_model(api_key, model_name, self.GEMINI_GENERATION_CONFIG)
+        return model, model_name
+
+    @staticmethod
+    def _gemini_usage(response):
+        """從 Gemini response 中提取 token 使用量"""
+        input_tokens = 0
+        output_tokens = 0
+        if hasattr(response, 'usage_metadata'):
+            usage_metadata = response.usage_metadata
+            input_tokens = getattr(usage_metadata, 'prompt_token_count', 0)
+            output_tokens = getattr(usage_metadata, 'candidates_token_count', 0)
+        return input_tokens, output_tokens
+
+    def _call_with_retry(self, provider, model, prompt, request_fn):
+        """在客戶端限流與重試策略下執行一次供應商請求"""
+        estimated_tokens = self.tokens.count(prompt, provider, model)
+
+        def attempt(deadline):
+            self.rate_limiter.acquire(provider, model, estimated_tokens, deadline)
+            return request_fn()
+
+        def on_retry(attempt_number, exc, delay):
+            self._call_state.retries = attempt_number
+
+        return self.retry_policy.call(attempt, on_retry=on_retry)
+
+    def call_gemini_api(self, prompt, api_config=None):
+        """調用 Gemini API（帶重試與限流）"""
+        model, model_name = self._build_gemini_model(api_config or self.api_config)
+
+        try:
+            # 單輪生成不需要對話歷史，直接調用 generate_content
+            response = self._call_with_retry('gemini', model_name, prompt, lambda: model.generate_content(
+                prompt, request_options={"timeout": self.clients.read_timeout}
+            ))
+            content = response.text
+        except Exception as e:
+            raise Exception(f"Gemini API 調用失敗: {str(e)}")
+        
+        input_tokens, output_tokens = self._gemini_usage(response)
         
-        generation_config = {
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 8192,
-            "response_mime_type": "text/plain",
+        # Gemini 2.0 Flash 目前免費，成本為 0
+        cost = 0.0
+        
+        # 記錄 token 使用量
+        log_cost_to_file(model_name, input_tokens, output_tokens, cost)
+        
+        usage_info = {
+            "model": model_name,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cost": cost
         }
+        return content, usage_info
 
-        model = genai.GenerativeModel(
-            model_name=model_name,
-            generation_config=generation_config,
-        )
-
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                chat_session = model.start_chat(history=[])
-                response = chat_session.send_message(prompt)
-                
-                # 從 Gemini response 中提取 token 使用量
-                input_tokens = 0
-                output_tokens = 0
-                
-                if hasattr(response, 'usage_metadata'):
-                    usage_metadata = response.usage_metadata
-                    input_tokens = getattr(usage_metadata, 'prompt_token_count', 0)
-                    output_tokens = getattr(usage_metadata, 'candidates_token_count', 0)
-                
-                # Gemini 2.0 Flash 目前免費，成本為 0
-                cost = 0.0
-                
-                # 記錄 token 使用量
-                log_cost_to_file(model_name, input_tokens, output_tokens, cost)
-                
-                usage_info = {
-                    "model": model_name,
-                    "input_tokens": input_tokens,
-                    "output_tokens": output_tokens,
-                    "cost": cost
-                }
-                return response.text, usage_info
-            except Exception as e:
-                if attempt == max_retries - 1:
-                    raise Exception(f"Gemini API 調用失敗 (重試 {max_retries} 次後): {str(e)}")
-                time.sleep(2) # 等待後重試
-
-    def call_openai_api(self, prompt):
-        """調用 OpenAI API（帶成本追蹤）"""
-        api_key = self.api_config.get('openai_api_key')
+    def _build_openai_request(self, prompt, api_config, stream=False):
+        """構建 OpenAI Chat Completions 請求，返回 (url, headers, payload, model)"""
+        api_key = api_config.get('openai_api_key')
         if not api_key:
             raise Exception("未配置 OpenAI API Key")
 
-        model = self.api_config.get('openai_model')
+        model = api_config.get('openai_model')
         if not model:
             model = 'gpt-4o-mini'
+
+        # 支持 OpenAI 相容的服務（例如本地測試用的 stub）
+        base_url = (api_config.get('openai_base_url') or self.OPENAI_DEFAULT_BASE_URL).rstrip('/')
         
         headers = {
             "Content-Type": "application/json",
@@ -125,7 +200,7 @@ class AIService:
             "messages": [
                 {
                     "role": "system",
-                    "content": "你是一個專業的文檔生成助手，擅長撰寫各種技術文檔、報告和 SOP。"
+                    "content": self.OPENAI_SYSTEM_PROMPT
                 },
                 {
                     "role": "user",
@@ -134,18 +209,39 @@ class AIService:
             ],
             "temperature": 0.7
         }
+        if stream:
+            payload["stream"] = True
+            # 要求在最後一個 chunk 中返回 usage，以便結束時計算成本
+            payload["stream_options"] = {"include_usage": True}
 
-        try:
-            response = requests.post(
-                "https://api.openai.com/v1/chat/completions",
+        return f"{base_url}/chat/completions", headers, payload, model
+
+    def _openai_cost(self, model, input_tokens, output_tokens):
+        pricing = self.config['OPENAI_PRICING'].get(model, {'input': 0, 'output': 0})
+        return (input_tokens / 1000000 * pricing['input']) + \
+               (output_tokens / 1000000 * pricing['output'])
+
+    def call_openai_api(self, prompt, api_config=None):
+        """調用 OpenAI API（帶重試、限流與成本追蹤）"""
+        url, headers, payload, model = self._build_openai_request(prompt, api_config or self.api_config)
+
+        def request():
+            response = self.clients.http_session().post(
+                url,
                 headers=headers,
-                json=payload
+                json=payload,
+                timeout=self.clients.timeout
             )
-            
             if response.status_code != 200:
-                raise Exception(f"OpenAI API Error: {response.text}")
-                
-            result = response.json()
+                raise ProviderHTTPError(
+                    f"OpenAI API Error: {response.text}",
+                    status_code=response.status_code,
+                    retry_after=parse_retry_after(response.headers)
+                )
+            return response.json()
+
+        try:
+            result = self._call_with_retry('openai', model, prompt, request)
             content = result['choices'][0]['message']['content']
             
             # 計算成本
@@ -153,9 +249,7 @@ class AIService:
             input_tokens = usage.get('prompt_tokens', 0)
             output_tokens = usage.get('completion_tokens', 0)
             
-            pricing = self.config['OPENAI_PRICING'].get(model, {'input': 0, 'output': 0})
-            cost = (input_tokens / 1000000 * pricing['input']) + \
-                   (output_tokens / 1000000 * pricing['output'])
+            cost = self._openai_cost(model, input_tokens, output_tokens)
             
             # 記錄成本
             log_cost_to_file(model, input_tokens, output_tokens, cost)
@@ -172,11 +266,7 @@ class AIService:
         except Exception as e:
             raise Exception(f"OpenAI API 調用失敗: {str(e)}")
 
-    def call_mock_api(self, prompt):
-        """調用模擬 API (不消耗額度)"""
-        time.sleep(1) # 模擬延遲
-        
-        content = """# 模擬生成文檔
+    MOCK_CONTENT = """# 模擬生成文檔
 
 這是一份由模擬 AI 生成的文檔內容。
 
@@ -191,6 +281,12 @@ class AIService:
 ## 3. 結論
 模擬模式運行正常。
 """
+
+    def call_mock_api(self, prompt, api_config=None):
+        """調用模擬 API (不消耗額度)"""
+        time.sleep(1) # 模擬延遲
+        
+        content = self.MOCK_CONTENT
         usage_info = {
             "model": "mock-model",
             "input_tokens": len(prompt),
@@ -199,17 +295,458 @@ class AIService:
         }
         return content, usage_info
 
-    def generate_content(self, prompt):
-        """生成內容的主入口"""
-        # 重新加載配置以確保獲取最新的設置（包括環境變數）
-        self.api_config = self.load_api_config()
-        api_type = self.api_config.get('api_type', 'gemini')
-        
+    # ==================== Token 預算與估算 ====================
+
+    @staticmethod
+    def _model_name(api_type, api_config):
+        """返回指定配置實際使用的模型名稱"""
         if api_type == 'gemini':
-            return self.call_gemini_api(prompt)
+            return api_config.get('gemini_model', 'gemini-2.0-flash-exp')
+        if api_type == 'openai':
+            return api_config.get('openai_model') or 'gpt-4o-mini'
+        if api_type == 'mock':
+            return 'mock-model'
+        return None
+
+    def current_model(self):
+        """返回目前配置的 (api_type, model)"""
+        api_config = self.load_api_config()
+        api_type = api_config.get('api_type', 'gemini')
+        return api_type, self._model_name(api_type, api_config)
+
+    def count_tokens(self, text):
+        """以目前配置的模型計算 token 數"""
+        api_type, model = self.current_model()
+        return self.tokens.count(text, api_type, model)
+
+    def fit_prompt(self, parts, priority, build_prompt):
+        """
+        按目前模型的輸入上限構建 prompt，超出時由低優先級的部分開始截斷
+
+        Returns:
+            tuple: (prompt, parts, report)，見 PromptBudget.fit
+        """
+        api_type, model = self.current_model()
+        return self.prompt_budget.fit(parts, priority, build_prompt, api_type, model)
+
+    def estimate(self, prompts, workers=1):
+        """
+        不調用模型，估算一組 prompt 的 token、成本與耗時（workers 為並發數）
+
+        輸出 token 以 LLM_ESTIMATED_OUTPUT_TOKENS 估計，耗時按 LLM_LATENCY_PROFILES 的
+        首字延遲與輸出速度計算。
+        """
+        api_type, model = self.current_model()
+        input_tokens = [self.tokens.count(prompt, api_type, model) for prompt in prompts]
+        output_per_call = self.config.get('LLM_ESTIMATED_OUTPUT_TOKENS', 3000)
+        if api_type == 'gemini':
+            output_per_call = min(output_per_call, self.GEMINI_GENERATION_CONFIG['max_output_tokens'])
+        output_tokens = output_per_call * len(prompts)
+
+        cost = 0.0
+        if api_type == 'openai':
+            cost = self._openai_cost(model, sum(input_tokens), output_tokens)
+
+        profile = (self.config.get('LLM_LATENCY_PROFILES') or {}).get(api_type, {})
+        per_call = profile.get('first_token_seconds', 1.0)
+        if profile.get('output_tokens_per_second'):
+            per_call += output_per_call / profile['output_tokens_per_second']
+        rounds = math.ceil(len(prompts) / max(1, workers)) if prompts else 0
+
+        return {
+            "model": model,
+            "api_type": api_type,
+            "requests": len(prompts),
+            "input_tokens": sum(input_tokens),
+            "max_request_input_tokens": max(input_tokens, default=0),
+            "input_budget": self.prompt_budget.limit_for(api_type, model),
+            "estimated_output_tokens": output_tokens,
+            "estimated_cost": cost,
+            "estimated_seconds": round(rounds * per_call, 1),
+            "exact_token_count": self.tokens.is_exact(api_type, model)
+        }
+
+    # ==================== 供應商路由 ====================
+
+    SUPPORTED_API_TYPES = ('gemini', 'openai', 'mock')
+
+    @staticmethod
+    def _target_config(api_config, target):
+        """以路由目標覆蓋配置快照中的模型 / 憑證 / 服務位址，返回新的配置"""
+        api_type = target['api_type']
+        config = dict(api_config)
+        config['api_type'] = api_type
+        for key in ('model', 'api_key', 'base_url'):
+            if target.get(key):
+                config[f"{api_type}_{key}"] = target[key]
+        return config
+
+    @staticmethod
+    def _has_credentials(api_type, api_config):
+        if api_type == 'mock':
+            return True
+        return bool(api_config.get(f"{api_type}_api_key"))
+
+    def _route_targets(self, api_type, api_config):
+        """
+        返回本次請求的路由目標：主目標為目前配置的模型，其後為已配置憑證的備用目標
+
+        備用目標優先讀取 api_config.json 的 fallback_targets，否則使用 LLM_FALLBACK_TARGETS。
+        """
+        if api_type not in self.SUPPORTED_API_TYPES:
+            raise ValueError(f"不支持的 API 類型: {api_type}")
+        targets = [{"api_type": api_type, "model": self._model_name(api_type, api_config)}]
+        names = {self.router.target_name(targets[0])}
+
+        fallbacks = api_config.get('fallback_targets')
+        if fallbacks is None:
+            fallbacks = self.config.get('LLM_FALLBACK_TARGETS') or []
+        for fallback in fallbacks:
+            if fallback.get('api_type') not in self.SUPPORTED_API_TYPES:
+                continue
+            target = dict(fallback)
+            config = self._target_config(api_config, target)
+            target['model'] = self._model_name(target['api_type'], config)
+            name = self.router.target_name(target)
+            if name in names or not self._has_credentials(target['api_type'], config):
+                continue
+            names.add(name)
+            targets.append(target)
+        return targets
+
+    def _dispatch(self, api_type, prompt, api_config):
+        """按 API 類型調用對應的供應商，並記錄延遲、輸出速度、錯誤類型與重試次數"""
+        if api_type == 'gemini':
+            call = self.call_gemini_api
         elif api_type == 'openai':
-            return self.call_openai_api(prompt)
+            call = self.call_openai_api
         elif api_type == 'mock':
-            return self.call_mock_api(prompt)
+            call = self.call_mock_api
         else:
             raise ValueError(f"不支持的 API 類型: {api_type}")
+
+        model = self._model_name(api_type, api_config)
+        self._call_state.retries = 0
+        started = time.monotonic()
+        try:
+            content, usage_info = call(prompt, api_config)
+        except Exception as e:
+            self.telemetry.record(api_type, model, time.monotonic() - started,
+                                  error=e, retries=self._call_state.retries)
+            raise
+        self.telemetry.record(
+            api_type, model, time.monotonic() - started,
+            input_tokens=usage_info.get('input_tokens', 0),
+            output_tokens=usage_info.get('output_tokens', 0),
+            cost=usage_info.get('cost', 0.0),
+            retries=self._call_state.retries
+        )
+        return content, usage_info
+
+    def _record_stream(self, stream, target):
+        """透傳串流，把結果記錄到路由器的熔斷器與遙測（含首字延遲）"""
+        api_type, model = target['api_type'], target['model']
+        self._call_state.retries = 0
+        started = time.monotonic()
+        ttft = None
+        usage_info = {}
+        try:
+            for kind, value in stream:
+                if kind == 'chunk' and ttft is None:
+                    ttft = time.monotonic() - started
+                elif kind == 'usage':
+                    usage_info = value
+                yield kind, value
+        except GeneratorExit:
+            # 客戶端中止：不算失敗，也不計入延遲
+            self.router.record(target)
+            raise
+        except Exception as e:
+            self.router.record(target, error=e)
+            self.telemetry.record(api_type, model, time.monotonic() - started, ttft=ttft,
+                                  error=e, retries=self._call_state.retries, streamed=True)
+            raise
+        latency = time.monotonic() - started
+        self.router.record(target, latency)
+        self.telemetry.record(
+            api_type, model, latency, ttft=ttft,
+            input_tokens=usage_info.get('input_tokens', 0),
+            output_tokens=usage_info.get('output_tokens', 0),
+            cost=usage_info.get('cost', 0.0),
+            retries=self._call_state.retries, streamed=True
+        )
+
+    def _apply_routing(self, api_type, api_config, prompt, route=None):
+        """
+        自適應模型選擇：短 prompt（或 route='fast'）改用觀測到最快的合適模型
+
+        route='configured' 時固定使用配置的模型。返回本次調用使用的配置。
+        """
+        if self.model_policy is None or route == 'configured' or api_type not in self.SUPPORTED_API_TYPES:
+            return api_config
+        model = self._model_name(api_type, api_config)
+        chosen = self.model_policy.choose(
+            api_type, model, self.tokens.count(prompt, api_type, model), force=(route == 'fast')
+        )
+        if chosen == model:
+            return api_config
+        return self._target_config(api_config, {"api_type": api_type, "model": chosen})
+
+    # ==================== 響應快取 ====================
+
+    def _cache_key(self, api_type, prompt, api_config):
+        """計算指定配置下的快取鍵，未知的 API 類型返回 None（不快取）"""
+        model = self._model_name(api_type, api_config)
+        if api_type == 'gemini':
+            params = self.GEMINI_GENERATION_CONFIG
+        elif api_type == 'openai':
+            params = {
+                "temperature": 0.7,
+                "system": self.OPENAI_SYSTEM_PROMPT,
+                "base_url": api_config.get('openai_base_url') or self.OPENAI_DEFAULT_BASE_URL
+            }
+        elif api_type == 'mock':
+            params = {}
+        else:
+            return None
+        return ResponseCache.make_key(api_type, model, params, prompt)
+
+    @staticmethod
+    def _cached_usage(usage_info, flag='cached'):
+        """
+        未實際調用模型時的 usage：標記來源，token 與成本為 0
+
+        flag 為 'cached'（快取命中）或 'coalesced'（共用其他並發請求的調用結果）
+        """
+        return {
+            "model": usage_info.get('model'),
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cost": 0.0,
+            flag: True
+        }
+
+    def _lookup_cache(self, api_type, prompt, api_config, use_cache):
+        """返回 (cache_key, cached_result)；不使用快取時 cache_key 為 None"""
+        if not use_cache or self.cache is None:
+            return None, None
+        cache_key = self._cache_key(api_type, prompt, api_config)
+        if cache_key is None:
+            return None, None
+        return cache_key, self.cache.get(cache_key)
+
+    def generate_content(self, prompt, use_cache=True, route=None, accept=None):
+        """
+        生成內容的主入口
+
+        Args:
+            prompt: 提示詞
+            use_cache: 是否使用響應快取（False 時強制調用模型，但結果仍會寫入快取）
+            route: 模型選擇，None 為自動（短 prompt 使用最快的合適模型），
+                   'fast' 為總是使用最快的合適模型，'configured' 為固定使用配置的模型
+            accept: 檢查輸出的函數（可選），返回 False 的輸出不寫入快取，快取中的此類結果也不使用
+        """
+        # 取得本次請求使用的配置快照（配置文件變更時自動重新加載），
+        # 整個調用過程只使用這份快照，不修改共享的實例狀態
+        api_config = self.load_api_config()
+        api_type = api_config.get('api_type', 'gemini')
+        api_config = self._apply_routing(api_type, api_config, prompt, route)
+        estimated = {"estimated_input_tokens": self.tokens.count(prompt, api_type, self._model_name(api_type, api_config))}
+
+        cache_key, cached = self._lookup_cache(api_type, prompt, api_config, use_cache)
+        if cached and (accept is None or accept(cached[0])):
+            content, usage_info = cached
+            return content, dict(self._cached_usage(usage_info), **estimated)
+
+        fingerprint = cache_key or self._cache_key(api_type, prompt, api_config)
+
+        def invoke():
+            # 主目標熔斷或失敗時改用備用目標，過慢時對沖
+            targets = self._route_targets(api_type, api_config)
+            (content, usage_info), target, hedged = self.router.call(
+                targets,
+                lambda target: self._dispatch(target['api_type'], prompt, self._target_config(api_config, target))
+            )
+            if target is not targets[0]:
+                # 備用模型的結果不寫入主模型的快取
+                return content, dict(usage_info, fallback=True, hedged=hedged)
+
+            if self.cache is not None and (accept is None or accept(content)):
+                self.cache.set(fingerprint, content, usage_info)
+            return content, usage_info
+
+        if self.singleflight is None or fingerprint is None:
+            content, usage_info = invoke()
+            return content, dict(usage_info, **estimated)
+
+        # 相同請求正在進行時共用其結果，成本只由實際調用的請求記錄一次；
+        # 其他進程的結果經由快取取得（略過快取的請求只在進程內合併）
+        # 輪詢用 peek，不把等待期間的未命中計入快取統計
+        lookup = (lambda: self.cache.peek(fingerprint)) if use_cache and self.cache is not None else None
+        (content, usage_info), shared = self.singleflight.do(fingerprint, invoke, lookup)
+        if shared:
+            return content, dict(self._cached_usage(usage_info, 'coalesced'), **estimated)
+        return content, dict(usage_info, **estimated)
+
+    # ==================== 串流生成 ====================
+    # 串流方法為生成器，逐段產生 ('chunk', text)，結束時產生 ('usage', usage_info)，
+    # 成本在串流完成後才記錄
+
+    def stream_gemini_api(self, prompt, api_config=None):
+        """串流調用 Gemini API（僅在尚未輸出任何內容前重試）"""
+        model, model_name = self._build_gemini_model(api_config or self.api_config)
+
+        def request():
+            # 取到第一個 chunk 才算請求成功，之後的錯誤不再重試（內容已輸出給用戶）
+            response = model.generate_content(
+                prompt, stream=True, request_options={"timeout": self.clients.read_timeout}
+            )
+            chunks = iter(response)
+            return response, chunks, next(chunks, None)
+
+        try:
+            response, chunks, first = self._call_with_retry('gemini', model_name, prompt, request)
+            if first is not None and getattr(first, 'text', ''):
+                yield 'chunk', first.text
+            for chunk in chunks:
+                text = getattr(chunk, 'text', '')
+                if text:
+                    yield 'chunk', text
+        except Exception as e:
+            raise Exception(f"Gemini API 串流調用失敗: {str(e)}")
+
+        input_tokens, output_tokens = self._gemini_usage(response)
+        cost = 0.0
+        log_cost_to_file(model_name, input_tokens, output_tokens, cost)
+        yield 'usage', {
+            "model": model_name,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cost": cost
+        }
+
+    def stream_openai_api(self, prompt, api_config=None):
+        """串流調用 OpenAI API（Server-Sent Events 格式的 chat completions）"""
+        url, headers, payload, model = self._build_openai_request(
+            prompt, api_config or self.api_config, stream=True
+        )
+
+        def request():
+            response = self.clients.http_session().post(
+                url, headers=headers, json=payload, stream=True, timeout=self.clients.timeout
+            )
+            if response.status_code != 200:
+                with response:
+                    raise ProviderHTTPError(
+                        f"OpenAI API Error: {response.text}",
+                        status_code=response.status_code,
+                        retry_after=parse_retry_after(response.headers)
+                    )
+            return response
+
+        try:
+            response = self._call_with_retry('openai', model, prompt, request)
+        except Exception as e:
+            raise Exception(f"OpenAI API 調用失敗: {str(e)}")
+
+        with response:
+            usage = {}
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                event = json.loads(data)
+                if event.get('usage'):
+                    usage = event['usage']
+                for choice in event.get('choices') or []:
+                    text = (choice.get('delta') or {}).get('content')
+                    if text:
+                        yield 'chunk', text
+
+        input_tokens = usage.get('prompt_tokens', 0)
+        output_tokens = usage.get('completion_tokens', 0)
+        cost = self._openai_cost(model, input_tokens, output_tokens)
+        log_cost_to_file(model, input_tokens, output_tokens, cost)
+        yield 'usage', {
+            "model": model,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cost": cost
+        }
+
+    def stream_mock_api(self, prompt, api_config=None):
+        """串流模擬 API (不消耗額度)，逐行輸出模擬內容"""
+        content = self.MOCK_CONTENT
+        for line in content.splitlines(keepends=True):
+            time.sleep(0.05) # 模擬逐段輸出
+            yield 'chunk', line
+        yield 'usage', {
+            "model": "mock-model",
+            "input_tokens": len(prompt),
+            "output_tokens": len(content),
+            "cost": 0.0
+        }
+
+    def stream_content(self, prompt, use_cache=True, route=None):
+        """串流生成內容的主入口（route 見 generate_content）"""
+        api_config = self.load_api_config()
+        api_type = api_config.get('api_type', 'gemini')
+        api_config = self._apply_routing(api_type, api_config, prompt, route)
+        estimated_tokens = self.tokens.count(prompt, api_type, self._model_name(api_type, api_config))
+
+        cache_key, cached = self._lookup_cache(api_type, prompt, api_config, use_cache)
+        if cached:
+            return self._with_estimate(self._stream_cached(*cached), estimated_tokens)
+
+        # 串流不對沖（內容已逐段輸出），只跳過熔斷中的目標
+        targets = self._route_targets(api_type, api_config)
+        target = self.router.pick(targets)
+        if target is None:
+            names = ', '.join(self.router.target_name(t) for t in targets)
+            raise NoAvailableProviderError(f"所有 LLM 供應商暫時不可用（熔斷中）: {names}")
+        target_config = self._target_config(api_config, target)
+
+        if target['api_type'] == 'gemini':
+            stream = self.stream_gemini_api(prompt, target_config)
+        elif target['api_type'] == 'openai':
+            stream = self.stream_openai_api(prompt, target_config)
+        else:
+            stream = self.stream_mock_api(prompt, target_config)
+        stream = self._record_stream(stream, target)
+
+        if target is not targets[0]:
+            stream = self._mark_fallback(stream)
+        elif self.cache is not None:
+            stream = self._stream_into_cache(stream, cache_key or self._cache_key(api_type, prompt, api_config))
+        return self._with_estimate(stream, estimated_tokens)
+
+    @staticmethod
+    def _mark_fallback(stream):
+        for kind, value in stream:
+            if kind == 'usage':
+                value = dict(value, fallback=True)
+            yield kind, value
+
+    @staticmethod
+    def _with_estimate(stream, estimated_tokens):
+        """在串流最後的 usage 中加入調用前估算的輸入 token 數"""
+        for kind, value in stream:
+            if kind == 'usage':
+                value = dict(value, estimated_input_tokens=estimated_tokens)
+            yield kind, value
+
+    def _stream_cached(self, content, usage_info):
+        yield 'chunk', content
+        yield 'usage', self._cached_usage(usage_info)
+
+    def _stream_into_cache(self, stream, cache_key):
+        """透傳串流事件，完整結束後將結果寫入快取"""
+        chunks = []
+        for kind, value in stream:
+            if kind == 'chunk':
+                chunks.append(value)
+            elif kind == 'usage':
+                self.cache.set(cache_key, ''.join(chunks), value)
+            yield kind, value
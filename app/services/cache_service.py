@@ -0,0 +1,185 @@
+"""
+LLM Response Cache Service
+以 (provider, model, 生成參數, prompt) 的雜湊作為鍵快取 LLM 響應，
+包含有上限的記憶體 LRU 層與 SQLite 持久化磁碟層。
+"""
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from ..utils.db import ThreadLocalSQLite
+
+
+class ResponseCache:
+    """LLM 響應快取 - 記憶體 LRU + 磁碟層，支援 TTL 與容量淘汰"""
+
+    # 每寫入多少次執行一次磁碟層的過期 / 容量清理
+    PRUNE_EVERY = 50
+
+    def __init__(self, db_path=None, max_memory_entries=256, ttl_seconds=7 * 24 * 3600,
+                 max_disk_bytes=200 * 1024 * 1024):
+        """
+        Args:
+            db_path: 磁碟層 SQLite 文件路徑，為 None 時只使用記憶體層
+            max_memory_entries: 記憶體 LRU 最多保留的條目數
+            ttl_seconds: 條目有效期（秒），0 或 None 表示不過期
+            max_disk_bytes: 磁碟層內容總大小上限，超過時淘汰最久未使用的條目
+        """
+        self.max_memory_entries = max_memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._stats = {'hits': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'sets': 0}
+        self._db = ThreadLocalSQLite(db_path) if db_path else None
+        if self._db:
+            self._init_schema()
+
+    def _init_schema(self):
+        conn = self._db.connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                usage TEXT,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache (accessed_at)')
+
+    @staticmethod
+    def make_key(provider, model, params, prompt):
+        """計算內容定址的快取鍵"""
+        identity = json.dumps(
+            {'provider': provider, 'model': model, 'params': params},
+            sort_keys=True, ensure_ascii=False
+        )
+        digest = hashlib.sha256()
+        digest.update(identity.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(prompt.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _expired(self, created_at, now):
+        return bool(self.ttl_seconds) and now - created_at > self.ttl_seconds
+
+    def get(self, key, record_stats=True):
+        """
+        讀取快取
+
+        Args:
+            record_stats: False 時不計入命中統計（見 peek）
+
+        Returns:
+            tuple 或 None: 命中時返回 (content, usage_info)
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry['created_at'], now):
+                    self._memory.move_to_end(key)
+                    if record_stats:
+                        self._stats['hits'] += 1
+                        self._stats['memory_hits'] += 1
+                    return entry['content'], dict(entry['usage'])
+                del self._memory[key]
+
+        if self._db:
+            conn = self._db.connect()
+            row = conn.execute(
+                'SELECT content, usage, created_at FROM llm_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is not None:
+                if self._expired(row['created_at'], now):
+                    conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                else:
+                    conn.execute('UPDATE llm_cache SET accessed_at = ? WHERE key = ?', (now, key))
+                    usage = json.loads(row['usage']) if row['usage'] else {}
+                    with self._lock:
+                        self._remember(key, row['content'], usage, row['created_at'])
+                        if record_stats:
+                            self._stats['hits'] += 1
+                            self._stats['disk_hits'] += 1
+                    return row['content'], dict(usage)
+
+        if record_stats:
+            with self._lock:
+                self._stats['misses'] += 1
+        return None
+
+    def peek(self, key):
+        """讀取快取但不計入命中統計（例如等待其他進程結果時的輪詢）"""
+        return self.get(key, record_stats=False)
+
+    def set(self, key, content, usage_info):
+        """寫入快取（同時寫入記憶體層與磁碟層）"""
+        now = time.time()
+        usage = dict(usage_info or {})
+        with self._lock:
+            self._remember(key, content, usage, now)
+            self._stats['sets'] += 1
+            self._writes += 1
+            should_prune = self._writes % self.PRUNE_EVERY == 0
+
+        if self._db:
+            self._db.connect().execute(
+                'INSERT OR REPLACE INTO llm_cache (key, content, usage, size, created_at, accessed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, content, json.dumps(usage, ensure_ascii=False),
+                 len(content.encode('utf-8')), now, now)
+            )
+            if should_prune:
+                self.prune()
+
+    def _remember(self, key, content, usage, created_at):
+        """放入記憶體 LRU（調用方需持有鎖）"""
+        self._memory[key] = {'content': content, 'usage': usage, 'created_at': created_at}
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def prune(self):
+        """清理磁碟層：刪除過期條目，並按最久未使用淘汰至容量上限以內"""
+        if not self._db:
+            return
+        conn = self._db.connect()
+        if self.ttl_seconds:
+            conn.execute('DELETE FROM llm_cache WHERE created_at < ?', (time.time() - self.ttl_seconds,))
+        if self.max_disk_bytes:
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM llm_cache').fetchone()[0]
+            if total > self.max_disk_bytes:
+                excess = total - self.max_disk_bytes
+                victims = []
+                for row in conn.execute('SELECT key, size FROM llm_cache ORDER BY accessed_at'):
+                    victims.append((row['key'],))
+                    excess -= row['size']
+                    if excess <= 0:
+                        break
+                conn.executemany('DELETE FROM llm_cache WHERE key = ?', victims)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if self._db:
+            self._db.connect().execute('DELETE FROM llm_cache')
+
+    def stats(self):
+        """返回命中 / 未命中計數與容量信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        if self._db:
+            row = self._db.connect().execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache'
+            ).fetchone()
+            stats['disk_entries'] = row[0]
+            stats['disk_bytes'] = row[1]
+        return stats
@@ -0,0 +1,154 @@
+"""
+Request Coalescing Service
+單飛 (single-flight)：相同指紋的並發請求只觸發一次供應商調用，其餘請求等待並共用結果。
+- 進程內：以 Event 讓跟隨者等待領導者完成
+- 跨進程：以 SQLite 租約決定唯一領導者，其他進程輪詢共用快取取得結果
+  （沒有 lookup 時無法取得其他進程的結果，只在進程內合併）
+"""
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+from ..utils.db import ThreadLocalSQLite
+
+
+class _Call:
+    """進程內一次進行中的調用"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """相同鍵的並發調用合併為一次"""
+
+    def __init__(self, db_path=None, lease_seconds=300, poll_interval=0.5):
+        """
+        Args:
+            db_path: 跨進程租約使用的 SQLite 文件，為 None 時只在進程內合併
+            lease_seconds: 租約有效期，領導者崩潰後其他進程最多等待這麼久才接手
+            poll_interval: 跨進程跟隨者輪詢結果的間隔（秒）
+        """
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._db = ThreadLocalSQLite(db_path) if db_path else None
+        if self._db:
+            self._db.connect().execute("""
+                CREATE TABLE IF NOT EXISTS llm_inflight (
+                    key TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+
+    def do(self, key, fn, lookup=None):
+        """
+        執行或加入一次調用
+
+        Args:
+            key: 請求指紋
+            fn: 實際執行調用的無參數函數
+            lookup: 可選，跨進程時用於讀取其他進程結果的函數，找不到返回 None；
+                為 None 時（例如略過快取的請求）不取得跨進程租約，只在進程內合併
+
+        Returns:
+            tuple: (result, shared)，shared 為 True 表示結果來自其他請求的調用
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result, shared = self._lead(key, fn, lookup)
+            return call.result, shared
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def _lead(self, key, fn, lookup):
+        """進程內的領導者：取得跨進程租約後執行，或等待其他進程的結果"""
+        if self._db is None or lookup is None:
+            # 等到其他進程完成也拿不到它的結果，不如直接執行
+            return fn(), False
+
+        while True:
+            if self._acquire_lease(key):
+                try:
+                    return fn(), False
+                finally:
+                    self._release_lease(key)
+
+            # 其他進程正在執行相同請求
+            result = self._wait_for_other(key, lookup)
+            if result is not None:
+                return result, True
+
+    def _acquire_lease(self, key):
+        now = time.time()
+        conn = self._db.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT owner, expires_at FROM llm_inflight WHERE key = ?', (key,)).fetchone()
+            if row is not None and row['expires_at'] > now:
+                conn.execute('COMMIT')
+                return False
+            conn.execute(
+                'INSERT OR REPLACE INTO llm_inflight (key, owner, expires_at) VALUES (?, ?, ?)',
+                (key, self.owner, now + self.lease_seconds)
+            )
+            conn.execute('COMMIT')
+            return True
+        except sqlite3.OperationalError:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            # 資料庫忙碌時不阻塞請求，直接自行執行
+            return True
+
+    def _release_lease(self, key):
+        try:
+            self._db.connect().execute(
+                'DELETE FROM llm_inflight WHERE key = ? AND owner = ?', (key, self.owner)
+            )
+        except sqlite3.OperationalError as e:
+            print(f"[WARNING] 釋放請求租約失敗: {e}")
+
+    def _lease_active(self, key):
+        row = self._db.connect().execute(
+            'SELECT expires_at FROM llm_inflight WHERE key = ?', (key,)
+        ).fetchone()
+        return row is not None and row['expires_at'] > time.time()
+
+    def _wait_for_other(self, key, lookup):
+        """輪詢直到其他進程的結果可用；租約結束仍無結果時返回 None（由調用方接手）"""
+        while True:
+            result = lookup()
+            if result is not None:
+                return result
+            if not self._lease_active(key):
+                return lookup()
+            time.sleep(self.poll_interval)
+
+    def in_flight(self):
+        """目前進程內進行中的調用數量"""
+        with self._lock:
+            return len(self._calls)
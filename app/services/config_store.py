@@ -0,0 +1,105 @@
+"""
+API Config Store
+快取解析後的 API 配置，以文件 mtime / inode / 大小判斷是否需要重新讀取，
+並提供不可變的配置快照給每個請求使用。
+"""
+import os
+import json
+import time
+import threading
+from types import MappingProxyType
+
+
+class ConfigStore:
+    """API 配置存儲 - 按文件簽名快取並原子地替換不可變快照"""
+
+    # 環境變數優先級高於 JSON 文件：環境變數名稱 -> 配置鍵
+    ENV_OVERRIDES = {
+        'GEMINI_API_KEY': 'gemini_api_key',
+        'OPENAI_API_KEY': 'openai_api_key',
+        'API_TYPE': 'api_type',
+        'OPENAI_MODEL': 'openai_model',
+        'OPENAI_BASE_URL': 'openai_base_url',
+    }
+
+    def __init__(self, config_path, check_interval=1.0):
+        """
+        Args:
+            config_path: api_config.json 路徑
+            check_interval: 兩次檢查文件簽名的最短間隔（秒），間隔內直接返回目前快照
+        """
+        self.config_path = config_path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._signature = None
+        self._checked_at = 0.0
+        self._env = self._read_env()
+        self._snapshot = self._load(self._file_signature())
+
+    def _read_env(self):
+        return {key: os.environ[name] for name, key in self.ENV_OVERRIDES.items() if os.environ.get(name)}
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+    def _load(self, signature):
+        """讀取文件並合併環境變數，返回不可變快照"""
+        config = {}
+        if signature is not None:
+            try:
+                with open(self.config_path, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+            except (OSError, ValueError):
+                config = {}
+        config.update(self._env)
+        self._signature = signature
+        return MappingProxyType(config)
+
+    def snapshot(self):
+        """
+        取得目前的配置快照
+
+        Returns:
+            MappingProxyType: 只讀配置，請求期間不會被其他線程修改
+        """
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return self._snapshot
+
+        with self._lock:
+            if now - self._checked_at >= self.check_interval:
+                signature = self._file_signature()
+                if signature != self._signature:
+                    self._snapshot = self._load(signature)
+                self._checked_at = now
+            return self._snapshot
+
+    def save(self, config):
+        """寫入配置文件（先寫臨時文件再替換），並立即切換到新快照"""
+        config_dir = os.path.dirname(self.config_path)
+        if config_dir:
+            os.makedirs(config_dir, exist_ok=True)
+        tmp_path = f"{self.config_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(config, f, indent=4)
+        os.replace(tmp_path, self.config_path)
+
+        with self._lock:
+            merged = dict(config)
+            merged.update(self._env)
+            self._snapshot = MappingProxyType(merged)
+            self._signature = self._file_signature()
+            self._checked_at = time.monotonic()
+        return self._snapshot
+
+    def reload(self):
+        """立即重新讀取文件與環境變數"""
+        with self._lock:
+            self._env = self._read_env()
+            self._snapshot = self._load(self._file_signature())
+            self._checked_at = time.monotonic()
+        return self._snapshot
@@ -1,6 +1,9 @@
 import os
 from docx import Document
 from pptx import Presentation
+from .ooxml_service import extract_docx_text, extract_pptx_text, OOXML_ERRORS
+from .ole_service import extract_doc_text, extract_ppt_text, OLE_ERRORS, OLEFILE_AVAILABLE
+from ..utils.process_pool import get_process_pool
 try:
     import win32com.client as win32
     import pythoncom
@@ -15,27 +18,114 @@ try:
 except ImportError:
     PYMUPDF_AVAILABLE = False
 
+def _extract_pdf_range(file_path, start, end, max_chars=None):
+    """提取 [start, end) 頁的文字（在子進程中執行，需為模組層級函數）"""
+    pages = []
+    length = 0
+    for page_text in FileProcessor.iter_pdf_pages(file_path, start, end):
+        pages.append(page_text)
+        length += len(page_text)
+        if max_chars is not None and length >= max_chars:
+            break
+    return ''.join(pages)
+
+
+def _extract_pdf_parallel(file_path, page_count, max_chars, workers):
+    """把頁碼範圍分給多個進程提取，按頁序拼接"""
+    # 每個進程分到數個較小的範圍，避免個別頁面特別複雜時整體等待單一進程
+    chunk_size = max(1, -(-page_count // (workers * 4)))
+    ranges = [(start, min(start + chunk_size, page_count)) for start in range(0, page_count, chunk_size)]
+    pool = get_process_pool(workers)
+    futures = [pool.submit(_extract_pdf_range, file_path, start, end, max_chars) for start, end in ranges]
+
+    parts = []
+    length = 0
+    for future in futures:
+        part = future.result()
+        parts.append(part)
+        length += len(part)
+        if max_chars is not None and length >= max_chars:
+            for pending in futures:
+                pending.cancel()
+            break
+    text = ''.join(parts)
+    return text if max_chars is None else text[:max_chars]
+
+
 class FileProcessor:
     """文件處理器 - 處理各種格式的文件讀取"""
     
+    # 頁數達到此值時改用多進程並行提取（進程啟動與傳輸有固定成本，小文件順序提取更快）
+    PDF_PARALLEL_MIN_PAGES = 64
+    # 並行提取的進程數上限，None 表示使用 CPU 核心數
+    PDF_MAX_WORKERS = None
+
     @staticmethod
-    def extract_text_from_pdf(file_path):
-        """從PDF提取文本"""
+    def iter_pdf_pages(file_path, start=0, end=None):
+        """
+        逐頁產出 PDF 文字（不在記憶體中累積整份文件）
+
+        Args:
+            start / end: 頁碼範圍（從 0 開始，不含 end）
+        """
+        doc = fitz.open(file_path)
+        try:
+            end = doc.page_count if end is None else min(end, doc.page_count)
+            for page_number in range(start, end):
+                yield doc.load_page(page_number).get_text()
+        finally:
+            doc.close()
+
+    @staticmethod
+    def extract_text_from_pdf(file_path, max_pages=None, max_chars=None, workers=None):
+        """
+        從PDF提取文本
+
+        Args:
+            file_path: PDF 文件路徑
+            max_pages: 最多讀取的頁數，None 表示全部
+            max_chars: 最多返回的字數，達到後停止讀取後續頁面
+            workers: 並行進程數，None 時頁數達到 PDF_PARALLEL_MIN_PAGES 才並行，1 表示順序提取
+        """
         if not PYMUPDF_AVAILABLE:
             return "錯誤: 未安裝 PyMuPDF，無法讀取 PDF 文件。"
-            
-        text = ""
+
         try:
-            doc = fitz.open(file_path)
-            for page in doc:
-                text += page.get_text()
-            return text
+            with fitz.open(file_path) as doc:
+                page_count = doc.page_count
+            if max_pages is not None:
+                page_count = min(page_count, max_pages)
+
+            if workers is None:
+                workers = FileProcessor.PDF_MAX_WORKERS or os.cpu_count() or 1
+                if page_count < FileProcessor.PDF_PARALLEL_MIN_PAGES:
+                    workers = 1
+            workers = max(1, min(workers, page_count))
+
+            if workers > 1:
+                return _extract_pdf_parallel(file_path, page_count, max_chars, workers)
+
+            pages = []
+            length = 0
+            for page_text in FileProcessor.iter_pdf_pages(file_path, 0, page_count):
+                pages.append(page_text)
+                length += len(page_text)
+                if max_chars is not None and length >= max_chars:
+                    break
+            text = ''.join(pages)
+            return text if max_chars is None else text[:max_chars]
         except Exception as e:
             return f"讀取 PDF 失敗: {str(e)}"
 
     @staticmethod
     def extract_text_from_docx(file_path):
-        """從DOCX提取文本"""
+        """從DOCX提取文本（串流解析 XML，包含表格；無法解析時改用 python-docx）"""
+        try:
+            return extract_docx_text(file_path)
+        except OOXML_ERRORS as e:
+            print(f"[WARNING] DOCX 快速提取失敗，改用 python-docx: {e}")
+        except Exception as e:
+            return f"讀取 DOCX 失敗: {str(e)}"
         try:
             doc = Document(file_path)
             text = []
@@ -47,9 +137,24 @@ class FileProcessor:
 
     @staticmethod
     def extract_text_from_doc(file_path):
-        """從舊版DOC提取文本"""
+        """
+        從舊版DOC提取文本
+
+        以 olefile 直接解析 Word 97-2003 二進位格式；無法解析時（例如 Word 95 或加密文件）
+        在安裝了 pywin32 的 Windows 上改用 Word 自動化。
+        """
+        if OLEFILE_AVAILABLE:
+            try:
+                return extract_doc_text(file_path)
+            except OLE_ERRORS as e:
+                if not WIN32_AVAILABLE:
+                    return f"讀取 DOC 失敗: {str(e)}"
+                print(f"[WARNING] DOC 直接解析失敗，改用 Word: {e}")
+            except Exception as e:
+                return f"讀取 DOC 失敗: {str(e)}"
+
         if not WIN32_AVAILABLE:
-            return "錯誤: 未安裝 pywin32，無法讀取 DOC 文件。"
+            return "錯誤: 未安裝 olefile 或 pywin32，無法讀取 DOC 文件。"
         try:
             pythoncom.CoInitialize()
             word = win32.Dispatch("Word.Application")
@@ -63,17 +168,32 @@ class FileProcessor:
             return f"讀取 DOC 失敗: {str(e)}"
 
     @staticmethod
-    def extract_text_from_pptx(file_path, include_image_markers=False):
+    def extract_text_from_pptx(file_path, include_image_markers=False, include_slide_markers=False):
         """
         從PPTX提取文本
+
+        以 zipfile + iterparse 串流解析投影片 XML（包含表格、群組形狀與備註，大型簡報並行解析），
+        無法解析時改用 python-pptx。
         
         Args:
             file_path: PPTX 文件路徑
             include_image_markers: 是否在文本中包含圖片標記
+            include_slide_markers: 是否在每張投影片前加上 [投影片 N] 分隔標記（供分段 SOP 優化切分）
             
         Returns:
             str 或 tuple: 如果 include_image_markers=True，返回 (text, image_count)
         """
+        try:
+            text, total_images = extract_pptx_text(
+                file_path, include_image_markers=include_image_markers, include_slide_markers=include_slide_markers
+            )
+            return (text, total_images) if include_image_markers else text
+        except OOXML_ERRORS as e:
+            print(f"[WARNING] PPTX 快速提取失敗，改用 python-pptx: {e}")
+        except Exception as e:
+            error = f"讀取 PPTX 失敗: {str(e)}"
+            return (error, 0) if include_image_markers else error
+
         try:
             prs = Presentation(file_path)
             text = []
@@ -96,6 +216,8 @@ class FileProcessor:
                         slide_text.append(shape.text)
                 
                 if slide_text:
+                    if include_slide_markers:
+                        slide_text.insert(0, f"[投影片 {slide_idx}]")
                     text.append('\n'.join(slide_text))
             
             result_text = '\n\n'.join(text)
@@ -112,10 +234,29 @@ class FileProcessor:
                 return f"讀取 PPTX 失敗: {str(e)}"
 
     @staticmethod
-    def extract_text_from_ppt(file_path):
-        """從舊版PPT提取文本"""
+    def extract_text_from_ppt(file_path, include_slide_markers=False):
+        """
+        從舊版PPT提取文本
+
+        以 olefile 直接解析 PowerPoint 97-2003 二進位格式；無法解析時
+        在安裝了 pywin32 的 Windows 上改用 PowerPoint 自動化。
+
+        Args:
+            file_path: PPT 文件路徑
+            include_slide_markers: 是否在每張投影片前加上 [投影片 N] 分隔標記（僅直接解析時支援）
+        """
+        if OLEFILE_AVAILABLE:
+            try:
+                return extract_ppt_text(file_path, include_slide_markers=include_slide_markers)
+            except OLE_ERRORS as e:
+                if not WIN32_AVAILABLE:
+                    return f"讀取 PPT 失敗: {str(e)}"
+                print(f"[WARNING] PPT 直接解析失敗，改用 PowerPoint: {e}")
+            except Exception as e:
+                return f"讀取 PPT 失敗: {str(e)}"
+
         if not WIN32_AVAILABLE:
-            return "錯誤: 未安裝 pywin32，無法讀取 PPT 文件。"
+            return "錯誤: 未安裝 olefile 或 pywin32，無法讀取 PPT 文件。"
         try:
             pythoncom.CoInitialize()
             ppt = win32.Dispatch("PowerPoint.Application")
@@ -1,18 +1,26 @@
 import os
-import re
 from docx import Document
 from pptx import Presentation
 from pptx.util import Inches, Pt
 from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Preformatted, Table, TableStyle
+from reportlab.lib import colors
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.lib.fonts import addMapping
+from xml.sax.saxutils import escape
+from .image_store import ImageManifest
+from .image_optimizer import get_image_optimizer
+from .markdown_ast import parse_markdown, flatten, plain_text
 
 class FormatConverter:
     """格式轉換器 - 將 Markdown 轉換為各種輸出格式"""
 
+    # markdown_to_pptx 中圖片的顯示寬度（高度按比例）
+    PPTX_IMAGE_WIDTH = Inches(3.5)
+
     @staticmethod
     def markdown_to_docx(content, doc_config):
         """將Markdown轉換為DOCX"""
@@ -21,28 +29,55 @@ class FormatConverter:
         # 添加標題
         doc.add_heading(doc_config.get('title', '生成的文檔'), 0)
         
-        # 處理內容
-        lines = content.split('\n')
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            if line.startswith('# '):
-                doc.add_heading(line[2:], 1)
-            elif line.startswith('## '):
-                doc.add_heading(line[3:], 2)
-            elif line.startswith('### '):
-                doc.add_heading(line[4:], 3)
-            elif line.startswith('- ') or line.startswith('* '):
-                doc.add_paragraph(line[2:], style='List Bullet')
-            elif re.match(r'^\d+\. ', line):
-                doc.add_paragraph(line.split('. ', 1)[1], style='List Number')
-            else:
-                doc.add_paragraph(line)
+        # 走訪共用的 Markdown AST
+        for block, depth, marker in flatten(parse_markdown(content)):
+            kind = block['type']
+            if kind == 'heading':
+                FormatConverter._add_docx_runs(doc.add_heading('', min(block['level'], 9)), block['runs'])
+            elif kind == 'table':
+                FormatConverter._add_docx_table(doc, block)
+            elif kind == 'code':
+                run = doc.add_paragraph().add_run(block['text'])
+                run.font.name = 'Consolas'
+            elif kind in ('paragraph', 'image'):
+                style = None
+                if marker:
+                    # 內建樣式只有三層：List Bullet / List Bullet 2 / List Bullet 3
+                    style = 'List Bullet' if marker == '-' else 'List Number'
+                    if depth > 1:
+                        style += f" {min(depth, 3)}"
+                FormatConverter._add_docx_runs(doc.add_paragraph(style=style), block['runs'])
                 
         return doc
 
+    @staticmethod
+    def _add_docx_runs(paragraph, runs):
+        """行內 Run → DOCX 段落中的 run（粗體 / 斜體 / 等寬）"""
+        for run in runs:
+            docx_run = paragraph.add_run(run.text)
+            if run.bold:
+                docx_run.bold = True
+            if run.italic:
+                docx_run.italic = True
+            if run.code:
+                docx_run.font.name = 'Consolas'
+
+    @staticmethod
+    def _add_docx_table(doc, block):
+        """Markdown 表格 → DOCX 表格（表頭粗體）"""
+        rows = ([block['header']] if block['header'] else []) + list(block['rows'])
+        columns = max((len(row) for row in rows), default=0)
+        if not columns:
+            return
+        table = doc.add_table(rows=len(rows), cols=columns)
+        table.style = 'Table Grid'
+        for row_index, row in enumerate(rows):
+            for column, cell_runs in enumerate(row):
+                paragraph = table.cell(row_index, column).paragraphs[0]
+                if row_index == 0 and block['header']:
+                    cell_runs = [run._replace(bold=True) for run in cell_runs]
+                FormatConverter._add_docx_runs(paragraph, cell_runs)
+
     @staticmethod
     def markdown_to_pptx(content, doc_config, image_folder=None):
         """
@@ -72,33 +107,39 @@ class FormatConverter:
         body_shape = None
         tf = None
         
-        # 圖片標記的正則表達式：支持多種格式
-        # 格式1: [圖片 1-1: 來自投影片 1]
-        # 格式2: - 圖片 1-1: 來自投影片 1
-        image_pattern = re.compile(r'[-\[]?\s*圖片\s+(\d+)-(\d+)(?::\s*來自投影片\s*\d+)?[\]]?')
+        # 圖片存入存放區或延遲模式時，文件夾中只有清單 (manifest.json)
+        manifest = ImageManifest.load(image_folder) if image_folder else None
+        blocks = list(flatten(parse_markdown(content)))
         
-        lines = content.split('\n')
-        for line in lines:
-            line_stripped = line.strip()
-            if not line_stripped:
-                continue
+        # 先找出所有引用的圖片，按顯示寬度並行縮小 / 重新壓縮，再逐個區塊插入
+        image_sources = {}
+        if image_folder:
+            found = {}
+            for block, _, _ in blocks:
+                key = (block.get('slide'), block.get('index'))
+                if block['type'] == 'image' and key not in found:
+                    source = FormatConverter._find_image_source(manifest, image_folder, *key)
+                    if source is not None:
+                        found[key] = source
+            optimized = get_image_optimizer().optimize_many(
+                [(source, FormatConverter.PPTX_IMAGE_WIDTH, None) for source in found.values()]
+            )
+            image_sources = dict(zip(found, optimized))
+        
+        for block, depth, marker in blocks:
+            kind = block['type']
             
-            # 檢查是否為圖片標記
-            image_match = image_pattern.search(line_stripped)
-            if image_match and image_folder:
-                slide_num = image_match.group(1)
-                img_num = image_match.group(2)
+            # 圖片標記（沒有圖片文件夾時按普通文字處理）
+            if kind == 'image' and image_folder:
+                slide_num = block['slide']
+                img_num = block['index']
                 
                 # 構建圖片文件名
                 image_filename = f"slide_{slide_num}_image_{img_num}"
                 
-                # 查找匹配的圖片文件（可能有不同擴展名）
-                image_path = None
-                for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']:
-                    potential_path = os.path.join(image_folder, image_filename + ext)
-                    if os.path.exists(potential_path):
-                        image_path = potential_path
-                        break
+                image_path = image_sources.get((slide_num, img_num))
+                if hasattr(image_path, 'seek'):
+                    image_path.seek(0)  # 同一張圖片可能被引用多次
                 
                 # 如果找到圖片，插入到投影片中
                 if image_path:
@@ -114,45 +155,102 @@ class FormatConverter:
                     # 在當前投影片中插入圖片（放在右側或下方）
                     left = Inches(5.5)  # 靠右放置
                     top = Inches(1.5)
-                    width = Inches(3.5)  # 設定寬度，高度自動調整
+                    width = FormatConverter.PPTX_IMAGE_WIDTH  # 設定寬度，高度按比例
+                    # 清單中有像素尺寸時直接計算高度
+                    dimensions = manifest.dimensions(slide_num, img_num) if manifest else None
+                    height = round(width * dimensions[1] / dimensions[0]) if dimensions else None
                     
                     try:
-                        current_slide.shapes.add_picture(image_path, left, top, width=width)
-                        print(f"成功插入圖片: {image_path}")
+                        current_slide.shapes.add_picture(image_path, left, top, width=width, height=height)
+                        print(f"成功插入圖片: {image_filename}")
                     except Exception as e:
-                        print(f"插入圖片失敗: {image_path}, 錯誤: {str(e)}")
+                        print(f"插入圖片失敗: {image_filename}, 錯誤: {str(e)}")
                 else:
                     print(f"未找到圖片文件: {image_filename} (在 {image_folder})")
                 
                 continue
                 
             # 新的一頁（一級或二級標題）
-            if line_stripped.startswith('# ') or line_stripped.startswith('## '):
+            if kind == 'heading' and block['level'] <= 2:
                 current_slide = prs.slides.add_slide(bullet_slide_layout)
                 shapes = current_slide.shapes
                 title_shape = shapes.title
                 body_shape = shapes.placeholders[1]
                 
-                title_text = line.lstrip('#').strip()
-                title_shape.text = title_text
+                title_shape.text = plain_text(block['runs'])
                 tf = body_shape.text_frame
                 
-            # 內容點
-            elif current_slide and (line.startswith('- ') or line.startswith('* ')):
-                if tf:
-                    p = tf.add_paragraph()
-                    p.text = line[2:]
-                    p.level = 0
-            
-            # 普通文本作為內容
-            elif current_slide and not line.startswith('#'):
-                if tf:
+            # 第一個標題之前的內容沒有投影片可放
+            elif not tf or kind == 'rule':
+                continue
+                
+            # 表格逐列作為內容點（儲存格以 | 分隔，表頭粗體）
+            elif kind == 'table':
+                if block['header']:
+                    FormatConverter._add_pptx_row(tf, block['header'], bold=True)
+                for row in block['rows']:
+                    FormatConverter._add_pptx_row(tf, row)
+                
+            elif kind == 'code':
+                for code_line in block['text'].split('\n'):
                     p = tf.add_paragraph()
-                    p.text = line
+                    run = p.add_run()
+                    run.text = code_line
+                    run.font.name = 'Consolas'
                     p.level = 0
+                
+            # 內容點、普通文本與三級以下標題（粗體）
+            else:
+                p = tf.add_paragraph()
+                if marker and marker != '-':
+                    p.add_run().text = f"{marker} "
+                FormatConverter._add_pptx_runs(p, block['runs'], bold=kind == 'heading')
+                p.level = min(max(depth - 1, 0), 4)
                     
+        if manifest:
+            manifest.close()
         return prs
 
+    @staticmethod
+    def _add_pptx_runs(paragraph, runs, bold=False):
+        """行內 Run → PPTX 段落中的 run"""
+        for run in runs:
+            pptx_run = paragraph.add_run()
+            pptx_run.text = run.text
+            if run.bold or bold:
+                pptx_run.font.bold = True
+            if run.italic:
+                pptx_run.font.italic = True
+            if run.code:
+                pptx_run.font.name = 'Consolas'
+
+    @staticmethod
+    def _add_pptx_row(tf, cells, bold=False):
+        """表格的一列 → 以 | 分隔儲存格的內容點"""
+        p = tf.add_paragraph()
+        for column, cell_runs in enumerate(cells):
+            if column:
+                p.add_run().text = ' | '
+            FormatConverter._add_pptx_runs(p, cell_runs, bold=bold)
+        p.level = 0
+
+    @staticmethod
+    def _find_image_source(manifest, image_folder, slide_num, img_num):
+        """
+        查找 [圖片 slide_num-img_num] 對應的圖片
+
+        有清單時只查字典：圖片可能是存放區的文件，或延遲模式下從原始 PPTX 讀出的內容；
+        沒有清單的舊文件夾按文件名查找（可能有不同擴展名）。
+        """
+        if manifest:
+            return manifest.image_source(slide_num, img_num)
+        image_filename = f"slide_{slide_num}_image_{img_num}"
+        for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']:
+            potential_path = os.path.join(image_folder, image_filename + ext)
+            if os.path.exists(potential_path):
+                return potential_path
+        return None
+
     @staticmethod
     def markdown_to_pdf(content, doc_config, output_path):
         """將Markdown轉換為PDF"""
@@ -168,6 +266,11 @@ class FormatConverter:
                 font_name = 'ArialUnicode'
             except:
                 font_name = 'Helvetica' #  fallback
+        if font_name != 'Helvetica':
+            # 中文字體沒有粗體 / 斜體字型，<b> <i> 標記仍使用同一字體
+            for bold in (0, 1):
+                for italic in (0, 1):
+                    addMapping(font_name, bold, italic, font_name)
         
         doc = SimpleDocTemplate(output_path, pagesize=letter)
         styles = getSampleStyleSheet()
@@ -190,6 +293,15 @@ class FormatConverter:
             spaceAfter=10
         )
         
+        subheading_style = ParagraphStyle(
+            'CustomSubheading',
+            parent=styles['Heading2'],
+            fontName=font_name,
+            fontSize=14,
+            spaceBefore=12,
+            spaceAfter=6
+        )
+        
         normal_style = ParagraphStyle(
             'CustomNormal',
             parent=styles['Normal'],
@@ -199,28 +311,83 @@ class FormatConverter:
             leading=18
         )
         
+        code_style = ParagraphStyle(
+            'CustomCode',
+            parent=styles['Code'],
+            fontSize=10,
+            leading=13,
+            spaceBefore=6,
+            spaceAfter=6
+        )
+        
         story = []
         
         # 添加標題
         story.append(Paragraph(doc_config.get('title', '生成的文檔'), title_style))
         story.append(Spacer(1, 12))
         
-        # 處理內容
-        lines = content.split('\n')
-        for line in lines:
-            line = line.strip()
-            if not line:
+        # 走訪共用的 Markdown AST
+        list_styles = {}
+        for block, depth, marker in flatten(parse_markdown(content)):
+            kind = block['type']
+            if kind == 'heading':
+                style = heading_style if block['level'] <= 2 else subheading_style
+                story.append(Paragraph(FormatConverter._pdf_markup(block['runs']), style))
+            elif kind == 'table':
+                story.append(FormatConverter._pdf_table(block, normal_style))
                 story.append(Spacer(1, 6))
-                continue
-                
-            if line.startswith('# ') or line.startswith('## '):
-                text = line.lstrip('#').strip()
-                story.append(Paragraph(text, heading_style))
-            elif line.startswith('- ') or line.startswith('* '):
-                text = "• " + line[2:]
-                story.append(Paragraph(text, normal_style))
+            elif kind == 'code':
+                story.append(Preformatted(block['text'], code_style))
+            elif kind == 'rule':
+                story.append(Spacer(1, 12))
+            elif depth:
+                # 列表項目按巢狀深度縮排
+                if depth not in list_styles:
+                    list_styles[depth] = ParagraphStyle(f"CustomList{depth}", parent=normal_style,
+                                                        leftIndent=18 * depth)
+                bullet = {None: '', '-': '• '}.get(marker, f"{marker} ")
+                story.append(Paragraph(escape(bullet) + FormatConverter._pdf_markup(block['runs']),
+                                       list_styles[depth]))
             else:
-                story.append(Paragraph(line, normal_style))
+                story.append(Paragraph(FormatConverter._pdf_markup(block['runs']), normal_style))
                 
         doc.build(story)
         return output_path
+
+    @staticmethod
+    def _pdf_markup(runs):
+        """行內 Run → reportlab 段落標記（文字已轉義）"""
+        parts = []
+        for run in runs:
+            text = escape(run.text)
+            if run.code:
+                text = f'<font face="Courier">{text}</font>'
+            if run.italic:
+                text = f"<i>{text}</i>"
+            if run.bold:
+                text = f"<b>{text}</b>"
+            if run.href:
+                text = f'<a href="{escape(run.href, {chr(34): "&quot;"})}" color="blue">{text}</a>'
+            parts.append(text)
+        return ''.join(parts)
+
+    @staticmethod
+    def _pdf_table(block, cell_style):
+        """Markdown 表格 → reportlab Table（表頭粗體、格線）"""
+        rows = ([block['header']] if block['header'] else []) + list(block['rows'])
+        columns = max((len(row) for row in rows), default=0)
+        data = []
+        for row_index, row in enumerate(rows):
+            cells = []
+            for column in range(columns):
+                cell_runs = row[column] if column < len(row) else ()
+                if row_index == 0 and block['header']:
+                    cell_runs = [run._replace(bold=True) for run in cell_runs]
+                cells.append(Paragraph(FormatConverter._pdf_markup(cell_runs), cell_style))
+            data.append(cells)
+        table = Table(data, repeatRows=1 if block['header'] else 0)
+        table.setStyle(TableStyle([
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ]))
+        return table
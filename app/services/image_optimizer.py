@@ -0,0 +1,195 @@
+"""
+Image Optimizer
+插入 PPTX 前按實際顯示尺寸縮小並重新壓縮圖片（取代 optimize_icon.py / optimize_aggressive.py 的一次性腳本）：
+- 依顯示寬高與目標 DPI 計算所需像素，較大的圖片以 LANCZOS 縮小
+- 依內容選擇格式：有透明度或顏色較少的截圖 / 圖表用 PNG，照片類用 JPEG
+- 結果按 (內容雜湊, 目標像素) 快取在磁碟上，同一張圖片重複生成時不再處理
+- 多張圖片由線程池並行處理（Pillow 的縮放與編碼會釋放 GIL）
+"""
+import io
+import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from .image_store import write_atomic
+
+
+EMU_PER_INCH = 914400
+
+# 不需縮小且小於此大小的圖片直接使用原圖
+MIN_RECOMPRESS_BYTES = 100 * 1024
+# 不同顏色數不超過像素數的 1/32（至少 256 色）時視為截圖 / 圖表，使用 PNG
+FLAT_COLOR_RATIO = 32
+
+
+def _read_source(source):
+    """圖片路徑或文件物件 → bytes"""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return f.read()
+    source.seek(0)
+    data = source.read()
+    source.seek(0)
+    return data
+
+
+class ImageOptimizer:
+    """按顯示尺寸縮小 / 重新壓縮圖片（可跨線程共用）"""
+
+    def __init__(self, cache_folder, dpi=150, jpeg_quality=85, max_workers=4, enabled=True):
+        """
+        Args:
+            cache_folder: 處理結果的快取目錄
+            dpi: 目標顯示解析度（每英寸像素數）
+            jpeg_quality: JPEG 品質
+            max_workers: 並行處理的線程數
+            enabled: False 時直接返回原圖
+        """
+        self.cache_folder = cache_folder
+        self.dpi = dpi
+        self.jpeg_quality = jpeg_quality
+        self.max_workers = max_workers
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._originals = set()  # 不需處理、直接使用原圖的快取鍵
+        self._stats = {'optimized': 0, 'cache_hits': 0, 'originals': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+    def target_pixels(self, width_emu, height_emu=None):
+        """顯示尺寸 (EMU) → 最大像素寬高（高度不限時為 None）"""
+        width = max(1, round(width_emu / EMU_PER_INCH * self.dpi))
+        height = max(1, round(height_emu / EMU_PER_INCH * self.dpi)) if height_emu else None
+        return width, height
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _cache_path(self, key, ext):
+        return os.path.join(self.cache_folder, key[:2], f"{key}{ext}")
+
+    def optimize(self, source, width_emu, height_emu=None):
+        """
+        返回適合插入的圖片
+
+        Args:
+            source: 圖片路徑或文件物件（例如從 PPTX 讀出的 BytesIO）
+            width_emu / height_emu: 圖片在投影片上的最大顯示寬高（EMU）
+
+        Returns:
+            str 或原 source: 處理後的快取文件路徑；無法處理或不需處理時返回原 source
+        """
+        if not self.enabled:
+            return source
+        data = _read_source(source)
+        max_width, max_height = self.target_pixels(width_emu, height_emu)
+        key = f"{hashlib.sha256(data).hexdigest()}_{max_width}x{max_height or 0}"
+
+        if key in self._originals:
+            self._count('originals')
+            return source
+        for ext in ('.png', '.jpg'):
+            path = self._cache_path(key, ext)
+            if os.path.exists(path):
+                self._count('cache_hits')
+                return path
+
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                result = self._recompress(img, max_width, max_height, len(data))
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            # 例如 EMF / WMF 等 Pillow 無法處理的格式
+            print(f"[WARNING] 圖片無法優化，使用原圖: {e}")
+            result = None
+
+        if result is None:
+            with self._lock:
+                self._originals.add(key)
+            self._count('originals')
+            return source
+
+        ext, blob = result
+        path = self._cache_path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, blob)
+        self._count('optimized')
+        self._count('bytes_in', len(data))
+        self._count('bytes_out', len(blob))
+        return path
+
+    def optimize_many(self, requests):
+        """
+        並行處理多張圖片
+
+        Args:
+            requests: [(source, width_emu, height_emu), ...]
+
+        Returns:
+            list: 與 requests 順序相同的處理結果
+        """
+        if not self.enabled or len(requests) <= 1 or self.max_workers <= 1:
+            return [self.optimize(*request) for request in requests]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(requests))) as pool:
+            return list(pool.map(lambda request: self.optimize(*request), requests))
+
+    def _recompress(self, img, max_width, max_height, original_size):
+        """縮小並重新編碼，結果不比原圖小時返回 None"""
+        width, height = img.size
+        scale = min(max_width / width, max_height / height if max_height else 1.0, 1.0)
+        resized = scale < 1.0
+        if not resized and original_size <= MIN_RECOMPRESS_BYTES:
+            return None
+
+        # JPEG 可直接以縮小的比例解碼
+        if resized and img.format == 'JPEG':
+            img.draft('RGB', (round(width * scale), round(height * scale)))
+        has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+        if has_alpha and img.getchannel('A').getextrema()[0] == 255:
+            # 有透明通道但完全不透明
+            img = img.convert('RGB')
+            has_alpha = False
+        if resized:
+            # reducing_gap：先以整數倍縮小再做 LANCZOS，大圖縮小快數倍且品質差異不可見
+            img = img.resize((max(1, round(width * scale)), max(1, round(height * scale))),
+                             Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+        output = io.BytesIO()
+        flat = img.getcolors(max(256, img.width * img.height // FLAT_COLOR_RATIO)) is not None
+        if has_alpha or flat:
+            # optimize=True 只小 1~2%，編碼卻慢約 3 倍
+            img.save(output, format='PNG')
+            ext = '.png'
+        else:
+            img.save(output, format='JPEG', quality=self.jpeg_quality, optimize=True)
+            ext = '.jpg'
+
+        blob = output.getvalue()
+        if not resized and len(blob) >= original_size:
+            return None
+        return ext, blob
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+_optimizer = None
+_optimizer_lock = threading.Lock()
+
+
+def configure_image_optimizer(cache_folder, **options):
+    """設定進程共用的圖片優化器（應用啟動時調用）"""
+    global _optimizer
+    with _optimizer_lock:
+        _optimizer = ImageOptimizer(cache_folder, **options)
+        return _optimizer
+
+
+def get_image_optimizer():
+    """取得進程共用的圖片優化器，尚未設定時使用預設目錄"""
+    if _optimizer is None:
+        configure_image_optimizer(os.path.join('output', 'image_cache'))
+    return _optimizer
@@ -3,69 +3,39 @@ import uuid
 from pptx import Presentation
 from PIL import Image
 import io
+from .ooxml_service import ingest_pptx
+from .image_store import ImageManifest
 
 class ImageExtractor:
     """圖片提取器 - 從 PPTX 文件中提取圖片"""
     
     @staticmethod
-    def extract_images_from_pptx(pptx_path, output_folder):
+    def extract_images_from_pptx(pptx_path, output_folder, store=None, lazy=False):
         """
         從 PPTX 提取所有圖片
         
         Args:
             pptx_path: PPTX 文件路徑
             output_folder: 圖片輸出文件夾
+            store: ImageStore（可選）；傳入時圖片存入存放區，output_folder 只寫入圖片清單
+            lazy: 是否只在清單中記錄圖片在 pptx_path 中的位置（不寫出圖片，pptx_path 須保留）
             
         Returns:
             list: 圖片信息列表 [{'slide': 1, 'index': 1, 'path': 'xxx.png', 'marker': '[圖片 1-1]'}]
         """
         try:
-            prs = Presentation(pptx_path)
-            images = []
-            
             # 確保輸出文件夾存在
             os.makedirs(output_folder, exist_ok=True)
-            
-            # 遍歷每個投影片
-            for slide_idx, slide in enumerate(prs.slides, start=1):
-                image_count = 0
-                
-                # 遍歷投影片中的所有形狀
-                for shape in slide.shapes:
-                    # 檢查是否為圖片
-                    if hasattr(shape, "image"):
-                        image_count += 1
-                        
-                        # 獲取圖片數據
-                        image = shape.image
-                        image_bytes = image.blob
-                        
-                        # 確定圖片格式
-                        ext = image.ext
-                        if not ext.startswith('.'):
-                            ext = '.' + ext
-                        
-                        # 生成圖片文件名
-                        filename = f"slide_{slide_idx}_image_{image_count}{ext}"
-                        filepath = os.path.join(output_folder, filename)
-                        
-                        # 保存圖片
-                        with open(filepath, 'wb') as f:
-                            f.write(image_bytes)
-                        
-                        # 記錄圖片信息
-                        marker = f"[圖片 {slide_idx}-{image_count}]"
-                        images.append({
-                            'slide': slide_idx,
-                            'index': image_count,
-                            'path': filepath,
-                            'filename': filename,
-                            'marker': marker,
-                            'ext': ext
-                        })
-            
+            # 與文字提取共用同一次遍歷的編號規則
+            images = ingest_pptx(pptx_path, output_folder, include_notes=False, store=store, lazy=lazy)['images']
+            if lazy and images:
+                ImageManifest.for_package(output_folder, pptx_path, images)
+            elif store is not None and images:
+                store.write_manifest(output_folder, images)
+            elif images:
+                # 圖片文件與清單放在同一目錄，插入時以清單查找，不逐一探測副檔名
+                ImageManifest.from_images(images).save(output_folder)
             return images
-            
         except Exception as e:
             raise Exception(f"提取圖片失敗: {str(e)}")
     
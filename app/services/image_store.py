@@ -0,0 +1,334 @@
+"""
+Content-Addressed Image Store
+以內容雜湊 (SHA-256) 存放從簡報提取出的圖片，相同內容只寫入一次：
+- 物件存放於 <root>/<雜湊前兩碼>/<雜湊>.<副檔名>，同一張 logo 出現在 80 張投影片也只有一個文件
+- 每次上傳一份清單 (manifest.json)：slide_X_image_Y → 圖片物件、大小與像素尺寸，
+  FormatConverter 載入一次後以字典查找圖片，版面配置不需再開啟圖片文件
+- 延遲模式：清單只記錄原始 PPTX 中的媒體部件名稱，需要時直接從 zip 讀取，不寫出任何圖片文件
+- 以 NumPy 對縮小後的灰階陣列批次計算感知雜湊 (aHash / dHash)，標記內容幾乎相同的截圖
+"""
+import io
+import os
+import json
+import hashlib
+import zipfile
+import tempfile
+
+from PIL import Image
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+# 清單中每張圖片記錄的欄位：位置（path 為圖片文件，延遲模式下只有 part）、大小與像素尺寸
+MANIFEST_FIELDS = ('slide', 'index', 'marker', 'ext', 'path', 'part', 'sha256', 'bytes', 'width', 'height')
+
+# 感知雜湊的邊長（8 × 8 = 64 位元）
+HASH_SIZE = 8
+# aHash 與 dHash 的漢明距離都不超過此值時視為近似重複
+NEAR_DUPLICATE_THRESHOLD = 5
+
+
+def image_key(slide, index):
+    """圖片在清單中的鍵（與舊版圖片文件名相同，不含副檔名）"""
+    return f"slide_{slide}_image_{index}"
+
+
+def write_atomic(path, data):
+    """寫入同目錄的暫存文件後改名，並行寫入同一物件時不會讀到寫了一半的內容"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class ImageStore:
+    """以內容雜湊定址的圖片存放區（可跨線程、跨進程共用）"""
+
+    def __init__(self, root, near_duplicate_threshold=NEAR_DUPLICATE_THRESHOLD):
+        """
+        Args:
+            root: 圖片物件的存放目錄
+            near_duplicate_threshold: 感知雜湊的漢明距離門檻，None 表示不檢查近似重複
+        """
+        self.root = root
+        self.near_duplicate_threshold = near_duplicate_threshold
+
+    def object_path(self, sha256, ext):
+        return os.path.join(self.root, sha256[:2], f"{sha256}{ext}")
+
+    def put(self, blob, ext):
+        """
+        存入圖片內容
+
+        Returns:
+            tuple: (sha256, 物件路徑, 是否新寫入)
+        """
+        sha256 = hashlib.sha256(blob).hexdigest()
+        path = self.object_path(sha256, ext)
+        if os.path.exists(path):
+            return sha256, path, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, blob)
+        return sha256, path, True
+
+    def write_manifest(self, folder, images):
+        """
+        寫出一次上傳的圖片清單，並標記近似重複的圖片
+
+        Args:
+            folder: 清單所在目錄（每次上傳一個）
+            images: ingest_pptx(store=...) 返回的圖片列表（含 sha256 與物件路徑）
+
+        Returns:
+            ImageManifest
+        """
+        manifest = ImageManifest.from_images(images)
+        if self.near_duplicate_threshold is not None and NUMPY_AVAILABLE:
+            manifest.mark_near_duplicates(self.near_duplicate_threshold)
+        manifest.save(folder)
+        return manifest
+
+
+class ImageManifest:
+    """
+    一次上傳的圖片清單：{slide_X_image_Y: 圖片資訊}
+
+    圖片資訊中有 path 時指向圖片文件（存放區物件）；延遲模式下只有 part，
+    內容從 package 指向的 PPTX（相對於清單目錄或絕對路徑）中讀取。
+    """
+
+    def __init__(self, images=None, folder=None, package=None):
+        self.images = images or {}
+        self.folder = folder
+        self.package = package
+        self._zip = None
+
+    @classmethod
+    def for_package(cls, folder, package, images):
+        """
+        建立延遲模式的清單並寫入 folder
+
+        Args:
+            folder: 清單所在目錄
+            package: PPTX 路徑（在 folder 內時記錄相對路徑）
+            images: ingest_pptx(lazy=True) 返回的圖片列表
+        """
+        package = os.path.abspath(package)
+        if os.path.dirname(package) == os.path.abspath(folder):
+            package = os.path.basename(package)
+        manifest = cls.from_images(images, package=package)
+        manifest.save(folder)
+        return manifest
+
+    @classmethod
+    def from_images(cls, images, package=None):
+        """由 ingest_pptx 返回的圖片列表建立清單（尚未寫入）"""
+        return cls({
+            image_key(image['slide'], image['index']): {
+                field: image.get(field) for field in MANIFEST_FIELDS if image.get(field) is not None
+            }
+            for image in images
+        }, package=package)
+
+    @classmethod
+    def load(cls, folder):
+        """讀取目錄中的清單，沒有清單時返回 None"""
+        try:
+            with open(os.path.join(folder, MANIFEST_NAME), encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        return cls(data.get('images', {}), folder, data.get('package'))
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        data = {'version': MANIFEST_VERSION, 'images': self.images}
+        if self.package:
+            data['package'] = self.package
+        write_atomic(os.path.join(folder, MANIFEST_NAME),
+                      json.dumps(data, ensure_ascii=False, indent=1).encode('utf-8'))
+
+    def package_path(self):
+        return os.path.join(self.folder, self.package) if self.package else None
+
+    def _package(self):
+        # 同一份清單多次讀取圖片時共用一個 zip 檔案代碼
+        if self._zip is None:
+            self._zip = zipfile.ZipFile(self.package_path())
+        return self._zip
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def entry(self, slide, index):
+        """[圖片 slide-index] 的清單記錄，沒有時返回 None"""
+        return self.images.get(image_key(slide, index))
+
+    def dimensions(self, slide, index):
+        """圖片的像素寬高，未知時返回 None"""
+        entry = self.images.get(image_key(slide, index))
+        if entry and entry.get('width') and entry.get('height'):
+            return entry['width'], entry['height']
+        return None
+
+    def resolve(self, slide, index):
+        """[圖片 slide-index] 對應的圖片文件路徑；沒有此圖片或圖片在 PPTX 內時返回 None"""
+        entry = self.images.get(image_key(slide, index))
+        return entry.get('path') if entry else None
+
+    def image_source(self, slide, index):
+        """
+        [圖片 slide-index] 的內容來源，可直接傳給 python-pptx 的 add_picture
+
+        Returns:
+            str 或 BytesIO: 圖片文件路徑，或從 PPTX 讀出的內容；沒有此圖片時返回 None
+        """
+        entry = self.images.get(image_key(slide, index))
+        if entry is None:
+            return None
+        if entry.get('path'):
+            return entry['path']
+        try:
+            return io.BytesIO(self._package().read(entry['part']))
+        except (OSError, KeyError, zipfile.BadZipFile) as e:
+            print(f"[WARNING] 無法從 {self.package_path()} 讀取圖片 {entry['part']}: {e}")
+            return None
+
+    def open(self, key):
+        """
+        以串流方式開啟圖片（不整個讀入記憶體）
+
+        Returns:
+            file: 二進位文件物件；延遲模式下為 zip 成員的解壓串流。沒有此圖片時拋出 KeyError
+        """
+        entry = self.images[key]
+        if entry.get('path'):
+            return open(entry['path'], 'rb')
+        # 已開啟的成員串流持有 zip 文件的引用，關閉清單不影響串流讀取
+        return self._package().open(entry['part'])
+
+    def unique_count(self):
+        return len({entry.get('sha256') or entry['part'] for entry in self.images.values()})
+
+    def near_duplicate_count(self):
+        return sum(1 for entry in self.images.values() if entry.get('near_duplicate_of'))
+
+    def mark_near_duplicates(self, threshold=NEAR_DUPLICATE_THRESHOLD):
+        """
+        計算每個不同圖片的感知雜湊，內容不同但幾乎相同的圖片記錄 near_duplicate_of（最早出現的那張）
+
+        只對不同的物件解碼一次，完全相同的圖片共用結果。
+        """
+        first_key = {}
+        for key, entry in self.images.items():
+            first_key.setdefault(entry['sha256'], key)
+        if not first_key:
+            return
+        objects = list(first_key)
+        position = {sha256: index for index, sha256 in enumerate(objects)}
+
+        ahashes, dhashes, valid = perceptual_hashes([self.images[first_key[sha256]]['path'] for sha256 in objects])
+        representative = near_duplicate_groups(ahashes, dhashes, valid, threshold)
+
+        for entry in self.images.values():
+            index = position[entry['sha256']]
+            if valid[index]:
+                entry['ahash'] = f"{int(ahashes[index]):016x}"
+                entry['dhash'] = f"{int(dhashes[index]):016x}"
+            if representative[index] != index:
+                entry['near_duplicate_of'] = first_key[objects[representative[index]]]
+
+
+# ==================== 感知雜湊 ====================
+
+def _load_gray(path, hash_size):
+    """讀取圖片並縮小為 (hash_size, hash_size + 1) 的灰階陣列；無法解碼（例如 EMF）時返回 None"""
+    try:
+        with Image.open(path) as img:
+            # JPEG 可直接以縮小的比例解碼
+            img.draft('L', (hash_size * 8, hash_size * 8))
+            gray = img.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+            return np.asarray(gray, dtype=np.float32)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def _pack_bits(bits):
+    """(N, 8, 8) 布林陣列 → (N,) uint64"""
+    flat = bits.reshape(bits.shape[0], bits.shape[1] * bits.shape[2])
+    return np.packbits(flat, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def perceptual_hashes(sources, hash_size=HASH_SIZE):
+    """
+    批次計算感知雜湊
+
+    Args:
+        sources: 圖片路徑或 bytes 列表
+
+    Returns:
+        tuple: (aHash 陣列, dHash 陣列, 是否成功解碼的布林陣列)，雜湊為 uint64
+    """
+    grids = np.zeros((len(sources), hash_size, hash_size + 1), dtype=np.float32)
+    valid = np.zeros(len(sources), dtype=bool)
+    for position, source in enumerate(sources):
+        gray = _load_gray(io.BytesIO(source) if isinstance(source, bytes) else source, hash_size)
+        if gray is not None:
+            grids[position] = gray
+            valid[position] = True
+
+    # dHash：每個像素與右側像素比較；aHash：以相鄰兩欄的平均作為 hash_size × hash_size 的縮圖，與整體平均比較
+    dbits = grids[:, :, 1:] > grids[:, :, :-1]
+    small = (grids[:, :, 1:] + grids[:, :, :-1]) / 2
+    abits = small > small.mean(axis=(1, 2), keepdims=True)
+    return _pack_bits(abits), _pack_bits(dbits), valid
+
+
+_POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8) if NUMPY_AVAILABLE else None
+
+
+def hamming_matrix(hashes):
+    """兩兩之間的漢明距離 (N, N)"""
+    xor = hashes[:, None] ^ hashes[None, :]
+    return _POPCOUNT[xor.view(np.uint8)].reshape(len(hashes), len(hashes), 8).sum(axis=2, dtype=np.uint8)
+
+
+def near_duplicate_groups(ahashes, dhashes, valid, threshold=NEAR_DUPLICATE_THRESHOLD):
+    """
+    找出近似重複的圖片
+
+    Returns:
+        np.ndarray: 每張圖片所屬群組中最早出現的那張的位置（不重複的圖片為自己的位置）
+    """
+    count = len(ahashes)
+    close = (hamming_matrix(ahashes) <= threshold) & (hamming_matrix(dhashes) <= threshold)
+    close &= valid[:, None] & valid[None, :]
+    # 只與更早出現的圖片比較
+    close &= np.tri(count, k=-1, dtype=bool)
+    representative = np.where(close.any(axis=1), close.argmax(axis=1), np.arange(count))
+    # 代表本身也可能是更早圖片的近似重複，收斂到每組最早的一張
+    while True:
+        resolved = representative[representative]
+        if np.array_equal(resolved, representative):
+            return representative
+        representative = resolved
@@ -0,0 +1,177 @@
+"""
+Template Ingestion Service
+模板上傳後在背景 worker 中預先處理，生成請求只需調用模型與輸出：
+- 提取文字（寫入 TemplateTextCache）
+- 產生標題骨架（章節標題與層級，分段 SOP 優化時作為各段的模板參考）
+- PPTX 模板提取圖片
+- 記錄文件資訊與每個模板的處理狀態，供 /api/templates 查詢
+"""
+import os
+import json
+import time
+import shutil
+
+from ..utils.db import ThreadLocalSQLite
+from .image_service import ImageExtractor
+from .section_service import SectionGenerator
+from .template_cache import file_sha256, is_extraction_error
+
+
+class TemplateIngestor:
+    """模板預處理與狀態記錄（狀態存儲在 SQLite，可由多個進程共享）"""
+
+    STATUS_QUEUED = 'queued'
+    STATUS_PROCESSING = 'processing'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+
+    # 標題骨架最多保留的標題數
+    MAX_HEADINGS = 200
+
+    def __init__(self, db_path, text_cache, asset_folder, image_store=None, lazy_images=False):
+        """
+        Args:
+            db_path: SQLite 文件路徑
+            text_cache: TemplateTextCache
+            asset_folder: 模板提取出的圖片等資源的存放目錄（每個模板一個子目錄）
+            image_store: ImageStore（可選）；傳入時圖片存入存放區，模板子目錄只保存圖片清單
+            lazy_images: 是否只記錄圖片在模板文件中的位置，使用時再從模板讀取
+        """
+        self.text_cache = text_cache
+        self.asset_folder = asset_folder
+        self.image_store = image_store
+        self.lazy_images = lazy_images
+        self._db = ThreadLocalSQLite(db_path)
+        self._init_schema()
+
+    def _init_schema(self):
+        self._db.connect().execute("""
+            CREATE TABLE IF NOT EXISTS template_ingest (
+                filename TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                job_id TEXT,
+                error TEXT,
+                headings TEXT,
+                metadata TEXT,
+                queued_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+        """)
+
+    def asset_path(self, filename):
+        """模板資源目錄"""
+        return os.path.join(self.asset_folder, os.path.splitext(filename)[0])
+
+    def mark_queued(self, filename, job_id=None):
+        """記錄模板已排入處理佇列"""
+        self._db.connect().execute("""
+            INSERT OR REPLACE INTO template_ingest (filename, status, job_id, queued_at)
+            VALUES (?, ?, ?, ?)
+        """, (filename, self.STATUS_QUEUED, job_id, time.time()))
+
+    def attach_job(self, filename, job_id):
+        """記錄負責處理的背景任務 ID"""
+        self._update(filename, job_id=job_id)
+
+    def _update(self, filename, **fields):
+        columns = ', '.join(f"{name} = ?" for name in fields)
+        self._db.connect().execute(
+            f'UPDATE template_ingest SET {columns} WHERE filename = ?', (*fields.values(), filename)
+        )
+
+    def ingest(self, path):
+        """
+        預處理一個模板（在背景 worker 中執行）
+
+        Returns:
+            dict: 處理結果摘要
+        """
+        filename = os.path.basename(path)
+        started = time.time()
+        if self.status(filename) is None:
+            self.mark_queued(filename)
+        self._update(filename, status=self.STATUS_PROCESSING, started_at=started, error=None)
+        try:
+            stats = os.stat(path)
+            text = self.text_cache.get_text(path)
+            if is_extraction_error(text):
+                raise ValueError(text)
+
+            headings = self.build_skeleton(text)
+            images = []
+            if filename.lower().endswith('.pptx'):
+                asset_path = self.asset_path(filename)
+                shutil.rmtree(asset_path, ignore_errors=True)
+                images = ImageExtractor.extract_images_from_pptx(path, asset_path, store=self.image_store,
+                                                                 lazy=self.lazy_images)
+
+            metadata = {
+                "type": os.path.splitext(filename)[1].lower().lstrip('.'),
+                "size": stats.st_size,
+                "sha256": file_sha256(path),
+                "characters": len(text),
+                "headings": len(headings),
+                "images": len(images),
+                "unique_images": len({image.get('sha256') or image['part'] for image in images}),
+                "image_folder": self.asset_path(filename) if images else None,
+                "seconds": round(time.time() - started, 3),
+            }
+            self._update(filename, status=self.STATUS_READY, finished_at=time.time(),
+                         headings=json.dumps(headings, ensure_ascii=False),
+                         metadata=json.dumps(metadata, ensure_ascii=False))
+            print(f"[INFO] 模板 {filename} 預處理完成（{metadata['seconds']} 秒，"
+                  f"{len(headings)} 個標題，{len(images)} 張圖片）")
+            return dict(metadata, filename=filename)
+        except Exception as e:
+            self._update(filename, status=self.STATUS_FAILED, error=str(e), finished_at=time.time())
+            raise
+
+    @classmethod
+    def build_skeleton(cls, text):
+        """模板的標題骨架 [{'title': ..., 'level': ...}]"""
+        return SectionGenerator.build_skeleton(text, cls.MAX_HEADINGS)
+
+    @staticmethod
+    def _row_to_status(row):
+        if row is None:
+            return None
+        status = dict(row)
+        status['headings'] = json.loads(status['headings']) if status['headings'] else []
+        status['metadata'] = json.loads(status['metadata']) if status['metadata'] else None
+        return status
+
+    def status(self, filename):
+        """返回模板的處理狀態，沒有記錄時返回 None"""
+        row = self._db.connect().execute(
+            'SELECT * FROM template_ingest WHERE filename = ?', (filename,)
+        ).fetchone()
+        return self._row_to_status(row)
+
+    def skeleton(self, filename):
+        """已完成預處理的模板標題骨架，尚未完成時返回 None"""
+        status = self.status(filename)
+        if status is None or status['status'] != self.STATUS_READY:
+            return None
+        return status['headings']
+
+    def statuses(self):
+        """所有模板的處理狀態 {filename: status}（不含標題骨架）"""
+        rows = self._db.connect().execute(
+            'SELECT filename, status, error, metadata, finished_at FROM template_ingest'
+        ).fetchall()
+        return {
+            row['filename']: {
+                "status": row['status'],
+                "error": row['error'],
+                "metadata": json.loads(row['metadata']) if row['metadata'] else None,
+                "finished_at": row['finished_at'],
+            }
+            for row in rows
+        }
+
+    def remove(self, filename):
+        """刪除模板的處理記錄與資源"""
+        self._db.connect().execute('DELETE FROM template_ingest WHERE filename = ?', (filename,))
+        self.text_cache.invalidate(filename)
+        shutil.rmtree(self.asset_path(filename), ignore_errors=True)
@@ -0,0 +1,263 @@
+"""
+Job Queue Service
+將耗時的生成流程放到背景 worker 池執行，任務狀態持久化在 SQLite 中，
+因此 worker / 進程重啟後未完成的任務會被重新排隊執行。
+"""
+import os
+import json
+import atexit
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+import traceback
+
+from ..utils.db import ThreadLocalSQLite
+
+
+class JobStore:
+    """任務狀態存儲 - SQLite (WAL 模式)，可由多個進程共享"""
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._db = ThreadLocalSQLite(db_path)
+        self._init_schema()
+
+    def _connect(self):
+        return self._db.connect()
+
+    def _init_schema(self):
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                payload TEXT,
+                result TEXT,
+                error TEXT,
+                worker TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)')
+
+    @staticmethod
+    def _row_to_job(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload']) if job['payload'] else {}
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def create(self, kind, payload):
+        """新增一個排隊中的任務"""
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        self._connect().execute(
+            'INSERT INTO jobs (id, kind, status, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (job_id, kind, self.STATUS_QUEUED, json.dumps(payload, ensure_ascii=False), now, now)
+        )
+        return self.get(job_id)
+
+    def get(self, job_id):
+        row = self._connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._row_to_job(row)
+
+    def claim_next(self, worker_id, kinds):
+        """原子地領取最早的排隊任務，沒有可執行任務時返回 None"""
+        if not kinds:
+            return None
+        conn = self._connect()
+        placeholders = ','.join('?' * len(kinds))
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                f'SELECT id FROM jobs WHERE status = ? AND kind IN ({placeholders}) ORDER BY created_at LIMIT 1',
+                (self.STATUS_QUEUED, *kinds)
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute(
+                'UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, '
+                'started_at = ?, updated_at = ? WHERE id = ?',
+                (self.STATUS_RUNNING, worker_id, now, now, row['id'])
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return self.get(row['id'])
+
+    def heartbeat(self, job_ids):
+        """更新執行中任務的心跳時間"""
+        if not job_ids:
+            return
+        now = time.time()
+        self._connect().executemany(
+            'UPDATE jobs SET updated_at = ? WHERE id = ? AND status = ?',
+            [(now, job_id, self.STATUS_RUNNING) for job_id in job_ids]
+        )
+
+    def complete(self, job_id, result):
+        now = time.time()
+        self._connect().execute(
+            'UPDATE jobs SET status = ?, result = ?, error = NULL, updated_at = ?, finished_at = ? WHERE id = ?',
+            (self.STATUS_DONE, json.dumps(result, ensure_ascii=False), now, now, job_id)
+        )
+
+    def fail(self, job_id, error):
+        now = time.time()
+        self._connect().execute(
+            'UPDATE jobs SET status = ?, error = ?, updated_at = ?, finished_at = ? WHERE id = ?',
+            (self.STATUS_FAILED, error, now, now, job_id)
+        )
+
+    def recover_stale(self, stale_seconds, max_attempts):
+        """
+        回收心跳逾時的執行中任務（worker 崩潰或進程重啟）
+
+        Returns:
+            int: 被重新排隊的任務數量
+        """
+        conn = self._connect()
+        deadline = time.time() - stale_seconds
+        conn.execute(
+            'UPDATE jobs SET status = ?, error = ?, finished_at = ? '
+            'WHERE status = ? AND updated_at < ? AND attempts >= ?',
+            (self.STATUS_FAILED, 'worker 中斷次數過多，任務已放棄', time.time(),
+             self.STATUS_RUNNING, deadline, max_attempts)
+        )
+        cursor = conn.execute(
+            'UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND updated_at < ?',
+            (self.STATUS_QUEUED, self.STATUS_RUNNING, deadline)
+        )
+        return cursor.rowcount
+
+
+class JobQueue:
+    """
+    背景任務佇列
+
+    任務以 kind 區分，由 register() 註冊對應的處理函數。處理函數在應用上下文中執行，
+    接收任務 payload 並返回可 JSON 序列化的結果；拋出的異常會記錄為任務失敗。
+    """
+
+    def __init__(self, app, db_path, workers=4, stale_seconds=120, max_attempts=3, poll_interval=1.0):
+        self.app = app
+        self.store = JobStore(db_path)
+        self.workers = max(1, int(workers))
+        self.stale_seconds = stale_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        self._handlers = {}
+        self._running_jobs = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._threads = []
+        self._stopped = threading.Event()
+
+    def register(self, kind, handler):
+        """註冊任務處理函數"""
+        self._handlers[kind] = handler
+
+    def start(self):
+        """啟動 worker 線程與心跳線程（重複調用不會重複啟動）"""
+        if self._threads:
+            return
+        # 接手上一次運行中斷的任務
+        self.store.recover_stale(self.stale_seconds, self.max_attempts)
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._worker_loop, args=(f"{self.worker_prefix}:{i}",),
+                name=f"job-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        heartbeat = threading.Thread(target=self._heartbeat_loop, name='job-heartbeat', daemon=True)
+        heartbeat.start()
+        self._threads.append(heartbeat)
+        # 進程結束時讓 worker 停止領取新任務（執行中的任務下次啟動時由 recover_stale 接手）
+        atexit.register(self.stop, timeout=1.0)
+
+    def stop(self, timeout=5.0):
+        """停止 worker 與心跳線程，最多等待 timeout 秒讓正在執行的任務結束"""
+        self._stopped.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(max(0.0, deadline - time.monotonic()))
+        atexit.unregister(self.stop)
+
+    def submit(self, kind, payload):
+        """提交任務，立即返回任務記錄"""
+        if kind not in self._handlers:
+            raise ValueError(f"未註冊的任務類型: {kind}")
+        job = self.store.create(kind, payload)
+        with self._wakeup:
+            self._wakeup.notify()
+        return job
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def _worker_loop(self, worker_id):
+        while not self._stopped.is_set():
+            try:
+                job = self.store.claim_next(worker_id, list(self._handlers))
+            except sqlite3.OperationalError as e:
+                # 資料庫暫時被鎖定，稍後再試
+                print(f"[WARNING] 領取任務失敗: {e}")
+                job = None
+
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+
+            self._execute(job)
+
+    def _execute(self, job):
+        with self._lock:
+            self._running_jobs.add(job['id'])
+        try:
+            handler = self._handlers[job['kind']]
+            with self.app.app_context():
+                result = handler(job['payload'])
+            self.store.complete(job['id'], result)
+        except Exception as e:
+            traceback.print_exc()
+            self.store.fail(job['id'], str(e))
+        finally:
+            with self._lock:
+                self._running_jobs.discard(job['id'])
+
+    def _heartbeat_loop(self):
+        interval = max(1.0, self.stale_seconds / 4)
+        while not self._stopped.wait(interval):
+            try:
+                with self._lock:
+                    running = list(self._running_jobs)
+                self.store.heartbeat(running)
+                # 順便回收其他進程遺留的逾時任務
+                if self.store.recover_stale(self.stale_seconds, self.max_attempts):
+                    with self._wakeup:
+                        self._wakeup.notify_all()
+            except Exception as e:
+                print(f"[WARNING] 任務心跳更新失敗: {e}")
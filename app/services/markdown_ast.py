@@ -0,0 +1,366 @@
+"""
+Markdown AST
+將生成的 Markdown 解析一次為精簡的區塊 / 行內結構，DOCX、PPTX、PDF 各輸出格式都走訪同一份結果：
+- 以 Python-Markdown（tables、fenced_code、sane_lists 擴展）解析，在行內處理後把元素樹轉為 dict / tuple
+- 區塊：heading、paragraph、list、table、code、quote、rule，以及 [圖片 x-y] 標記轉成的 image
+- 行內：Run(text, bold, italic, code, href)
+- 段落內的換行各自成為一個段落，列表與表格前不必空行（與原本逐行轉換的行為一致）
+- 列表按相對縮排巢狀（LLM 常用的 2 空格縮排也可以）
+- 結果按內容雜湊保存在 LRU 快取中，同一份內容轉換為多種格式或重複轉換時不再解析
+"""
+import re
+import html
+import hashlib
+import threading
+import xml.etree.ElementTree as etree
+from collections import OrderedDict, namedtuple
+
+import markdown
+from markdown.preprocessors import Preprocessor
+from markdown.treeprocessors import Treeprocessor
+from markdown.util import HTML_PLACEHOLDER_RE
+
+
+# 圖片標記：[圖片 1-1: 來自投影片 1]、- 圖片 1-1: 來自投影片 1 或 圖片1-1
+# （section_service 檢查分段輸出是否保留圖片標記時使用同一規則）
+IMAGE_MARKER_PATTERN = re.compile(r'[-\[]?\s*圖片\s*(\d+)-(\d+)(?::\s*來自投影片\s*\d+)?[\]]?')
+
+# 快取的解析結果數量
+AST_CACHE_SIZE = 64
+
+BLOCK_TAGS = {'p', 'ul', 'ol', 'pre', 'blockquote', 'table', 'hr', 'div',
+              'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+# 內容中的原始 HTML 只去除常見標籤；<username> 這類佔位寫法保留原文
+HTML_TAG_PATTERN = re.compile(
+    r'</?(?:a|b|i|u|s|em|strong|span|div|p|code|sup|sub|small|font|mark|del|ins|kbd|center|'
+    r'table|thead|tbody|tr|td|th|ul|ol|li|h[1-6]|pre|blockquote|img|hr)\b[^>]*>', re.IGNORECASE)
+# fenced_code 把程式碼區塊以原始 HTML 存入 htmlStash，段落中只留下佔位符
+STASHED_CODE_PATTERN = re.compile(
+    r'\s*<pre[^>]*><code(?: class="(?:language-)?([^"]*)")?[^>]*>(.*?)</code></pre>\s*', re.DOTALL)
+
+LIST_LINE_PATTERN = re.compile(r' {0,3}(?:([*+-])|\d+\.)\s+\S')
+LIST_ITEM_PATTERN = re.compile(r'( *)(?:([*+-])|\d+\.)\s+\S')
+TABLE_LINE_PATTERN = re.compile(r' {0,3}\|')
+
+Run = namedtuple('Run', ['text', 'bold', 'italic', 'code', 'href'], defaults=(False, False, False, None))
+
+
+def plain_text(runs):
+    """Run 列表 → 純文字"""
+    return ''.join(run.text for run in runs)
+
+
+class _AstBuilder:
+    """Python-Markdown 元素樹 → 區塊 tuple"""
+
+    def __init__(self, md):
+        self.md = md
+
+    def _resolve(self, text):
+        """還原原始 HTML / 實體的佔位符（標籤去除，只保留文字）"""
+        if '\x02' not in text:
+            return text
+
+        def replace(match):
+            index = int(match.group(1))
+            stash = self.md.htmlStash.rawHtmlBlocks
+            raw = str(stash[index]) if index < len(stash) else ''
+            if re.fullmatch(r'<br\s*/?>', raw.strip(), re.IGNORECASE):
+                return '\n'
+            return html.unescape(HTML_TAG_PATTERN.sub('', raw))
+
+        return HTML_PLACEHOLDER_RE.sub(replace, text)
+
+    def _stashed_code(self, element):
+        """只含一個佔位符、且內容是 <pre><code> 的段落 → code 區塊"""
+        if len(element):
+            return None
+        match = HTML_PLACEHOLDER_RE.fullmatch((element.text or '').strip())
+        stash = self.md.htmlStash.rawHtmlBlocks
+        if not match or int(match.group(1)) >= len(stash):
+            return None
+        code = STASHED_CODE_PATTERN.fullmatch(str(stash[int(match.group(1))]))
+        if not code:
+            return None
+        return {'type': 'code', 'language': code.group(1) or '',
+                'text': html.unescape(code.group(2)).strip('\n')}
+
+    def _append(self, runs, text, style):
+        if not text:
+            return
+        text = self._resolve(text)
+        if runs and runs[-1][1:] == style:
+            runs[-1] = Run(runs[-1].text + text, *style)
+        else:
+            runs.append(Run(text, *style))
+
+    def runs(self, element, style=(False, False, False, None), runs=None):
+        """行內元素 → Run 列表（相鄰同樣式的文字合併）"""
+        if runs is None:
+            runs = []
+        self._append(runs, element.text, style)
+        for child in element:
+            tag = child.tag
+            if tag == 'br':
+                self._append(runs, '\n', style)
+            elif tag == 'img':
+                self._append(runs, child.get('alt', ''), style)
+            else:
+                bold, italic, code, href = style
+                self.runs(child, (
+                    bold or tag in ('strong', 'b'),
+                    italic or tag in ('em', 'i'),
+                    code or tag == 'code',
+                    child.get('href') if tag == 'a' else href,
+                ), runs)
+            self._append(runs, child.tail, style)
+        return runs
+
+    def paragraphs(self, element):
+        """段落按換行拆成多個 paragraph；整行是圖片標記時成為 image 區塊"""
+        blocks = []
+        line = []
+        for run in self.runs(element) + [Run('\n')]:
+            parts = run.text.split('\n')
+            for i, part in enumerate(parts):
+                if i:
+                    blocks.extend(self._line_block(line))
+                    line = []
+                if part:
+                    line.append(run._replace(text=part))
+        return blocks
+
+    @staticmethod
+    def _line_block(line):
+        if line:
+            line[0] = line[0]._replace(text=line[0].text.lstrip())
+            line[-1] = line[-1]._replace(text=line[-1].text.rstrip())
+        runs = tuple(run for run in line if run.text)
+        if not runs:
+            return []
+        match = IMAGE_MARKER_PATTERN.search(plain_text(runs)) if '圖片' in plain_text(runs) else None
+        if match:
+            return [{'type': 'image', 'slide': match.group(1), 'index': match.group(2), 'runs': runs}]
+        return [{'type': 'paragraph', 'runs': runs}]
+
+    def cell(self, element):
+        runs = self.runs(element)
+        if runs:
+            runs[0] = runs[0]._replace(text=runs[0].text.lstrip())
+            runs[-1] = runs[-1]._replace(text=runs[-1].text.rstrip())
+        return tuple(run for run in runs if run.text)
+
+    def mixed(self, element):
+        """列表項目可同時有行內文字與子區塊（巢狀列表、鬆散列表的段落）"""
+        blocks = []
+        inline = etree.Element('span')
+        inline.text = element.text
+        for child in element:
+            if child.tag in BLOCK_TAGS:
+                blocks.extend(self.paragraphs(inline))
+                blocks.extend(self.blocks([child]))
+                inline = etree.Element('span')
+                inline.text = child.tail
+            else:
+                inline.append(child)
+        blocks.extend(self.paragraphs(inline))
+        return tuple(blocks)
+
+    def blocks(self, elements):
+        blocks = []
+        for element in elements:
+            tag = element.tag
+            if tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
+                runs = self.cell(element)
+                if runs:
+                    blocks.append({'type': 'heading', 'level': int(tag[1]), 'runs': runs})
+            elif tag in ('ul', 'ol'):
+                items = tuple(self.mixed(li) for li in element if li.tag == 'li')
+                blocks.append({'type': 'list', 'ordered': tag == 'ol',
+                               'start': int(element.get('start', 1)), 'items': items})
+            elif tag == 'table':
+                head = element.find('thead/tr')
+                blocks.append({
+                    'type': 'table',
+                    'header': tuple(self.cell(c) for c in head) if head is not None else (),
+                    'rows': tuple(tuple(self.cell(c) for c in tr) for tr in element.iterfind('tbody/tr')),
+                })
+            elif tag == 'pre':
+                code = element.find('code')
+                source = code if code is not None else element
+                language = (source.get('class') or '').replace('language-', '')
+                # CodeBlockProcessor 保存的是已轉義的 HTML 文字
+                text = html.unescape(self._resolve(''.join(source.itertext())))
+                blocks.append({'type': 'code', 'language': language, 'text': text.strip('\n')})
+            elif tag == 'blockquote':
+                blocks.append({'type': 'quote', 'blocks': self.blocks(element)})
+            elif tag == 'hr':
+                blocks.append({'type': 'rule'})
+            elif tag == 'div':
+                blocks.extend(self.blocks(element))
+            else:
+                code = self._stashed_code(element) if tag == 'p' else None
+                if code:
+                    blocks.append(code)
+                else:
+                    blocks.extend(self.paragraphs(element))
+        return tuple(blocks)
+
+
+class _ListIndentPreprocessor(Preprocessor):
+    """
+    Python-Markdown 只把縮排 4 空格的列表項目視為巢狀；按項目之間的相對縮排推算層級，
+    統一改寫為每層 4 空格（「- a\\n  - b」中的 b 成為 a 的子項目）；
+    同一層中有序 / 無序列表切換時補一個空行，否則後者會被併入前一項目的文字
+    """
+
+    def run(self, lines):
+        output = []
+        indents = []  # 目前各層列表項目的原始縮排
+        ordered = []  # 各層是否為有序列表
+        for line in lines:
+            match = LIST_ITEM_PATTERN.match(line)
+            if not line.strip():
+                output.append(line)
+                continue
+            if match is None or (not indents and len(match.group(1)) > 3):
+                # 不在列表中且不縮排的文字結束列表；縮排的文字（項目的續行、程式碼）保持原樣
+                if not line.startswith(' '):
+                    indents, ordered = [], []
+                output.append(line)
+                continue
+
+            indent = len(match.group(1))
+            is_ordered = match.group(2) is None
+            while indents and indent < indents[-1]:
+                indents.pop()
+                ordered.pop()
+            if not indents or indent > indents[-1]:
+                indents.append(indent)
+                ordered.append(is_ordered)
+            elif ordered[-1] != is_ordered:
+                ordered[-1] = is_ordered
+                if output and output[-1].strip():
+                    output.append('')
+            output.append('    ' * (len(indents) - 1) + line[indent:])
+        return output
+
+
+class _BlockStartPreprocessor(Preprocessor):
+    """
+    生成內容常在文字後直接接列表或表格（「說明：\\n- 步驟」、「- 項目\\n1. 步驟」），
+    或在列表後直接接不縮排的文字，標準 Markdown 會把它們併入前一段落 / 項目；
+    在這些行前補一個空行，讓它們各自成為區塊
+    """
+
+    def run(self, lines):
+        output = []
+        for line in lines:
+            previous = output[-1] if output else ''
+            if previous.strip():
+                current_list = LIST_LINE_PATTERN.match(line)
+                previous_list = LIST_LINE_PATTERN.match(previous)
+                if current_list and (previous_list is None
+                                     or bool(previous_list.group(1)) != bool(current_list.group(1))):
+                    output.append('')
+                elif TABLE_LINE_PATTERN.match(line) and not TABLE_LINE_PATTERN.match(previous):
+                    output.append('')
+                elif (line.strip() and not line.startswith((' ', '\t')) and current_list is None
+                      and LIST_ITEM_PATTERN.match(previous)):
+                    output.append('')
+            output.append(line)
+        return output
+
+
+class _AstCapture(Treeprocessor):
+    """在行內處理與反轉義之後取得元素樹，轉為 AST 保存在 md.ast 上"""
+
+    def run(self, root):
+        self.md.ast = _AstBuilder(self.md).blocks(root)
+
+
+_local = threading.local()
+
+
+def _parser():
+    """Markdown 實例不可跨線程共用，每個線程各建一個"""
+    md = getattr(_local, 'md', None)
+    if md is None:
+        md = markdown.Markdown(extensions=['tables', 'fenced_code', 'sane_lists'])
+        # 在 fenced_code (25) 之後，程式碼區塊已被取出；先統一列表縮排再補空行
+        md.preprocessors.register(_ListIndentPreprocessor(md), 'list_indent', 23)
+        md.preprocessors.register(_BlockStartPreprocessor(md), 'block_start', 22)
+        md.treeprocessors.register(_AstCapture(md), 'ast_capture', -10)
+        _local.md = md
+    return md
+
+
+def build_ast(content):
+    """解析 Markdown 為區塊 tuple（不經快取）"""
+    if not content or not content.strip():
+        return ()
+    md = _parser()
+    md.reset()
+    md.ast = ()
+    md.convert(content)
+    return md.ast
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def parse_markdown(content):
+    """
+    解析 Markdown（按內容雜湊快取）
+
+    返回的結構在各渲染器之間共用，走訪時不可修改。
+
+    Returns:
+        tuple: 區塊 dict 的 tuple
+    """
+    key = hashlib.sha256((content or '').encode('utf-8')).hexdigest()
+    with _cache_lock:
+        ast = _cache.get(key)
+        if ast is not None:
+            _cache.move_to_end(key)
+            _cache_stats['hits'] += 1
+            return ast
+        _cache_stats['misses'] += 1
+
+    ast = build_ast(content)
+    with _cache_lock:
+        _cache[key] = ast
+        _cache.move_to_end(key)
+        while len(_cache) > AST_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return ast
+
+
+def ast_cache_info():
+    with _cache_lock:
+        return dict(_cache_stats, size=len(_cache))
+
+
+def flatten(blocks, depth=0):
+    """
+    展開列表與引用，逐個返回 (block, depth, marker)
+
+    depth 為列表巢狀深度；marker 只出現在每個列表項目的第一個區塊上，
+    無序列表為 '-'，有序列表為 '3.' 形式的編號，其餘為 None。
+    """
+    for block in blocks:
+        kind = block['type']
+        if kind == 'list':
+            for number, item in enumerate(block['items'], block['start']):
+                marker = f"{number}." if block['ordered'] else '-'
+                for child, child_depth, child_marker in flatten(item, depth + 1):
+                    if marker and child_depth == depth + 1 and child_marker is None:
+                        child_marker = marker
+                    marker = None
+                    yield child, child_depth, child_marker
+        elif kind == 'quote':
+            yield from flatten(block['blocks'], depth)
+        else:
+            yield block, depth, None
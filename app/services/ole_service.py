@@ -0,0 +1,297 @@
+"""
+OLE2 (Compound File Binary) Text Extractor
+以 olefile 直接讀取 Word 97-2003 (.doc) 與 PowerPoint 97-2003 (.ppt) 的二進位資料流，
+不需要啟動 Word / PowerPoint（win32com），可在 Linux 上執行，每次調用各自開啟文件，可多線程並行：
+- DOC：依 FIB 找到 Clx 片段表 (piece table)，按片段讀取正文（壓縮片段為 cp1252，其餘為 UTF-16），
+  移除域代碼只保留域結果，表格每列一行、儲存格以 " | " 分隔（與 DOCX 輸出一致）
+- PPT：沿 Current User → UserEditAtom → PersistDirectory 找到最新版本的文件與投影片，
+  按投影片順序輸出版面配置區文字 (SlideListWithText) 與投影片上其他文字框的文字
+"""
+import re
+import struct
+
+try:
+    import olefile
+    OLEFILE_AVAILABLE = True
+except ImportError:
+    OLEFILE_AVAILABLE = False
+
+from .ooxml_service import CELL_SEPARATOR
+
+
+class OLEFormatError(ValueError):
+    """文件不是可解析的 Word / PowerPoint 97-2003 格式"""
+
+
+# 文件結構不符預期時的錯誤（olefile 對非 OLE2 文件與缺少的資料流拋出 OSError）
+OLE_ERRORS = (OSError, struct.error, IndexError, OLEFormatError)
+
+
+# ==================== DOC ====================
+
+WORD_IDENT = 0xA5EC
+# Word 97 起的 nFib；更早的 Word 6 / 95 格式沒有片段表
+WORD97_MIN_NFIB = 0xC0
+FIB_FLAG_ENCRYPTED = 0x0100
+FIB_FLAG_WHICH_TABLE = 0x0200
+FIB_OFFSET_FLAGS = 0x0A
+FIB_OFFSET_CCP_TEXT = 0x4C
+FIB_OFFSET_CLX = 0x01A2
+
+CLX_PRC = 0x01
+CLX_PCDT = 0x02
+PCD_SIZE = 8
+FC_COMPRESSED = 0x40000000
+
+FIELD_BEGIN, FIELD_SEPARATOR, FIELD_END = '\x13', '\x14', '\x15'
+CELL_MARK = '\x07'
+
+# 正文中的特殊字元：段落 / 換行 / 分頁轉為換行，不換行連字號轉為 "-"，其餘控制字元（圖片、物件錨點等）移除
+_DOC_TRANSLATION = {ord('\r'): '\n', ord('\x0b'): '\n', ord('\x0c'): '\n', ord('\x1e'): '-'}
+_DOC_TRANSLATION.update({code: None for code in range(0x20) if chr(code) not in '\t\n\r\x0b\x0c\x1e'})
+
+
+def extract_doc_text(file_path):
+    """
+    提取 Word 97-2003 (.doc) 正文文字（不含頁首頁尾、註腳與批註）
+
+    Returns:
+        str: 段落以換行分隔，表格每列一行
+    """
+    with olefile.OleFileIO(file_path) as ole:
+        word = ole.openstream('WordDocument').read()
+        ident, n_fib = struct.unpack_from('<HH', word, 0)
+        if ident != WORD_IDENT:
+            raise OLEFormatError('不是 Word 97-2003 文件')
+        if n_fib < WORD97_MIN_NFIB:
+            raise OLEFormatError('不支援 Word 95 以前的文件格式')
+        (flags,) = struct.unpack_from('<H', word, FIB_OFFSET_FLAGS)
+        if flags & FIB_FLAG_ENCRYPTED:
+            raise OLEFormatError('文件已加密')
+        (ccp_text,) = struct.unpack_from('<i', word, FIB_OFFSET_CCP_TEXT)
+        fc_clx, lcb_clx = struct.unpack_from('<II', word, FIB_OFFSET_CLX)
+
+        table_name = '1Table' if flags & FIB_FLAG_WHICH_TABLE else '0Table'
+        clx = ole.openstream(table_name).read()[fc_clx:fc_clx + lcb_clx]
+
+    return _clean_doc_text(''.join(_iter_doc_pieces(word, clx, ccp_text)))
+
+
+def _iter_doc_pieces(word, clx, ccp_text):
+    """按片段表順序返回正文各片段的文字，讀到 ccp_text 個字元為止"""
+    pos = 0
+    # 跳過格式修改記錄 (Prc)，之後是片段表 (Pcdt)
+    while pos < len(clx) and clx[pos] == CLX_PRC:
+        (cb,) = struct.unpack_from('<h', clx, pos + 1)
+        pos += 3 + cb
+    if pos >= len(clx) or clx[pos] != CLX_PCDT:
+        raise OLEFormatError('找不到片段表')
+    (lcb,) = struct.unpack_from('<I', clx, pos + 1)
+    plc = clx[pos + 5:pos + 5 + lcb]
+
+    count = (len(plc) - 4) // (4 + PCD_SIZE)
+    cps = struct.unpack_from(f'<{count + 1}I', plc, 0)
+    pcd_offset = 4 * (count + 1)
+    for index in range(count):
+        start, end = cps[index], min(cps[index + 1], ccp_text)
+        if start >= end:
+            break
+        (fc,) = struct.unpack_from('<I', plc, pcd_offset + index * PCD_SIZE + 2)
+        chars = end - start
+        if fc & FC_COMPRESSED:
+            offset = (fc & ~FC_COMPRESSED) // 2
+            yield word[offset:offset + chars].decode('cp1252', errors='replace')
+        else:
+            yield word[fc:fc + 2 * chars].decode('utf-16-le', errors='replace')
+
+
+def _strip_fields(text):
+    """移除域代碼（\\x13 代碼 \\x14 結果 \\x15），只保留域結果；域可以巢狀"""
+    if FIELD_BEGIN not in text:
+        return text
+    output = []
+    stack = []        # 每層域目前是否在代碼部分
+    in_code = 0       # 目前位於多少層域代碼之內
+    for char in text:
+        if char == FIELD_BEGIN:
+            stack.append(True)
+            in_code += 1
+        elif char == FIELD_SEPARATOR and stack:
+            if stack[-1]:
+                stack[-1] = False
+                in_code -= 1
+        elif char == FIELD_END and stack:
+            if stack.pop():
+                in_code -= 1
+        elif not in_code:
+            output.append(char)
+    return ''.join(output)
+
+
+def _clean_doc_text(text):
+    text = _strip_fields(text)
+    # 每個儲存格以 \x07 結尾，列結束標記也是 \x07，因此連續兩個代表列尾
+    text = text.replace(CELL_MARK * 2, '\n').replace(CELL_MARK, CELL_SEPARATOR)
+    text = text.translate(_DOC_TRANSLATION)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+
+# ==================== PPT ====================
+
+RT_DOCUMENT = 0x03E8
+RT_SLIDE = 0x03EE
+RT_SLIDE_PERSIST_ATOM = 0x03F3
+RT_TEXT_CHARS_ATOM = 0x0FA0
+RT_TEXT_BYTES_ATOM = 0x0FA8
+RT_SLIDE_LIST_WITH_TEXT = 0x0FF0
+RT_USER_EDIT_ATOM = 0x0FF5
+RT_PERSIST_DIRECTORY_ATOM = 0x1772
+
+CONTAINER_VERSION = 0xF
+RECORD_HEADER_SIZE = 8
+# SlideListWithText 的 instance：0 為投影片（1 為母片、2 為備註頁）
+SLIDE_LIST_SLIDES = 0
+# CurrentUserAtom 中 offsetToCurrentEdit 的位置（含記錄標頭）
+CURRENT_USER_OFFSET_TO_EDIT = 16
+
+
+def _iter_records(data, start, end):
+    """返回 [start, end) 範圍內的同層記錄 (recType, recInstance, 是否為容器, 內容起點, 內容終點)"""
+    pos = start
+    while pos + RECORD_HEADER_SIZE <= end:
+        ver_instance, rec_type, rec_len = struct.unpack_from('<HHI', data, pos)
+        body = pos + RECORD_HEADER_SIZE
+        body_end = min(body + rec_len, end)
+        yield rec_type, ver_instance >> 4, (ver_instance & 0xF) == CONTAINER_VERSION, body, body_end
+        pos = body + rec_len
+
+
+def _record_at(data, offset, expected_type):
+    """返回 offset 處記錄的 (內容起點, 內容終點)，類型不符時拋出 OLEFormatError"""
+    if offset + RECORD_HEADER_SIZE > len(data):
+        raise OLEFormatError(f'記錄位置超出資料流範圍: {offset}')
+    _, rec_type, rec_len = struct.unpack_from('<HHI', data, offset)
+    if rec_type != expected_type:
+        raise OLEFormatError(f'預期記錄類型 0x{expected_type:04X}，實際為 0x{rec_type:04X}')
+    body = offset + RECORD_HEADER_SIZE
+    return body, min(body + rec_len, len(data))
+
+
+def _text_atom(data, rec_type, body, body_end):
+    """文字原子的內容，不是文字原子時返回 None"""
+    if rec_type == RT_TEXT_CHARS_ATOM:
+        raw = data[body:body_end].decode('utf-16-le', errors='replace')
+    elif rec_type == RT_TEXT_BYTES_ATOM:
+        # 每個位元組是 UTF-16 字元的低位元組
+        raw = data[body:body_end].decode('latin-1')
+    else:
+        return None
+    return raw.replace('\r', '\n').replace('\x0b', '\n').strip()
+
+
+def _iter_text_atoms(data, start, end):
+    """遞迴返回範圍內所有文字原子的內容"""
+    for rec_type, _, is_container, body, body_end in _iter_records(data, start, end):
+        if is_container:
+            yield from _iter_text_atoms(data, body, body_end)
+            continue
+        text = _text_atom(data, rec_type, body, body_end)
+        if text:
+            yield text
+
+
+def _persist_directory(ole, data):
+    """
+    讀取持久化目錄
+
+    Returns:
+        tuple: ({persistId: 記錄位置}, 文件容器的 persistId)；多次增量儲存時以最新的記錄為準
+    """
+    current_user = ole.openstream('Current User').read()
+    (offset,) = struct.unpack_from('<I', current_user, CURRENT_USER_OFFSET_TO_EDIT)
+
+    persist = {}
+    document_ref = None
+    visited = set()
+    while offset and offset not in visited:
+        visited.add(offset)
+        body, _ = _record_at(data, offset, RT_USER_EDIT_ATOM)
+        last_edit, directory_offset, doc_ref = struct.unpack_from('<III', data, body + 8)
+        if document_ref is None:
+            document_ref = doc_ref
+
+        pos, directory_end = _record_at(data, directory_offset, RT_PERSIST_DIRECTORY_ATOM)
+        while pos + 4 <= directory_end:
+            (entry,) = struct.unpack_from('<I', data, pos)
+            first_id, count = entry & 0xFFFFF, entry >> 20
+            offsets = struct.unpack_from(f'<{count}I', data, pos + 4)
+            for index, record_offset in enumerate(offsets):
+                persist.setdefault(first_id + index, record_offset)
+            pos += 4 + 4 * count
+        offset = last_edit
+
+    if document_ref not in persist:
+        raise OLEFormatError('找不到文件容器')
+    return persist, document_ref
+
+
+def _slide_outlines(data, document_body, document_end):
+    """文件容器內投影片清單中的版面配置區文字 [(投影片 persistId, [文字, ...]), ...]"""
+    slides = []
+    for rec_type, instance, _, body, body_end in _iter_records(data, document_body, document_end):
+        if rec_type != RT_SLIDE_LIST_WITH_TEXT or instance != SLIDE_LIST_SLIDES:
+            continue
+        for child_type, _, _, child_body, child_end in _iter_records(data, body, body_end):
+            if child_type == RT_SLIDE_PERSIST_ATOM:
+                (persist_ref,) = struct.unpack_from('<I', data, child_body)
+                slides.append((persist_ref, []))
+            elif slides:
+                text = _text_atom(data, child_type, child_body, child_end)
+                if text:
+                    slides[-1][1].append(text)
+    return slides
+
+
+def _iter_ppt_slides(ole, data):
+    """按投影片順序返回每張投影片的文字列表"""
+    try:
+        persist, document_ref = _persist_directory(ole, data)
+    except OLE_ERRORS:
+        # 沒有可用的持久化目錄（文件損壞或由其他工具產生）：按資料流中的順序讀取投影片容器
+        for rec_type, _, _, body, body_end in _iter_records(data, 0, len(data)):
+            if rec_type == RT_SLIDE:
+                yield list(_iter_text_atoms(data, body, body_end))
+        return
+
+    document_body, document_end = _record_at(data, persist[document_ref], RT_DOCUMENT)
+    for persist_ref, texts in _slide_outlines(data, document_body, document_end):
+        # 版面配置區的文字在投影片清單中；其他文字框的文字在投影片自己的繪圖記錄中
+        if persist_ref in persist:
+            body, body_end = _record_at(data, persist[persist_ref], RT_SLIDE)
+            texts.extend(_iter_text_atoms(data, body, body_end))
+        yield texts
+
+
+def extract_ppt_text(file_path, include_slide_markers=False):
+    """
+    提取 PowerPoint 97-2003 (.ppt) 投影片文字
+
+    Args:
+        file_path: PPT 文件路徑
+        include_slide_markers: 是否在每張投影片前加上 [投影片 N] 分隔標記
+
+    Returns:
+        str: 每張投影片的文字之間以空行分隔（與 PPTX 輸出一致）
+    """
+    with olefile.OleFileIO(file_path) as ole:
+        data = ole.openstream('PowerPoint Document').read()
+        slides = list(_iter_ppt_slides(ole, data))
+
+    text = []
+    for slide_idx, slide_text in enumerate(slides, start=1):
+        if not slide_text:
+            continue
+        if include_slide_markers:
+            slide_text = [f"[投影片 {slide_idx}]"] + slide_text
+        text.append('\n'.join(slide_text))
+    return '\n\n'.join(text)
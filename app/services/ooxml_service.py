@@ -0,0 +1,403 @@
+"""
+OOXML Fast Text Extractor
+直接以 zipfile 開啟 DOCX / PPTX 讀取 XML，不載入 python-docx / python-pptx 的完整物件模型：
+- DOCX：按閱讀順序輸出段落與表格（每列一行，儲存格以 " | " 分隔），包含文字方塊；
+  正文以 iterparse 串流解析並隨即釋放已處理的元素，記憶體用量不隨文件大小增長
+- PPTX：按投影片順序輸出文字，包含表格、群組中的形狀與備註，圖片標記格式與 FileProcessor 相同
+- 大型簡報按投影片範圍分給多個進程並行解析
+- ingest_pptx 一次遍歷同時產生文字、圖片標記與圖片文件，標記與文件名的編號一致；
+  可改為存入以內容雜湊定址的圖片存放區，重複的圖片只寫入一次，或只記錄媒體部件名稱、需要時再從 zip 讀取
+"""
+import io
+import os
+import posixpath
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree.ElementTree import XML, iterparse, ParseError
+
+from PIL import Image
+
+from ..utils.process_pool import get_process_pool
+
+
+W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+A = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+P = '{http://schemas.openxmlformats.org/presentationml/2006/main}'
+R = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PKG_REL = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+NOTES_REL_TYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/notesSlide'
+
+# 文件結構不符預期時的錯誤，調用方可改用完整的物件模型
+OOXML_ERRORS = (zipfile.BadZipFile, KeyError, ParseError)
+
+# 表格儲存格之間的分隔
+CELL_SEPARATOR = ' | '
+
+# 媒體文件副檔名的標準寫法
+IMAGE_EXTENSION_ALIASES = {'jpeg': 'jpg', 'jpe': 'jpg', 'tif': 'tiff'}
+
+# 延遲模式下解析圖片標頭時最多解壓的位元組數
+IMAGE_HEADER_PEEK_BYTES = 64 * 1024
+
+# 少於此張數的簡報順序解析（進程間傳輸有固定成本）
+PARALLEL_MIN_SLIDES = 200
+
+
+# ==================== DOCX ====================
+
+def extract_docx_text(file_path):
+    """
+    提取 DOCX 正文文字
+
+    Returns:
+        str: 段落以換行分隔，表格每列一行
+    """
+    with zipfile.ZipFile(file_path) as package:
+        with package.open('word/document.xml') as stream:
+            return '\n'.join(_iter_docx_lines(stream))
+
+
+def _iter_docx_lines(stream):
+    paragraphs = []   # 巢狀段落（文字方塊內的段落）的文字緩衝
+    cells = []        # 巢狀表格：每層一個目前列的儲存格列表
+    cell_lines = []   # 每層表格目前儲存格內的行
+    pending = []      # 文字方塊內完成的段落，在外層段落之前輸出
+
+    def emit(line):
+        # 表格內的行寫入目前儲存格，否則直接輸出
+        if cell_lines:
+            cell_lines[-1].append(line)
+            return None
+        return line
+
+    for event, element in iterparse(stream, events=('start', 'end')):
+        tag = element.tag
+        if event == 'start':
+            if tag == W + 'p':
+                paragraphs.append([])
+            elif tag == W + 'tr':
+                cells.append([])
+            elif tag == W + 'tc':
+                cell_lines.append([])
+            continue
+
+        if tag == W + 't':
+            if paragraphs and element.text:
+                paragraphs[-1].append(element.text)
+        elif tag in (W + 'tab', W + 'ptab'):
+            if paragraphs:
+                paragraphs[-1].append('\t')
+        elif tag in (W + 'br', W + 'cr'):
+            if paragraphs:
+                paragraphs[-1].append('\n')
+        elif tag == W + 'noBreakHyphen':
+            if paragraphs:
+                paragraphs[-1].append('-')
+        elif tag == W + 'p':
+            text = ''.join(paragraphs.pop())
+            if paragraphs:
+                # 文字方塊內的段落
+                pending.append(text)
+            else:
+                for line in pending + [text]:
+                    line = emit(line)
+                    if line is not None:
+                        yield line
+                pending = []
+            element.clear()
+        elif tag == W + 'tc':
+            cells[-1].append(' '.join(line for line in cell_lines.pop() if line.strip()))
+            element.clear()
+        elif tag == W + 'tr':
+            line = emit(CELL_SEPARATOR.join(cells.pop()))
+            if line is not None:
+                yield line
+            element.clear()
+        elif tag == W + 'tbl':
+            element.clear()
+
+
+# ==================== PPTX ====================
+
+def _read_rels(package, part_name):
+    """讀取 part 的關聯 {rId: (type, 目標 part 名稱)}"""
+    directory, name = posixpath.split(part_name)
+    rels_name = posixpath.join(directory, '_rels', f"{name}.rels")
+    try:
+        data = package.read(rels_name)
+    except KeyError:
+        return {}
+    rels = {}
+    for _, element in iterparse(io.BytesIO(data)):
+        if element.tag == PKG_REL + 'Relationship':
+            target = element.get('Target', '')
+            if element.get('TargetMode') != 'External':
+                target = posixpath.normpath(posixpath.join(directory, target))
+            rels[element.get('Id')] = (element.get('Type'), target)
+    return rels
+
+
+def slide_part_names(package):
+    """按簡報順序返回投影片的 part 名稱"""
+    rels = _read_rels(package, 'ppt/presentation.xml')
+    names = []
+    with package.open('ppt/presentation.xml') as stream:
+        for _, element in iterparse(stream):
+            if element.tag == P + 'sldId':
+                rel = rels.get(element.get(R + 'id'))
+                if rel:
+                    names.append(rel[1])
+    return names
+
+
+def _paragraph_text(paragraph):
+    """與 python-pptx 相同：換行 (a:br) 轉為垂直定位字元"""
+    pieces = []
+    for element in paragraph.iter():
+        if element.tag == A + 't' and element.text:
+            pieces.append(element.text)
+        elif element.tag == A + 'br':
+            pieces.append('\v')
+    return ''.join(pieces)
+
+
+def _text_body(element):
+    """文字框 (p:txBody / a:txBody) 的文字，段落以換行分隔"""
+    return '\n'.join(_paragraph_text(p) for p in element.iter(A + 'p'))
+
+
+def _table_text(table):
+    rows = []
+    for row in table.iter(A + 'tr'):
+        cells = [' '.join(_text_body(cell).split()) for cell in row.iter(A + 'tc')]
+        rows.append(CELL_SEPARATOR.join(cells))
+    return '\n'.join(rows)
+
+
+def _iter_slide_shapes(container, depth=1):
+    """
+    按閱讀順序產出投影片中的 ('text', 文字) / ('picture', 圖片關聯 ID)
+
+    只有直接位於 spTree 下的圖片計為 'picture'（與 ImageExtractor 的圖片編號一致），
+    群組內的圖片不產生標記；群組內形狀的文字照常輸出。
+    """
+    for element in container:
+        tag = element.tag
+        if tag == P + 'sp':
+            body = element.find(P + 'txBody')
+            if body is not None:
+                text = _text_body(body)
+                if text.strip():
+                    yield 'text', text
+        elif tag == P + 'pic':
+            if depth == 1:
+                blip = element.find(f'{P}blipFill/{A}blip')
+                yield 'picture', blip.get(R + 'embed') if blip is not None else None
+        elif tag == P + 'grpSp':
+            yield from _iter_slide_shapes(element, depth + 1)
+        elif tag == P + 'graphicFrame':
+            table = element.find(f'.//{A}tbl')
+            if table is not None:
+                text = _table_text(table)
+                if text.strip():
+                    yield 'text', text
+
+
+def _notes_text(package, notes_part):
+    """備註頁中正文佔位符的文字"""
+    lines = []
+    with package.open(notes_part) as stream:
+        for _, element in iterparse(stream):
+            if element.tag == P + 'sp':
+                placeholder = element.find(f'.//{P}ph')
+                body = element.find(P + 'txBody')
+                if placeholder is not None and placeholder.get('type') == 'body' and body is not None:
+                    text = _text_body(body)
+                    if text.strip():
+                        lines.append(text)
+                element.clear()
+    return '\n'.join(lines)
+
+
+def _slide_text(package, part_name, slide_idx, include_image_markers, include_slide_markers, include_notes):
+    """
+    提取一張投影片
+
+    Returns:
+        tuple: (投影片文字或 None, 圖片列表)，圖片列表按編號順序記錄每張圖片的媒體 part 名稱
+               （外部連結的圖片沒有內容，記為 None）
+    """
+    slide_text = []
+    pictures = []
+    # 單張投影片的 XML 很小，整份交給 C 解析器一次解析比逐事件處理更快
+    tree = XML(package.read(part_name)).find(f'{P}cSld/{P}spTree')
+    for kind, value in _iter_slide_shapes(tree if tree is not None else ()):
+        if kind == 'picture':
+            pictures.append(value)
+            if include_image_markers:
+                number = len(pictures)
+                slide_text.append(f"\n[圖片 {slide_idx}-{number}: 來自投影片 {slide_idx}]\n")
+        else:
+            slide_text.append(value)
+
+    rels = _read_rels(package, part_name) if pictures or include_notes else {}
+    pictures = [rels[rel_id][1] if rel_id in rels else None for rel_id in pictures]
+    if include_notes:
+        for rel_type, target in rels.values():
+            if rel_type == NOTES_REL_TYPE:
+                notes = _notes_text(package, target)
+                if notes:
+                    slide_text.append(f"備註：{notes}")
+
+    if not slide_text:
+        return None, pictures
+    if include_slide_markers:
+        slide_text.insert(0, f"[投影片 {slide_idx}]")
+    return '\n'.join(slide_text), pictures
+
+
+def _extract_slide_range(file_path, slides, options):
+    """提取一組投影片 [(序號, part 名稱)]（在子進程中執行，需為模組層級函數）"""
+    with zipfile.ZipFile(file_path) as package:
+        return [_slide_text(package, name, index, *options) for index, name in slides]
+
+
+def extract_pptx_text(file_path, include_image_markers=False, include_slide_markers=False,
+                      include_notes=True, workers=None):
+    """
+    提取 PPTX 文字，輸出格式與 FileProcessor.extract_text_from_pptx 相同
+
+    Args:
+        include_notes: 是否附加投影片備註
+        workers: 並行解析的進程數，None 時投影片數達到 PARALLEL_MIN_SLIDES 才使用 CPU 核心數並行
+
+    Returns:
+        tuple: (text, image_count)
+    """
+    with zipfile.ZipFile(file_path) as package:
+        slides = list(enumerate(slide_part_names(package), start=1))
+
+    options = (include_image_markers, include_slide_markers, include_notes)
+    if workers is None:
+        workers = (os.cpu_count() or 1) if len(slides) >= PARALLEL_MIN_SLIDES else 1
+    workers = max(1, min(workers, len(slides)))
+
+    if workers == 1:
+        results = _extract_slide_range(file_path, slides, options)
+    else:
+        # 每個進程分到數段連續的投影片，按順序拼接
+        chunk_size = max(1, -(-len(slides) // (workers * 4)))
+        pool = get_process_pool(workers)
+        futures = [pool.submit(_extract_slide_range, file_path, slides[start:start + chunk_size], options)
+                   for start in range(0, len(slides), chunk_size)]
+        results = [result for future in futures for result in future.result()]
+
+    text = '\n\n'.join(slide for slide, _ in results if slide)
+    return text, sum(len(pictures) for _, pictures in results)
+
+
+def image_extension(part_name):
+    """圖片文件的副檔名（與 python-pptx 的 Image.ext 相同，例如 jpeg 統一為 jpg）"""
+    ext = posixpath.splitext(part_name)[1].lower().lstrip('.')
+    return IMAGE_EXTENSION_ALIASES.get(ext, ext)
+
+
+def _write_blob(path, blob):
+    with open(path, 'wb') as f:
+        f.write(blob)
+
+
+def _image_info(data, size=None):
+    """圖片的位元組數與像素尺寸（只解析標頭；無法識別的格式尺寸為 None）"""
+    info = {'bytes': len(data) if size is None else size, 'width': None, 'height': None}
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            info['width'], info['height'] = img.size
+    except (OSError, ValueError, Image.DecompressionBombError):
+        pass
+    return info
+
+
+def _peek_image_info(package, media):
+    """不讀取整個媒體部件，只解壓開頭部分解析標頭"""
+    with package.open(media) as stream:
+        head = stream.read(IMAGE_HEADER_PEEK_BYTES)
+    return _image_info(head, package.getinfo(media).file_size)
+
+
+def ingest_pptx(file_path, image_folder, include_slide_markers=True, include_notes=True, io_workers=4, store=None,
+                lazy=False):
+    """
+    單次解析 PPTX：同時產生含圖片標記的文字與圖片文件
+
+    圖片標記與圖片文件名在同一次遍歷中編號（[圖片 N-K] 對應 slide_N_image_K.ext），
+    圖片內容由線程池並行寫入 image_folder（有圖片時才建立）。每個媒體部件只讀取一次。
+    傳入 store (ImageStore) 時改為存入圖片存放區（相同內容只寫入一次），
+    圖片的 path 指向存放區中的物件，並附上 sha256。
+    lazy=True 時不讀取圖片內容，path 為 None，只以 part（zip 中的媒體部件名稱）記錄圖片位置。
+    所有模式都附上圖片的位元組數與像素尺寸 (bytes / width / height)，版面配置不需再開啟圖片。
+
+    Returns:
+        dict: {"text": 含圖片標記的文字, "image_count": 圖片數,
+               "images": [{'slide', 'index', 'path', 'filename', 'marker', 'ext', 'part',
+                           'bytes', 'width', 'height'}]}
+    """
+    texts = []
+    images = []
+    image_count = 0
+    media_info = {}  # 媒體部件 → {'bytes', 'width', 'height'}
+    blobs = {}       # 媒體部件 → 內容（寫入 image_folder 時使用）
+    stored = {}      # 媒體部件 → 存入存放區的 future
+    if lazy:
+        store = None
+    with zipfile.ZipFile(file_path) as package, ThreadPoolExecutor(max_workers=io_workers) as writer:
+        futures = []
+        for slide_idx, part_name in enumerate(slide_part_names(package), start=1):
+            text, pictures = _slide_text(package, part_name, slide_idx, True, include_slide_markers, include_notes)
+            if text:
+                texts.append(text)
+            image_count += len(pictures)
+            for number, media in enumerate(pictures, start=1):
+                if media is None:
+                    continue
+                ext = f".{image_extension(media)}"
+                filename = f"slide_{slide_idx}_image_{number}{ext}"
+
+                # 同一媒體部件可能被多張投影片引用（例如 logo），只讀取一次
+                if media not in media_info:
+                    if lazy:
+                        media_info[media] = _peek_image_info(package, media)
+                    else:
+                        # zip 檔案代碼不可跨線程共用，在此讀取內容後交給線程池寫入
+                        blob = package.read(media)
+                        media_info[media] = _image_info(blob)
+                        if store is not None:
+                            stored[media] = writer.submit(store.put, blob, ext)
+                        else:
+                            blobs[media] = blob
+
+                image = {
+                    'slide': slide_idx,
+                    'index': number,
+                    'path': os.path.join(image_folder, filename),
+                    'filename': filename,
+                    'marker': f"[圖片 {slide_idx}-{number}]",
+                    'ext': ext,
+                    'part': media,
+                    **media_info[media]
+                }
+                if lazy:
+                    image['path'] = None
+                elif store is None:
+                    if not images:
+                        os.makedirs(image_folder, exist_ok=True)
+                    futures.append(writer.submit(_write_blob, image['path'], blobs[media]))
+                images.append(image)
+        for future in futures:
+            future.result()
+        if store is not None:
+            for image in images:
+                image['sha256'], image['path'], _ = stored[image['part']].result()
+
+    return {"text": '\n\n'.join(texts), "image_count": image_count, "images": images}
@@ -6,10 +6,15 @@ import os
 from pptx import Presentation
 from pptx.util import Inches, Pt
 from PIL import Image
+from .image_optimizer import get_image_optimizer
 
 
 class PPTXInjector:
     """PowerPoint 圖片注入器"""
+
+    # 圖片放置區域佔簡報寬 / 高的比例（右側 45% 寬度、70% 高度）
+    MAX_WIDTH_RATIO = 0.45
+    MAX_HEIGHT_RATIO = 0.7
     
     @staticmethod
     def inject_images(pptx_path, injections, output_path=None):
@@ -28,6 +33,7 @@ class PPTXInjector:
         prs = Presentation(pptx_path)
         
         # 處理每個注入請求
+        targets = []
         for injection in injections:
             image_path = injection.get('image_path')
             slide_number = injection.get('slide_number')
@@ -46,9 +52,15 @@ class PPTXInjector:
                 continue
             
             # 獲取目標 Slide (索引從 0 開始)
-            slide = prs.slides[slide_number - 1]
-            
-            # 插入圖片
+            targets.append((prs.slides[slide_number - 1], image_path))
+        
+        # 按放置區域的大小並行縮小 / 重新壓縮圖片後插入
+        max_width = prs.slide_width * PPTXInjector.MAX_WIDTH_RATIO
+        max_height = prs.slide_height * PPTXInjector.MAX_HEIGHT_RATIO
+        optimized = get_image_optimizer().optimize_many(
+            [(image_path, max_width, max_height) for _, image_path in targets]
+        )
+        for (slide, _), image_path in zip(targets, optimized):
             PPTXInjector._insert_image_to_slide(slide, image_path, prs.slide_width, prs.slide_height)
         
         # 生成輸出路徑
@@ -83,8 +95,8 @@ class PPTXInjector:
         
         # 計算圖片放置位置和大小
         # 目標：放置在右側 50% 區域，保持比例
-        max_width = slide_width * 0.45  # 右側 45% 寬度
-        max_height = slide_height * 0.7  # 70% 高度
+        max_width = slide_width * PPTXInjector.MAX_WIDTH_RATIO  # 右側 45% 寬度
+        max_height = slide_height * PPTXInjector.MAX_HEIGHT_RATIO  # 70% 高度
         
         # 計算縮放比例
         width_ratio = max_width / img_width
@@ -0,0 +1,334 @@
+"""
+Prompt Registry
+集中管理各文檔類型的定義與 Prompt 模板：
+- Prompt 模板在載入時預先切分為固定文字與欄位，構建時只以一次 join 拼接所選文檔類型的 Prompt
+- Profile (角色設定) 文件載入後快取在記憶體中，按修改時間 (mtime) 自動重新載入，請求路徑上不讀取磁碟
+"""
+import os
+import time
+import threading
+from string import Formatter
+
+
+# Profile 之後的分隔線，確保 AI 區分角色設定與具體指令
+PROFILE_SEPARATOR = "\n\n=== Role Definition End ===\n\n"
+
+# 文檔生成的 Prompt 模板，欄位：profile / template / requirements
+GENERATION_PROMPTS = {
+    "system_doc": """
+{profile}
+請根據以下模板結構和用戶需求，生成一份專業的系統文檔。
+
+模板內容：
+{template}
+
+用戶需求：
+{requirements}
+
+要求：
+1. 保持專業的技術文檔風格
+2. 包含系統架構、功能模組、技術棧等內容
+3. 確保文檔結構清晰、邏輯嚴謹
+4. 使用標準的技術術語
+5. 根據模板格式調整輸出格式
+6. 請生成完整的系統文檔內容，使用Markdown格式輸出。
+            """,
+    "sop": """
+{profile}
+請根據以下模板結構和用戶需求，生成一份標準作業程序(SOP)文檔。
+
+模板內容：
+{template}
+
+用戶需求：
+{requirements}
+
+要求：
+1. 步驟清晰明確
+2. 包含目的、範圍、職責、流程圖（文字描述）、詳細步驟
+3. 注意事項和異常處理
+4. 語言簡練、指令性強
+5. 根據模板格式調整輸出格式
+6. 請生成完整的SOP內容，使用Markdown格式輸出。
+            """,
+    "tech_report": """
+{profile}
+請根據以下模板結構和用戶需求，生成一份技術分析報告。
+
+模板內容：
+{template}
+
+用戶需求：
+{requirements}
+
+要求：
+1. 數據準確、分析深入
+2. 包含背景、方法、結果、結論等部分
+3. 圖表說明清晰
+4. 技術細節完整
+5. 根據模板格式調整輸出格式
+6. 請生成完整的技術報告內容，使用Markdown格式輸出。
+            """,
+    "sop_optimize": """
+{profile}
+你是一位專業的 SOP 文檔優化專家。請將以下舊的 SOP 文檔優化為統一、專業的標準作業程序。
+
+=== 原始 SOP 內容 ===
+{requirements}
+
+=== 參考模板風格 ===
+{template}
+
+=== 優化要求 ===
+
+**1. 內容處理原則**：
+- **保留所有關鍵信息**：所有操作步驟、設定值、路徑、注意事項都必須保留
+- **保留所有圖片標記**：格式為 [圖片 X-Y: 來自投影片 Z]，必須完整保留
+- **允許合理整合**：可以整合重複或相似的內容，使文檔更簡潔
+- **保留業務邏輯**：確保所有業務流程和邏輯關係都清晰呈現
+
+**2. 圖片標記處理**：
+- 所有 [圖片 X-Y: 來自投影片 Z] 標記必須保留
+- 圖片標記應放在相關內容的適當位置
+- 不要刪除任何圖片標記
+- [投影片 N] 是原始投影片的分隔標記，僅供參考，不要輸出
+
+**3. 格式優化**：
+- 參考模板的章節結構（目的、範圍、職責、流程等）
+- 使用清晰的標題層級（#, ##, ###）
+- 使用列表和表格提高可讀性
+- 統一術語和表達方式
+
+**4. 內容組織**：
+- 將內容按照標準 SOP 結構重新組織
+- 合併重複的說明，但保留所有獨特的信息
+- 確保邏輯清晰、步驟連貫
+- 使用適當的章節劃分
+
+**5. 語言優化**：
+- 使用專業、簡練的語言
+- 統一術語
+- 改善可讀性
+- 消除冗餘表達
+
+**輸出格式**：
+- 使用 Markdown 格式
+- 清晰的標題層級
+- 適當使用列表和表格
+
+請生成優化後的 SOP 文檔，確保所有關鍵信息和圖片標記都被保留。
+            """,
+}
+
+# 需求優化的 Prompt 模板，欄位：profile / role / requirements
+OPTIMIZE_PROMPTS = {
+    "sop": """
+{profile}
+{role}
+輸出語言：繁體中文。
+
+請依照我提供的功能模組，產生標準 SOP 文件。
+
+規則：
+1. SOP 請保持明確、實務、不要誇大或補造不存在的功能。
+2. 每段 SOP 都需包含以下章節：
+   (A) 作業目的
+   (B) 使用角色
+   (C) 系統流程圖（文字描述即可）
+   (D) 作業流程步驟（逐步條列）
+   (E) 異常處理 / 錯誤訊息處理
+   (F) 注意事項
+3. 若流程中涉及 UI 操作，請加入畫面邏輯（例如：點選「新增報價」、輸入欄位、按下儲存）。
+4. 內容需保持一致性、準確描述流程，不可幻想不存在的系統功能。
+5. 使用 Markdown 格式輸出。
+
+原始需求：
+{requirements}
+
+請依照上述規則，產生標準 SOP 文件：""",
+    "system_doc": """
+{profile}
+請優化以下系統文檔的需求描述，使其更加清晰、完整、專業。
+
+原始需求：
+{requirements}
+
+請提供優化後的需求描述，要求：
+1. 補充系統架構資訊（前端、後端、資料庫）
+2. 明確功能模組劃分
+3. 列出技術棧需求
+4. 包含部署和維護說明
+5. 使用專業術語，結構清晰
+6. 使用 Markdown 格式輸出
+
+優化後的需求描述：""",
+    "technical_report": """
+{profile}
+請優化以下技術報告的需求描述，使其更加清晰、完整、專業。
+
+原始需求：
+{requirements}
+
+請提供優化後的需求描述，要求：
+1. 補充背景資訊和問題陳述
+2. 列出技術方案和分析方法
+3. 包含數據分析和實施細節
+4. 提供結論和建議
+5. 使用專業術語，結構清晰
+6. 使用 Markdown 格式輸出
+
+優化後的需求描述：""",
+    "default": """
+{profile}
+請優化以下需求描述，使其更加清晰、完整、專業。
+
+原始需求：
+{requirements}
+
+請提供優化後的需求描述，要求：
+1. 保持原意，補充必要的細節
+2. 使用專業術語
+3. 結構清晰，分點說明
+4. 使用 Markdown 格式輸出
+
+優化後的需求描述：""",
+}
+
+# 沒有 Profile 時 SOP 需求優化使用的角色設定
+DEFAULT_SOP_ROLE = "你現在是一位企業內部系統的 SOP 工程師，熟悉採購/廠商報價/審核流程。"
+
+
+class DocType:
+    """一種可生成的文檔類型"""
+
+    __slots__ = ('id', 'name', 'title', 'profile')
+
+    def __init__(self, id, name, title, profile):
+        self.id = id
+        self.name = name
+        self.title = title
+        self.profile = profile
+
+
+DOC_TYPES = {
+    doc_type.id: doc_type for doc_type in (
+        DocType('system_doc', "系統文檔", "系統設計文檔", 'SYS_PROFILE.md'),
+        DocType('sop', "SOP標準作業程序", "標準作業程序(SOP)", 'PTT_PROFILE.md'),
+        DocType('tech_report', "技術報告", "技術分析報告", 'SYS_PROFILE.md'),
+        DocType('sop_optimize', "SOP優化", "SOP優化文檔", 'PTT_PROFILE.md'),
+    )
+}
+
+# 不在 DOC_TYPES 中的文檔類型（例如只用於需求優化的類型）使用的 Profile
+DEFAULT_PROFILE = 'SYS_PROFILE.md'
+
+
+class CompiledPrompt:
+    """預先切分的 Prompt 模板 - 固定文字與欄位交錯，構建時以一次 join 拼接"""
+
+    __slots__ = ('pieces', 'fields')
+
+    def __init__(self, template):
+        pieces = []
+        for literal, field, _, _ in Formatter().parse(template):
+            if literal:
+                pieces.append((literal, None))
+            if field is not None:
+                pieces.append((None, field))
+        self.pieces = tuple(pieces)
+        self.fields = frozenset(field for _, field in self.pieces if field)
+
+    def render(self, **values):
+        return ''.join(literal if field is None else str(values.get(field) or '')
+                       for literal, field in self.pieces)
+
+
+class ProfileLoader:
+    """Profile 文件快取（每個進程一份，可跨線程共用）"""
+
+    def __init__(self, folder, reload_interval=2.0, clock=time.monotonic):
+        """
+        Args:
+            folder: Profile 文件所在目錄
+            reload_interval: 最短多久檢查一次文件修改時間（秒），0 表示每次都檢查
+        """
+        self.folder = folder
+        self.reload_interval = reload_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        # 文件名 -> (mtime, 內容, 上次檢查時間)
+        self._entries = {}
+
+    def get(self, filename):
+        """
+        返回 Profile 內容（已附加分隔線），文件不存在時返回空字串
+        """
+        now = self._clock()
+        entry = self._entries.get(filename)
+        if entry is not None and now - entry[2] < self.reload_interval:
+            return entry[1]
+
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and now - entry[2] < self.reload_interval:
+                return entry[1]
+            path = os.path.join(self.folder, filename)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if entry is not None and entry[0] == mtime:
+                self._entries[filename] = (mtime, entry[1], now)
+                return entry[1]
+
+            content = ''
+            if mtime is None:
+                print(f"[WARNING] Profile {filename} not found")
+            else:
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        content = f"{f.read()}{PROFILE_SEPARATOR}"
+                    print(f"[INFO] Loaded profile from {filename}")
+                except (OSError, UnicodeDecodeError) as e:
+                    print(f"[ERROR] Failed to read profile: {e}")
+            self._entries[filename] = (mtime, content, now)
+            return content
+
+
+class PromptRegistry:
+    """文檔類型與 Prompt 模板登記處"""
+
+    def __init__(self, profile_loader, doc_types=None, generation_prompts=None, optimize_prompts=None):
+        self.profiles = profile_loader
+        self.doc_types = doc_types or DOC_TYPES
+        self._generation = {key: CompiledPrompt(text)
+                            for key, text in (generation_prompts or GENERATION_PROMPTS).items()}
+        self._optimize = {key: CompiledPrompt(text)
+                          for key, text in (optimize_prompts or OPTIMIZE_PROMPTS).items()}
+
+    def get(self, doc_type):
+        """返回 DocType，不支持時返回 None"""
+        return self.doc_types.get(doc_type)
+
+    def doc_config(self, doc_type):
+        """返回生成流程使用的文檔類型配置（name / title），不支持時返回 None"""
+        definition = self.get(doc_type)
+        if definition is None:
+            return None
+        return {"name": definition.name, "title": definition.title}
+
+    def profile(self, doc_type):
+        """返回該文檔類型的 Profile 內容"""
+        definition = self.get(doc_type)
+        return self.profiles.get(definition.profile if definition else DEFAULT_PROFILE)
+
+    def build(self, doc_type, profile, template, requirements):
+        """構建文檔生成的 Prompt"""
+        return self._generation[doc_type].render(profile=profile, template=template, requirements=requirements)
+
+    def build_optimize(self, doc_type, requirements):
+        """構建需求優化的 Prompt"""
+        profile = self.profile(doc_type)
+        compiled = self._optimize.get(doc_type) or self._optimize['default']
+        role = '' if profile else DEFAULT_SOP_ROLE
+        return compiled.render(profile=profile, role=role, requirements=requirements)
@@ -0,0 +1,78 @@
+"""
+LLM Provider Clients
+保存可重用的供應商客戶端：HTTP keep-alive 連線池與按 (模型, 生成參數) 快取的 Gemini 模型，
+避免每次調用都重新握手或重新建立客戶端。
+"""
+import json
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+import google.generativeai as genai
+
+
+class ProviderClients:
+    """供應商客戶端池（每個 worker 進程一份，可跨線程共用）"""
+
+    def __init__(self, connect_timeout=10, read_timeout=120, pool_maxsize=32):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_maxsize = pool_maxsize
+        self._lock = threading.Lock()
+        self._session = None
+        self._gemini_api_key = None
+        self._gemini_models = {}
+
+    @property
+    def timeout(self):
+        """requests 使用的 (連線, 讀取) 超時"""
+        return (self.connect_timeout, self.read_timeout)
+
+    def http_session(self):
+        """
+        取得共用的 HTTP Session
+
+        urllib3 的連線池是線程安全的，多個線程共用同一個 Session 可以重用 TCP/TLS 連線。
+        """
+        session = self._session
+        if session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_maxsize)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                session = self._session
+        return session
+
+    def gemini_model(self, api_key, model_name, generation_config):
+        """
+        取得 (模型, 生成參數) 對應的 Gemini 模型，首次使用時建立
+
+        genai.configure 是進程級設定，只在 API Key 變更時重新調用。
+        """
+        config_key = (model_name, json.dumps(generation_config, sort_keys=True))
+        with self._lock:
+            if api_key != self._gemini_api_key:
+                genai.configure(api_key=api_key)
+                self._gemini_api_key = api_key
+                self._gemini_models = {}
+
+            model = self._gemini_models.get(config_key)
+            if model is None:
+                model = genai.GenerativeModel(
+                    model_name=model_name,
+                    generation_config=generation_config,
+                )
+                self._gemini_models[config_key] = model
+        return model
+
+    def reset(self):
+        """關閉連線並丟棄所有客戶端（憑證變更時調用）"""
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._gemini_api_key = None
+            self._gemini_models = {}
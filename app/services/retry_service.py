@@ -0,0 +1,260 @@
+"""
+Retry & Rate Limiting Service
+所有 LLM 供應商共用的重試與限流引擎：
+- 分類可重試的錯誤（429、5xx、連線錯誤、超時）
+- 遵守 Retry-After 及供應商的限流重置標頭
+- 指數退避 + 抖動，並限制整體截止時間
+- 客戶端令牌桶，按供應商 / 模型限制每分鐘請求數與 token 數
+"""
+import re
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+import requests
+
+try:
+    from google.api_core import exceptions as google_exceptions
+    GOOGLE_API_CORE_AVAILABLE = True
+except ImportError:
+    GOOGLE_API_CORE_AVAILABLE = False
+
+
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class ProviderHTTPError(Exception):
+    """供應商返回非 2xx 響應"""
+
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class RateLimitTimeout(Exception):
+    """在截止時間內無法取得限流配額"""
+
+
+def _parse_duration(value):
+    """解析 OpenAI 限流重置時間格式，例如 '1s'、'6m0s'、'20ms'、'0.5'"""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    matched = False
+    for amount, unit in re.findall(r'([\d.]+)(ms|h|m|s)', value):
+        matched = True
+        amount = float(amount)
+        total += {'ms': amount / 1000, 's': amount, 'm': amount * 60, 'h': amount * 3600}[unit]
+    return total if matched else None
+
+
+def parse_retry_after(headers):
+    """
+    從響應標頭中解析建議的等待秒數
+
+    支援 Retry-After（秒數或 HTTP 日期）、retry-after-ms，
+    以及 OpenAI 的 x-ratelimit-reset-requests / x-ratelimit-reset-tokens。
+
+    Returns:
+        float 或 None
+    """
+    if not headers:
+        return None
+
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get('Retry-After')
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    resets = []
+    for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens'):
+        value = headers.get(name)
+        if value:
+            seconds = _parse_duration(value)
+            if seconds is not None:
+                resets.append(seconds)
+    return max(resets) if resets else None
+
+
+def classify_error(exc):
+    """
+    判斷錯誤是否可重試
+
+    Returns:
+        tuple: (retryable, retry_after)
+    """
+    if isinstance(exc, ProviderHTTPError):
+        return exc.status_code in RETRYABLE_STATUS_CODES, exc.retry_after
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True, None
+    if GOOGLE_API_CORE_AVAILABLE:
+        if isinstance(exc, (google_exceptions.TooManyRequests,
+                            google_exceptions.ResourceExhausted,
+                            google_exceptions.ServiceUnavailable,
+                            google_exceptions.InternalServerError,
+                            google_exceptions.DeadlineExceeded)):
+            return True, None
+        if isinstance(exc, google_exceptions.GoogleAPICallError):
+            return getattr(exc, 'code', None) in RETRYABLE_STATUS_CODES, None
+    return False, None
+
+
+class RetryPolicy:
+    """指數退避重試策略（full jitter），受整體截止時間限制"""
+
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=30.0, deadline=180.0,
+                 sleep=time.sleep, clock=time.monotonic):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self._sleep = sleep
+        self._clock = clock
+
+    def backoff(self, attempt, retry_after=None):
+        """第 attempt 次失敗後（從 1 開始）應等待的秒數"""
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        delay = random.uniform(0, ceiling)
+        if retry_after is not None:
+            # 伺服器明確要求的等待時間優先，並加上少量抖動避免同時重試
+            delay = retry_after + random.uniform(0, self.base_delay)
+        return delay
+
+    def call(self, fn, on_retry=None):
+        """
+        執行 fn，遇到可重試錯誤時退避後重試
+
+        Args:
+            fn: 接收關鍵字參數 deadline（clock 時間，None 表示不限）的函數
+            on_retry: 可選回調 on_retry(attempt, exc, delay)
+
+        Raises:
+            最後一次失敗的異常
+        """
+        deadline = self._clock() + self.deadline if self.deadline else None
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return fn(deadline=deadline)
+            except Exception as exc:
+                retryable, retry_after = classify_error(exc)
+                if not retryable or attempt >= self.max_attempts:
+                    raise
+                delay = self.backoff(attempt, retry_after)
+                if deadline is not None and self._clock() + delay > deadline:
+                    raise
+                if on_retry:
+                    on_retry(attempt, exc, delay)
+                self._sleep(delay)
+
+
+class TokenBucket:
+    """令牌桶 - capacity 為每分鐘配額，按比例連續補充"""
+
+    def __init__(self, per_minute, clock=time.monotonic):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self._tokens = self.capacity
+        self._clock = clock
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount):
+        """
+        預約 amount 個令牌（允許透支），返回需要等待的秒數
+
+        單次請求超過桶容量時按容量計算，避免永遠無法通過。
+        """
+        amount = min(float(amount), self.capacity)
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def refund(self, amount):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + min(float(amount), self.capacity))
+
+
+class RateLimiter:
+    """
+    客戶端限流器 - 按供應商 / 模型限制每分鐘請求數 (rpm) 與 token 數 (tpm)
+
+    limits 範例：{'openai:gpt-4o-mini': {'rpm': 500, 'tpm': 200000}, 'gemini': {'rpm': 15}}
+    查找順序為 'provider:model'、'provider'，都沒有配置時不限流。
+    """
+
+    def __init__(self, limits=None, sleep=time.sleep, clock=time.monotonic):
+        self.limits = limits or {}
+        self._sleep = sleep
+        self._clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _buckets_for(self, provider, model):
+        key = f"{provider}:{model}"
+        if key not in self.limits:
+            key = provider
+        limit = self.limits.get(key)
+        if not limit:
+            return None, None
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = (
+                    TokenBucket(limit['rpm'], self._clock) if limit.get('rpm') else None,
+                    TokenBucket(limit['tpm'], self._clock) if limit.get('tpm') else None,
+                )
+            return self._buckets[key]
+
+    def acquire(self, provider, model, tokens=0, deadline=None):
+        """
+        等待直到請求數與 token 配額都可用
+
+        Raises:
+            RateLimitTimeout: 等待時間會超過截止時間
+        """
+        request_bucket, token_bucket = self._buckets_for(provider, model)
+        if request_bucket is None and token_bucket is None:
+            return 0.0
+
+        wait = 0.0
+        if request_bucket:
+            wait = max(wait, request_bucket.reserve(1))
+        if token_bucket and tokens:
+            wait = max(wait, token_bucket.reserve(tokens))
+
+        if wait > 0:
+            if deadline is not None and self._clock() + wait > deadline:
+                # 放棄本次請求，歸還預約的配額
+                if request_bucket:
+                    request_bucket.refund(1)
+                if token_bucket and tokens:
+                    token_bucket.refund(tokens)
+                raise RateLimitTimeout(f"{provider}:{model} 已達客戶端限流上限，需等待 {wait:.1f} 秒")
+            self._sleep(wait)
+        return wait
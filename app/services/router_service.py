@@ -0,0 +1,389 @@
+"""
+Provider Router
+在多個 LLM 供應商 / 模型之間路由請求，保護尾延遲：
+- 每個目標一個熔斷器：連續失敗或連續超出延遲 SLO 時打開，冷卻後半開試探並自動恢復
+- 對沖請求：主目標在 p95 延遲內沒有返回時，同時向下一個目標發出請求，採用最先成功的結果
+- 故障轉移：主目標失敗或熔斷時立即改用下一個目標
+"""
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .retry_service import classify_error
+
+
+class NoAvailableProviderError(Exception):
+    """所有目標的熔斷器都處於打開狀態"""
+
+
+def is_provider_failure(exc):
+    """
+    錯誤是否反映供應商故障：只有暫時性或伺服器端錯誤計入熔斷器，請求本身無效（4xx）不計入
+
+    供應商調用把原始錯誤包裝為 Exception，因此沿 __cause__ / __context__ 檢查原始錯誤。
+    """
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        retryable, _ = classify_error(exc)
+        status = getattr(exc, 'status_code', None) or getattr(exc, 'code', None)
+        if retryable or (isinstance(status, int) and status >= 500):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+class CircuitBreaker:
+    """熔斷器 - closed（正常）→ open（拒絕請求）→ half_open（放行一個試探請求）"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=3, slo_seconds=None, slo_breaches=3, reset_timeout=30.0,
+                 clock=time.monotonic):
+        """
+        Args:
+            failure_threshold: 連續失敗多少次後打開
+            slo_seconds: 延遲 SLO，成功但超過此時間視為一次 SLO 違反（None 表示不檢查）
+            slo_breaches: 連續違反 SLO 多少次後打開
+            reset_timeout: 打開後多久進入半開狀態（秒）
+        """
+        self.failure_threshold = max(1, failure_threshold)
+        self.slo_seconds = slo_seconds
+        self.slo_breaches = max(1, slo_breaches)
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._breaches = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """是否放行一次請求；半開狀態同時只放行一個試探請求"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if self._clock() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def _open(self):
+        self._state = self.OPEN
+        self._opened_at = self._clock()
+        self._trial_in_flight = False
+
+    def record_success(self, latency=None):
+        with self._lock:
+            self._failures = 0
+            breached = self.slo_seconds is not None and latency is not None and latency > self.slo_seconds
+            if self._state == self.HALF_OPEN:
+                # 試探請求成功即恢復；仍然過慢則繼續打開
+                if breached:
+                    self._open()
+                else:
+                    self._state = self.CLOSED
+                    self._breaches = 0
+                    self._trial_in_flight = False
+                return
+            if breached:
+                self._breaches += 1
+                if self._breaches >= self.slo_breaches:
+                    self._open()
+            else:
+                self._breaches = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._open()
+
+    def snapshot(self):
+        return {"state": self.state, "consecutive_failures": self._failures, "slo_breaches": self._breaches}
+
+
+class LatencyWindow:
+    """最近 N 次成功請求的延遲，用於計算對沖閾值"""
+
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction, min_samples=1):
+        """返回延遲的分位數，樣本不足時返回 None"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < max(1, min_samples):
+            return None
+        index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+        return samples[index]
+
+
+class ProviderRouter:
+    """供應商路由器（每個進程一份，可跨線程共用）"""
+
+    def __init__(self, hedge_percentile=0.95, hedge_min_samples=20, hedge_default_delay=30.0,
+                 hedge_min_delay=2.0, hedge_max_delay=60.0, failure_threshold=3, slo_seconds=None,
+                 slo_breaches=3, reset_timeout=30.0, max_workers=16, clock=time.monotonic):
+        """
+        Args:
+            hedge_percentile: 以主目標延遲的哪個分位數作為對沖閾值
+            hedge_min_samples: 樣本少於此數時使用 hedge_default_delay
+            hedge_min_delay / hedge_max_delay: 對沖閾值的上下限（秒），hedge_default_delay 為 None 時不對沖
+            max_workers: 多目標調用的線程池大小（只有一個目標時在調用方線程直接執行）
+            其餘參數見 CircuitBreaker
+        """
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self._breaker_options = {
+            "failure_threshold": failure_threshold,
+            "slo_seconds": slo_seconds,
+            "slo_breaches": slo_breaches,
+            "reset_timeout": reset_timeout,
+            "clock": clock,
+        }
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self._latencies = {}
+        # 落後的對沖請求無法取消，由獨立線程池執行完畢，不佔用調用方線程
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='llm-route')
+
+    @staticmethod
+    def target_name(target):
+        return f"{target['api_type']}:{target.get('model') or ''}"
+
+    def breaker(self, target):
+        name = self.target_name(target)
+        with self._lock:
+            if name not in self._breakers:
+                self._breakers[name] = CircuitBreaker(**self._breaker_options)
+                self._latencies[name] = LatencyWindow()
+            return self._breakers[name]
+
+    def latency(self, target):
+        self.breaker(target)
+        return self._latencies[self.target_name(target)]
+
+    def hedge_delay(self, target):
+        """主目標在此時間內沒有返回時發出對沖請求"""
+        observed = self.latency(target).percentile(self.hedge_percentile, self.hedge_min_samples)
+        if observed is None:
+            return self.hedge_default_delay
+        return min(self.hedge_max_delay, max(self.hedge_min_delay, observed))
+
+    def record(self, target, latency=None, error=None):
+        """記錄一次請求結果（串流等不經過 call 的請求也應記錄）"""
+        if error is None:
+            self.breaker(target).record_success(latency)
+            if latency is not None:
+                self.latency(target).add(latency)
+        elif is_provider_failure(error):
+            self.breaker(target).record_failure()
+
+    def pick(self, targets):
+        """返回第一個熔斷器允許的目標，全部熔斷時返回 None（不對沖的調用使用，例如串流）"""
+        for target in targets:
+            if self.breaker(target).allow():
+                return target
+        return None
+
+    def _run(self, target, fn):
+        started = self._clock()
+        try:
+            result = fn(target)
+        except Exception as e:
+            self.record(target, error=e)
+            raise
+        self.record(target, self._clock() - started)
+        return result
+
+    def call(self, targets, fn):
+        """
+        按順序嘗試目標，返回第一個成功的結果
+
+        Args:
+            targets: 目標列表，第一個為主目標，例如 [{'api_type': 'gemini', 'model': '...'}, ...]
+            fn: fn(target) 執行實際調用
+
+        Returns:
+            tuple: (result, target, hedged)，target 為實際返回結果的目標，hedged 表示曾發出對沖請求
+
+        Raises:
+            NoAvailableProviderError: 所有目標都已熔斷
+            最後一個失敗目標的異常
+        """
+        if len(targets) == 1:
+            # 沒有備用目標時不需要對沖，直接在調用方線程執行
+            target = targets[0]
+            if not self.breaker(target).allow():
+                raise NoAvailableProviderError(f"所有 LLM 供應商暫時不可用（熔斷中）: {self.target_name(target)}")
+            return self._run(target, fn), target, False
+
+        pending_targets = list(targets)
+        running = {}
+        started = {}
+        last_error = None
+        hedged = False
+
+        def launch():
+            # 熔斷器在真正發出請求時才檢查，避免佔用半開狀態的試探名額
+            while pending_targets:
+                target = pending_targets.pop(0)
+                if self.breaker(target).allow():
+                    event = threading.Event()
+                    future = self._executor.submit(lambda t=target, e=event: e.set() or self._run(t, fn))
+                    running[future] = target
+                    started[future] = event
+                    return True
+            return False
+
+        if not launch():
+            names = ', '.join(self.target_name(t) for t in targets)
+            raise NoAvailableProviderError(f"所有 LLM 供應商暫時不可用（熔斷中）: {names}")
+
+        while running:
+            primary_future, primary = next(iter(running.items()))
+            delay = None
+            if pending_targets:
+                # 在線程池中排隊的時間不計入對沖閾值
+                started[primary_future].wait()
+                delay = self.hedge_delay(primary)
+            done, _ = wait(list(running), timeout=delay, return_when=FIRST_COMPLETED)
+            if not done:
+                # 超過對沖閾值仍未返回：同時請求下一個目標
+                if launch():
+                    hedged = True
+                    print(f"[WARNING] {self.target_name(primary)} 超過 {delay:.1f} 秒未返回，已對沖至下一個供應商")
+                continue
+            for future in done:
+                target = running.pop(future)
+                try:
+                    return future.result(), target, hedged
+                except Exception as e:
+                    last_error = e
+                    print(f"[WARNING] {self.target_name(target)} 調用失敗: {e}")
+            if not running:
+                launch()
+        if last_error is None:
+            raise NoAvailableProviderError("所有 LLM 供應商暫時不可用（熔斷中）")
+        raise last_error
+
+    def stats(self):
+        """各目標的熔斷器狀態與延遲分位數"""
+        with self._lock:
+            names = list(self._breakers)
+        result = {}
+        for name in names:
+            window = self._latencies[name]
+            result[name] = dict(
+                self._breakers[name].snapshot(),
+                p50_seconds=window.percentile(0.5),
+                p95_seconds=window.percentile(0.95)
+            )
+        return result
+
+
+class ModelRoutingPolicy:
+    """
+    自適應模型選擇 - 短 prompt 改用同一供應商中觀測到最快的合適模型
+
+    只在同一供應商的候選模型之間選擇（共用憑證），並且只根據觀測資料改換模型：
+    配置的模型不在候選中、或它本身還沒有足夠的觀測資料時維持配置的模型；
+    錯誤率過高的模型不參與選擇，延遲相近（10% 內）時選擇成本較低者。
+    force（route='fast'）時沒有觀測資料也使用候選列表的第一個。
+    """
+
+    def __init__(self, telemetry, candidates=None, short_prompt_tokens=1500, min_samples=5,
+                 max_error_rate=0.2):
+        """
+        Args:
+            telemetry: Telemetry
+            candidates: 各供應商的候選模型，例如 {'openai': ['gpt-4o-mini', 'gpt-4o']}
+            short_prompt_tokens: 不超過此 token 數的 prompt 自動路由
+            min_samples: 模型至少需要多少次相近大小的成功調用才參與比較
+            max_error_rate: 錯誤率上限
+        """
+        self.telemetry = telemetry
+        self.candidates = candidates or {}
+        self.short_prompt_tokens = short_prompt_tokens
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+
+    def _observed(self, provider, model, prompt_tokens):
+        """相近大小的 prompt 在該模型上的 (p50 延遲, 每 1k token 成本)，資料不足時返回 None"""
+        records = self.telemetry.records(provider, model)
+        if not records:
+            return None
+        errors = sum(1 for r in records if r.error)
+        if errors / len(records) > self.max_error_rate:
+            return None
+        size_limit = max(self.short_prompt_tokens, prompt_tokens * 2)
+        similar = [r for r in records if not r.error and r.input_tokens <= size_limit]
+        if len(similar) < self.min_samples:
+            return None
+        latencies = sorted(r.latency for r in similar)
+        tokens = sum(r.input_tokens + r.output_tokens for r in similar)
+        cost = sum(r.cost for r in similar) / tokens * 1000 if tokens else 0.0
+        return latencies[len(latencies) // 2], cost
+
+    def _failing(self, provider, model):
+        """已有足夠樣本且錯誤率超過上限"""
+        records = self.telemetry.records(provider, model)
+        if len(records) < self.min_samples:
+            return False
+        return sum(1 for r in records if r.error) / len(records) > self.max_error_rate
+
+    def choose(self, provider, default_model, prompt_tokens, force=False):
+        """
+        返回應使用的模型
+
+        Args:
+            force: True 時不論 prompt 大小都選擇最快的模型（例如需求優化這類輕量任務）
+        """
+        candidates = self.candidates.get(provider)
+        if not candidates:
+            return default_model
+        if not force and (prompt_tokens > self.short_prompt_tokens or default_model not in candidates):
+            return default_model
+
+        scored = []
+        for model in candidates:
+            observed = self._observed(provider, model, prompt_tokens)
+            if observed is not None:
+                scored.append((observed[0], observed[1], model))
+        if not force:
+            # 配置的模型有足夠的觀測資料（或錯誤率過高）才有比較的依據
+            measured = any(model == default_model for _, _, model in scored)
+            if not scored or not (measured or self._failing(provider, default_model)):
+                return default_model
+        if not scored:
+            return candidates[0]
+
+        fastest = min(latency for latency, _, _ in scored)
+        near = [entry for entry in scored if entry[0] <= fastest * 1.1]
+        return min(near, key=lambda entry: (entry[1], entry[0]))[2]
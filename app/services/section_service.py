@@ -0,0 +1,501 @@
+"""
+Section Generation Service
+分段生成長文檔（map-reduce）：
+- 按標題把模板切分為章節，並產生所有章節共用的大綱
+- 以有限並發同時生成各章節，總耗時取決於最長的章節而非全文長度
+- 按模板順序拼接為一份 Markdown 文檔，並彙總 token 與成本
+- SOP 優化按投影片切分為窗口並發處理，逐段檢查圖片標記是否完整保留
+"""
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from .markdown_ast import IMAGE_MARKER_PATTERN
+
+
+# 模板標題的識別規則：(正則, 層級函數)
+HEADING_PATTERNS = [
+    # Markdown 標題：# 標題
+    (re.compile(r'^(#{1,6})\s+(?P<title>.+?)\s*#*$'), lambda m: len(m.group(1))),
+    # 第一章 / 第 2 節 / 第三部分
+    (re.compile(r'^第\s*[一二三四五六七八九十百零\d]+\s*[章部篇]\s*.*$'), lambda m: 1),
+    (re.compile(r'^第\s*[一二三四五六七八九十百零\d]+\s*節\s*.*$'), lambda m: 2),
+    # 一、目的
+    (re.compile(r'^[一二三四五六七八九十]+\s*[、.．]\s*\S.*$'), lambda m: 1),
+    # 1. 目的 / 1.2 範圍 / 3.1.4 細節
+    (re.compile(r'^(\d+(?:\.\d+)*)(?:[.、．]\s*|\s+)\S.*$'), lambda m: m.group(1).count('.') + 1),
+]
+
+# 超過此長度的行視為正文而非標題（避免把編號列表的長句誤判為標題）
+MAX_HEADING_LENGTH = 40
+# 標題骨架最多保留的標題數
+MAX_SKELETON_HEADINGS = 200
+
+# 各文檔類型的寫作重點，與整份生成的 Prompt 要求一致
+SECTION_GUIDELINES = {
+    'system_doc': "保持專業的技術文檔風格，使用標準的技術術語，涵蓋系統架構、功能模組、技術棧等相關內容",
+    'sop': "步驟清晰明確，語言簡練、指令性強，包含必要的注意事項和異常處理",
+    'tech_report': "數據準確、分析深入，技術細節完整，圖表說明清晰",
+}
+
+
+class Section:
+    """模板中的一個章節"""
+
+    def __init__(self, title, level, body=''):
+        self.title = title
+        self.level = level
+        self.body = body
+
+    @property
+    def text(self):
+        """章節的完整模板文字（含標題）"""
+        return f"{self.title}\n{self.body}".strip()
+
+
+class SectionGenerator:
+    """分段生成器 - 將模板切分為章節後並發生成再拼接"""
+
+    SUPPORTED_DOC_TYPES = tuple(SECTION_GUIDELINES)
+
+    def __init__(self, ai_service, max_workers=4, min_sections=2, max_sections=16):
+        """
+        Args:
+            ai_service: AIService 實例
+            max_workers: 同時生成的章節數上限
+            min_sections: 模板章節少於此數時不值得分段，由調用方改用整份生成
+            max_sections: 章節數上限，超過時合併相鄰的小章節
+        """
+        self.ai_service = ai_service
+        self.max_workers = max(1, max_workers)
+        self.min_sections = min_sections
+        self.max_sections = max(1, max_sections)
+
+    @staticmethod
+    def detect_heading(line):
+        """判斷一行是否為標題，返回 (標題, 層級) 或 None"""
+        stripped = line.strip()
+        if not stripped or len(stripped) > MAX_HEADING_LENGTH:
+            return None
+        for pattern, level_of in HEADING_PATTERNS:
+            match = pattern.match(stripped)
+            if match:
+                return match.groupdict().get('title') or stripped, level_of(match)
+        return None
+
+    @staticmethod
+    def build_skeleton(text, max_headings=MAX_SKELETON_HEADINGS):
+        """模板的標題骨架 [{'title': ..., 'level': ...}]"""
+        headings = []
+        for line in text.splitlines():
+            heading = SectionGenerator.detect_heading(line)
+            if heading:
+                headings.append({"title": heading[0], "level": heading[1]})
+                if len(headings) >= max_headings:
+                    break
+        return headings
+
+    def split_sections(self, template_text):
+        """
+        按最高層級的標題切分模板
+
+        下級標題保留在所屬章節內，第一個標題之前的文字併入第一個章節。
+
+        Returns:
+            list[Section]
+        """
+        lines = template_text.splitlines()
+        headings = []
+        for index, line in enumerate(lines):
+            heading = self.detect_heading(line)
+            if heading:
+                headings.append((index, heading[0], heading[1]))
+        if not headings:
+            return []
+
+        top_level = min(level for _, _, level in headings)
+        starts = [(index, title) for index, title, level in headings if level == top_level]
+
+        sections = []
+        for position, (index, title) in enumerate(starts):
+            end = starts[position + 1][0] if position + 1 < len(starts) else len(lines)
+            body = '\n'.join(lines[index + 1:end]).strip()
+            sections.append(Section(title, top_level, body))
+
+        preamble = '\n'.join(lines[:starts[0][0]]).strip()
+        if preamble:
+            sections[0].body = f"{preamble}\n\n{sections[0].body}".strip()
+        return self._merge_sections(sections)
+
+    def _merge_sections(self, sections):
+        """章節過多時把相鄰章節合併，使數量不超過 max_sections"""
+        if len(sections) <= self.max_sections:
+            return sections
+        group_size = -(-len(sections) // self.max_sections)
+        merged = []
+        for start in range(0, len(sections), group_size):
+            group = sections[start:start + group_size]
+            first = group[0]
+            body = '\n\n'.join([first.body] + [section.text for section in group[1:]]).strip()
+            merged.append(Section(first.title, first.level, body))
+        return merged
+
+    @staticmethod
+    def build_outline(sections):
+        """所有章節共用的大綱，讓各章節的用語與分工一致"""
+        return '\n'.join(f"{index}. {section.title}" for index, section in enumerate(sections, start=1))
+
+    def build_prompt(self, doc_type, doc_name, profile_content, requirements, sections, index):
+        """構建第 index 個章節的 Prompt"""
+        section = sections[index]
+        heading = '#' * min(section.level, 6)
+        guideline = SECTION_GUIDELINES.get(doc_type, "")
+        return f"""
+{profile_content}
+你正在分段撰寫一份{doc_name}，各章節由不同的撰寫者同時完成，最後按大綱順序合併為一份文檔。
+
+=== 文檔大綱（所有章節共用）===
+{self.build_outline(sections)}
+
+=== 用戶需求 ===
+{requirements}
+
+=== 本章節的模板內容 ===
+{section.text}
+
+=== 撰寫要求 ===
+1. 只撰寫第 {index + 1} 章「{section.title}」，不要撰寫其他章節的內容
+2. 以 Markdown 標題「{heading} {section.title}」開頭，下級標題依序使用更深的層級
+3. {guideline}
+4. 與大綱中其他章節的分工保持一致，避免重複其他章節的內容
+5. 不要輸出文檔標題、目錄或結語，直接輸出本章節內容
+        """
+
+    def iter_sections(self, doc_type, doc_name, profile_content, requirements, sections, use_cache=True):
+        """
+        並發生成所有章節，按章節順序逐一產出結果
+
+        前面的章節完成後即可產出，不必等待全部完成（供串流使用）。
+
+        Yields:
+            tuple: (章節索引, 內容, usage_info)
+        """
+        prompts = [
+            self.build_prompt(doc_type, doc_name, profile_content, requirements, sections, index)
+            for index in range(len(sections))
+        ]
+        workers = min(self.max_workers, len(prompts))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='section') as executor:
+            futures = [
+                executor.submit(self.ai_service.generate_content, prompt, use_cache)
+                for prompt in prompts
+            ]
+            try:
+                for index, future in enumerate(futures):
+                    content, usage_info = future.result()
+                    yield index, content.strip(), usage_info
+            finally:
+                # 失敗或調用方中止時取消尚未開始的章節
+                for future in futures:
+                    future.cancel()
+
+    @staticmethod
+    def merge_usage(usages, count_key='sections'):
+        """彙總各部分的 token 與成本，count_key 記錄部分數量"""
+        merged = {
+            "model": next((usage.get('model') for usage in usages if usage.get('model')), None),
+            "input_tokens": sum(usage.get('input_tokens', 0) for usage in usages),
+            "output_tokens": sum(usage.get('output_tokens', 0) for usage in usages),
+            "cost": sum(usage.get('cost', 0.0) for usage in usages),
+            count_key: len(usages),
+        }
+        if usages and all(usage.get('cached') for usage in usages):
+            merged['cached'] = True
+        return merged
+
+    def generate(self, doc_type, doc_name, profile_content, requirements, sections, use_cache=True):
+        """
+        生成完整文檔
+
+        Returns:
+            tuple: (Markdown 內容, 彙總的 usage_info)
+        """
+        contents = []
+        usages = []
+        for _, content, usage_info in self.iter_sections(
+                doc_type, doc_name, profile_content, requirements, sections, use_cache):
+            contents.append(content)
+            usages.append(usage_info)
+        return '\n\n'.join(contents), self.merge_usage(usages)
+
+
+# 投影片分隔標記（FileProcessor.extract_text_from_pptx 的 include_slide_markers 輸出）
+SLIDE_MARKER_PATTERN = re.compile(r'^\[投影片\s*(\d+)\]\s*$', re.M)
+# 原文中的圖片標記：[圖片 X-Y: 來自投影片 Z]
+SOURCE_IMAGE_MARKER_PATTERN = re.compile(r'\[圖片\s*(\d+)-(\d+)')
+# 輸出中的圖片標記：與渲染器（markdown_ast）識別為圖片的寫法相同
+OUTPUT_IMAGE_MARKER_PATTERN = IMAGE_MARKER_PATTERN
+
+
+class SlideWindow:
+    """連續若干張投影片組成的處理窗口"""
+
+    def __init__(self, slides, text):
+        self.slides = slides
+        self.text = text
+        self.markers = []
+        for slide, index in SOURCE_IMAGE_MARKER_PATTERN.findall(text):
+            marker = f"{slide}-{index}"
+            if marker not in self.markers:
+                self.markers.append(marker)
+
+    @property
+    def label(self):
+        """窗口涵蓋的投影片範圍，例如 '3-5'"""
+        if not self.slides:
+            return ''
+        first, last = self.slides[0], self.slides[-1]
+        return str(first) if first == last else f"{first}-{last}"
+
+
+class ChunkedSOPOptimizer:
+    """
+    分段 SOP 優化 - 按投影片切分舊 SOP，窗口並發優化後按順序拼接
+
+    每個窗口完成後檢查原文中的圖片標記是否都出現在輸出中，
+    只對缺少標記的窗口重新請求；重試後仍缺少時把標記補在該段末尾，確保圖片不會遺失。
+    模板在每個窗口的 Prompt 中重複出現，因此只放標題骨架與開頭的一段範例（見 template_reference）。
+    """
+
+    def __init__(self, ai_service, slides_per_window=5, max_chars=6000, max_workers=4, max_retries=2,
+                 template_excerpt_chars=1500):
+        """
+        Args:
+            ai_service: AIService 實例
+            slides_per_window: 每個窗口最多包含的投影片數
+            max_chars: 每個窗口的字數上限（單張投影片超過時自成一個窗口）
+            max_workers: 同時處理的窗口數上限
+            max_retries: 圖片標記缺失時重新請求的次數上限
+            template_excerpt_chars: 每個窗口附上的模板範例字數上限
+        """
+        self.ai_service = ai_service
+        self.slides_per_window = max(1, slides_per_window)
+        self.max_chars = max_chars
+        self.max_workers = max(1, max_workers)
+        self.max_retries = max(0, max_retries)
+        self.template_excerpt_chars = max(0, template_excerpt_chars)
+
+    @staticmethod
+    def split_slides(text):
+        """
+        切分出每張投影片的內容
+
+        有投影片分隔標記時按標記切分；否則按空行分段（提取時每張投影片以空行分隔）。
+
+        Returns:
+            list[tuple]: [(投影片編號, 內容)]
+        """
+        matches = list(SLIDE_MARKER_PATTERN.finditer(text))
+        if not matches:
+            blocks = [block.strip() for block in re.split(r'\n\s*\n', text)]
+            return [(index, block) for index, block in enumerate((b for b in blocks if b), start=1)]
+
+        slides = []
+        preamble = text[:matches[0].start()].strip()
+        for position, match in enumerate(matches):
+            end = matches[position + 1].start() if position + 1 < len(matches) else len(text)
+            content = text[match.start():end].strip()
+            if position == 0 and preamble:
+                content = f"{preamble}\n\n{content}"
+            slides.append((int(match.group(1)), content))
+        return slides
+
+    def split_windows(self, text):
+        """按投影片數與字數上限把舊 SOP 切分為窗口"""
+        windows = []
+        numbers, parts, size = [], [], 0
+        for number, content in self.split_slides(text):
+            if parts and (len(parts) >= self.slides_per_window or size + len(content) > self.max_chars):
+                windows.append(SlideWindow(numbers, '\n\n'.join(parts)))
+                numbers, parts, size = [], [], 0
+            numbers.append(number)
+            parts.append(content)
+            size += len(content)
+        if parts:
+            windows.append(SlideWindow(numbers, '\n\n'.join(parts)))
+        return windows
+
+    @staticmethod
+    def build_outline(windows):
+        """各窗口共用的全文概要：每張投影片的第一行"""
+        lines = []
+        for window in windows:
+            for _, content in ChunkedSOPOptimizer.split_slides(window.text):
+                first_line = next((line.strip() for line in content.splitlines()
+                                   if line.strip() and not SLIDE_MARKER_PATTERN.match(line.strip())
+                                   and not SOURCE_IMAGE_MARKER_PATTERN.match(line.strip())), '')
+                if first_line:
+                    lines.append(f"- {first_line[:60]}")
+        return '\n'.join(lines)
+
+    def template_reference(self, template_content, skeleton=None):
+        """
+        各窗口共用的模板參考：標題骨架加上模板開頭的範例
+
+        模板不超過範例字數時原樣返回。
+
+        Args:
+            skeleton: 預先產生的標題骨架（模板預處理時已保存），為 None 時從模板文字產生
+        """
+        template_content = (template_content or '').strip()
+        if len(template_content) <= self.template_excerpt_chars:
+            return template_content
+
+        if skeleton is None:
+            skeleton = SectionGenerator.build_skeleton(template_content)
+        excerpt = template_content[:self.template_excerpt_chars]
+        if '\n' in excerpt:
+            excerpt = excerpt[:excerpt.rindex('\n')]
+        parts = []
+        if skeleton:
+            parts.append("章節結構：\n" + '\n'.join(
+                f"{'  ' * (heading['level'] - 1)}- {heading['title']}" for heading in skeleton
+            ))
+        parts.append(f"開頭範例（以下省略）：\n{excerpt.strip()}")
+        return '\n\n'.join(parts)
+
+    def build_prompts(self, profile_content, template_content, windows, skeleton=None):
+        """所有窗口首次請求的 Prompt（試算使用）"""
+        reference = self.template_reference(template_content, skeleton)
+        outline = self.build_outline(windows)
+        return [self.build_prompt(profile_content, reference, windows, index, outline)
+                for index in range(len(windows))]
+
+    def build_prompt(self, profile_content, template_content, windows, index, outline, missing=None):
+        """
+        構建第 index 個窗口的 Prompt，missing 為上一輪輸出中缺少的圖片標記
+
+        template_content 應為 template_reference 的結果，而非完整模板。
+        """
+        window = windows[index]
+        heading_rule = (
+            "以一級標題 (#) 輸出文檔標題，章節使用二級 (##) 以下的標題"
+            if index == 0 else
+            "這是文檔中間的片段，不要輸出文檔標題，章節直接使用二級 (##) 以下的標題"
+        )
+        markers = '、'.join(f"[圖片 {marker}]" for marker in window.markers) or "（本段沒有圖片）"
+        reminder = ""
+        if missing:
+            reminder = (
+                "\n**注意：上一次的輸出遺漏了以下圖片標記，這次必須在相關內容處完整保留：**\n"
+                + '\n'.join(f"- [圖片 {marker}]" for marker in missing) + "\n"
+            )
+        return f"""
+{profile_content}
+你是一位專業的 SOP 文檔優化專家。一份舊 SOP 被按投影片切分為 {len(windows)} 段同時優化，
+你負責第 {index + 1} 段（投影片 {window.label}），完成後會按順序與其他段落合併為一份文檔。
+
+=== 全文概要（各段共用，用於保持術語與結構一致）===
+{outline}
+
+=== 參考模板風格 ===
+{template_content}
+
+=== 本段原始 SOP 內容 ===
+{window.text}
+
+=== 優化要求 ===
+1. 只優化本段內容，不要補寫其他段落的內容，也不要輸出目錄或結語
+2. 保留所有操作步驟、設定值、路徑、注意事項；每張投影片的內容都要保留，不要大幅刪減
+3. 必須完整保留本段的所有圖片標記：{markers}，格式為 [圖片 X-Y: 來自投影片 Z]，放在相關內容的適當位置
+4. [投影片 N] 是原始投影片的分隔標記，僅供參考，不要輸出
+5. {heading_rule}
+6. 使用專業、簡練的語言，適當使用列表和表格，以 Markdown 格式輸出
+{reminder}
+        """
+
+    @staticmethod
+    def missing_markers(window, content):
+        """返回輸出中缺少的圖片標記"""
+        found = {f"{slide}-{index}" for slide, index in OUTPUT_IMAGE_MARKER_PATTERN.findall(content)}
+        return [marker for marker in window.markers if marker not in found]
+
+    def optimize_window(self, profile_content, template_content, windows, index, outline, use_cache=True):
+        """
+        優化單個窗口並檢查圖片標記，缺失時只重新請求此窗口
+
+        缺少標記的輸出不寫入快取；重新請求時略過快取，確保模型確實重新生成。
+
+        Returns:
+            tuple: (內容, usage 列表, 重試次數)
+        """
+        window = windows[index]
+        usages = []
+        missing = None
+        content = ''
+        complete = lambda output: not self.missing_markers(window, SLIDE_MARKER_PATTERN.sub('', output))
+        for attempt in range(self.max_retries + 1):
+            prompt = self.build_prompt(profile_content, template_content, windows, index, outline, missing)
+            content, usage_info = self.ai_service.generate_content(prompt, use_cache and attempt == 0,
+                                                                   accept=complete)
+            usages.append(usage_info)
+            content = SLIDE_MARKER_PATTERN.sub('', content)
+            missing = self.missing_markers(window, content)
+            if not missing:
+                return content.strip(), usages, attempt
+            print(f"[WARNING] 投影片 {window.label} 的輸出缺少圖片標記 {missing}（第 {attempt + 1} 次）")
+
+        # 重試後仍缺少：補在段落末尾，避免圖片在轉換時遺失
+        appended = '\n\n'.join(f"[圖片 {marker}: 來自投影片 {marker.split('-')[0]}]" for marker in missing)
+        return f"{content.strip()}\n\n{appended}", usages, self.max_retries
+
+    def iter_windows(self, profile_content, template_content, windows, use_cache=True, skeleton=None):
+        """
+        並發優化所有窗口，按順序逐一產出結果
+
+        Args:
+            skeleton: 模板的標題骨架（可選，見 template_reference）
+
+        Yields:
+            tuple: (窗口索引, 內容, usage 列表, 重試次數)
+        """
+        reference = self.template_reference(template_content, skeleton)
+        outline = self.build_outline(windows)
+        workers = min(self.max_workers, len(windows))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sop-chunk') as executor:
+            futures = [
+                executor.submit(self.optimize_window, profile_content, reference,
+                                windows, index, outline, use_cache)
+                for index in range(len(windows))
+            ]
+            try:
+                for index, future in enumerate(futures):
+                    content, usages, retries = future.result()
+                    yield index, content, usages, retries
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    @staticmethod
+    def merge_usage(usages, chunks, retries=0):
+        """彙總所有窗口（含重試）的 token 與成本"""
+        merged = SectionGenerator.merge_usage(usages, count_key='requests')
+        merged['chunks'] = chunks
+        merged['retries'] = retries
+        return merged
+
+    def generate(self, profile_content, template_content, windows, use_cache=True, skeleton=None):
+        """
+        優化完整的舊 SOP
+
+        Returns:
+            tuple: (Markdown 內容, 彙總的 usage_info)
+        """
+        contents = []
+        usages = []
+        retries = 0
+        for _, content, window_usages, window_retries in self.iter_windows(
+                profile_content, template_content, windows, use_cache, skeleton):
+            contents.append(content)
+            usages.extend(window_usages)
+            retries += window_retries
+        return '\n\n'.join(contents), self.merge_usage(usages, len(windows), retries)
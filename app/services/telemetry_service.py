@@ -0,0 +1,157 @@
+"""
+LLM Telemetry Service
+記錄每次供應商調用的延遲、首字延遲 (TTFT)、輸出速度、錯誤類型與重試次數，
+按 'provider:model' 保存最近 N 次調用的滾動窗口，並彙總為直方圖與分位數。
+"""
+import time
+import threading
+from collections import deque, Counter
+
+import requests
+
+from .retry_service import ProviderHTTPError, RateLimitTimeout
+
+
+# 延遲直方圖的桶上限（秒）
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, float('inf'))
+
+
+def error_class(exc):
+    """
+    返回錯誤的分類名稱
+
+    供應商方法會把原始錯誤包裝為一般 Exception，因此沿著 __cause__ / __context__ 找到原始錯誤。
+    """
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, ProviderHTTPError):
+            return f"http_{exc.status_code}"
+        if isinstance(exc, RateLimitTimeout):
+            return 'client_rate_limit'
+        if isinstance(exc, requests.Timeout):
+            return 'timeout'
+        if isinstance(exc, requests.ConnectionError):
+            return 'connection'
+        inner = exc.__cause__ or exc.__context__
+        if inner is None:
+            return type(exc).__name__
+        exc = inner
+    return 'unknown'
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class CallRecord:
+    """一次供應商調用的測量結果"""
+
+    __slots__ = ('timestamp', 'latency', 'ttft', 'input_tokens', 'output_tokens', 'cost',
+                 'error', 'retries', 'streamed')
+
+    def __init__(self, latency, ttft=None, input_tokens=0, output_tokens=0, cost=0.0,
+                 error=None, retries=0, streamed=False):
+        self.timestamp = time.time()
+        self.latency = latency
+        self.ttft = ttft
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.cost = cost
+        self.error = error
+        self.retries = retries
+        self.streamed = streamed
+
+    @property
+    def tokens_per_second(self):
+        """輸出速度：串流時扣除首字延遲"""
+        generating = self.latency - (self.ttft or 0)
+        if self.error or not self.output_tokens or generating <= 0:
+            return None
+        return self.output_tokens / generating
+
+
+class Telemetry:
+    """供應商調用遙測（每個進程一份，可跨線程共用）"""
+
+    def __init__(self, window=500):
+        """
+        Args:
+            window: 每個模型保留的最近調用數
+        """
+        self.window = window
+        self._lock = threading.Lock()
+        self._records = {}
+
+    @staticmethod
+    def key(provider, model):
+        return f"{provider}:{model}"
+
+    def record(self, provider, model, latency, ttft=None, input_tokens=0, output_tokens=0, cost=0.0,
+               error=None, retries=0, streamed=False):
+        """記錄一次調用；error 為異常時記錄其分類名稱"""
+        if isinstance(error, BaseException):
+            error = error_class(error)
+        entry = CallRecord(latency, ttft, input_tokens, output_tokens, cost, error, retries, streamed)
+        with self._lock:
+            records = self._records.get(self.key(provider, model))
+            if records is None:
+                records = self._records[self.key(provider, model)] = deque(maxlen=self.window)
+            records.append(entry)
+
+    def records(self, provider, model):
+        with self._lock:
+            return list(self._records.get(self.key(provider, model), ()))
+
+    def summary(self, provider, model):
+        """
+        彙總一個模型最近的調用
+
+        Returns:
+            dict 或 None（尚無記錄）
+        """
+        records = self.records(provider, model)
+        if not records:
+            return None
+        succeeded = [r for r in records if not r.error]
+        latencies = [r.latency for r in succeeded]
+        ttfts = [r.ttft for r in succeeded if r.ttft is not None]
+        speeds = [r.tokens_per_second for r in succeeded if r.tokens_per_second is not None]
+        input_tokens = sum(r.input_tokens for r in succeeded)
+        output_tokens = sum(r.output_tokens for r in succeeded)
+
+        histogram = Counter()
+        for latency in latencies:
+            bucket = next(b for b in LATENCY_BUCKETS if latency <= b)
+            histogram['+Inf' if bucket == float('inf') else f"le_{bucket:g}s"] += 1
+
+        return {
+            "calls": len(records),
+            "successes": len(succeeded),
+            "error_rate": round(1 - len(succeeded) / len(records), 4),
+            "errors": dict(Counter(r.error for r in records if r.error)),
+            "retries": sum(r.retries for r in records),
+            "latency_p50": _percentile(latencies, 0.5),
+            "latency_p95": _percentile(latencies, 0.95),
+            "ttft_p50": _percentile(ttfts, 0.5),
+            "ttft_p95": _percentile(ttfts, 0.95),
+            "output_tokens_per_second_p50": _percentile(speeds, 0.5),
+            "cost_per_1k_tokens": (
+                sum(r.cost for r in succeeded) / (input_tokens + output_tokens) * 1000
+                if input_tokens + output_tokens else None
+            ),
+            "latency_histogram": dict(histogram),
+        }
+
+    def stats(self):
+        """所有模型的彙總"""
+        with self._lock:
+            keys = list(self._records)
+        result = {}
+        for key in keys:
+            provider, _, model = key.partition(':')
+            result[key] = self.summary(provider, model)
+        return result
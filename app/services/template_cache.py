@@ -0,0 +1,138 @@
+"""
+Template Text Cache
+快取模板文件提取出的文字，生成請求不再重新解析 DOCX / PPTX / PDF：
+- 以 (文件名, 大小, 修改時間) 快速判斷快取是否有效，文件變更時以內容雜湊 (SHA-256) 查找相同內容的結果
+- 記憶體 LRU 層 + SQLite 持久化層，重啟後仍然有效
+- 上傳時預先提取，刪除模板時一併清除
+"""
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from ..utils.db import ThreadLocalSQLite
+from .file_service import FileProcessor
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """計算文件內容的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_extraction_error(text):
+    """FileProcessor 以返回文字的方式回報錯誤，這些結果不應快取"""
+    if not text:
+        return False
+    first_line = text.split('\n', 1)[0]
+    return (first_line.startswith(('錯誤:', '不支持的文件格式'))
+            or (first_line.startswith('讀取 ') and '失敗' in first_line))
+
+
+class TemplateTextCache:
+    """模板文字快取（每個進程一份，可跨線程共用）"""
+
+    def __init__(self, db_path, max_memory_entries=32, extractor=None):
+        """
+        Args:
+            db_path: SQLite 文件路徑
+            max_memory_entries: 記憶體層最多保留的模板數
+            extractor: 提取文字的函數，預設為 FileProcessor.extract_text
+        """
+        self.max_memory_entries = max_memory_entries
+        self.extractor = extractor or FileProcessor.extract_text
+        self._db = ThreadLocalSQLite(db_path)
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'hash_hits': 0, 'extractions': 0}
+        self._init_schema()
+
+    def _init_schema(self):
+        conn = self._db.connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS template_text (
+                filename TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                text TEXT NOT NULL,
+                extracted_at REAL NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_template_text_sha256 ON template_text (sha256)')
+
+    def _remember(self, key, text):
+        with self._lock:
+            self._memory[key] = text
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get_text(self, path):
+        """
+        返回模板的文字內容，快取無效時提取並寫入快取
+
+        Args:
+            path: 模板文件路徑（文件名作為快取鍵）
+        """
+        filename = os.path.basename(path)
+        stats = os.stat(path)
+        key = (filename, stats.st_size, stats.st_mtime_ns)
+
+        with self._lock:
+            text = self._memory.get(key)
+            if text is not None:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return text
+
+        conn = self._db.connect()
+        row = conn.execute(
+            'SELECT text FROM template_text WHERE filename = ? AND size = ? AND mtime_ns = ?', key
+        ).fetchone()
+        if row is not None:
+            self._count('disk_hits')
+            self._remember(key, row['text'])
+            return row['text']
+
+        # 文件已變更或尚未快取：以內容雜湊查找相同內容（例如重新上傳同一份模板）
+        sha256 = file_sha256(path)
+        row = conn.execute('SELECT text FROM template_text WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone()
+        if row is not None:
+            self._count('hash_hits')
+            text = row['text']
+        else:
+            self._count('extractions')
+            started = time.time()
+            text = self.extractor(path)
+            if is_extraction_error(text):
+                return text
+            print(f"[INFO] 已提取模板文字 {filename}（{time.time() - started:.2f} 秒）")
+
+        conn.execute("""
+            INSERT OR REPLACE INTO template_text (filename, size, mtime_ns, sha256, text, extracted_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (filename, stats.st_size, stats.st_mtime_ns, sha256, text, time.time()))
+        self._remember(key, text)
+        return text
+
+    def invalidate(self, filename):
+        """清除模板的快取（刪除模板時調用）"""
+        with self._lock:
+            for key in [key for key in self._memory if key[0] == filename]:
+                del self._memory[key]
+        self._db.connect().execute('DELETE FROM template_text WHERE filename = ?', (filename,))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, memory_entries=len(self._memory))
+        stats['disk_entries'] = self._db.connect().execute('SELECT COUNT(*) FROM template_text').fetchone()[0]
+        return stats
@@ -0,0 +1,178 @@
+"""
+Token Accounting Service
+離線計算 prompt 的 token 數並控制輸入預算：
+- OpenAI 模型使用 tiktoken 的對應編碼（可選依賴，編碼文件需預先下載或放在 TIKTOKEN_CACHE_DIR）
+- 其他模型或 tiktoken 不可用時，按字元類別估算
+- 超出輸入預算時，按優先級由低到高截斷 prompt 的組成部分
+"""
+import threading
+
+# 可選依賴：tiktoken (用於 OpenAI 模型的精確計數)
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+
+# 截斷後附加的說明，讓模型知道內容並不完整
+TRUNCATION_NOTICE = "\n...（以下內容超出輸入上限，已省略）"
+
+
+def heuristic_token_count(text):
+    """粗略估算 token 數：中日韓字元約 1 token，其餘約 4 字元 1 token"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if '\u2e80' <= ch <= '\u9fff' or '\uac00' <= ch <= '\ud7af')
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+class TokenCounter:
+    """按供應商 / 模型計算 token 數（每個進程一份，可跨線程共用）"""
+
+    # tiktoken 不認識的模型名稱使用的預設編碼
+    DEFAULT_OPENAI_ENCODING = 'o200k_base'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._encodings = {}
+        self._loading = set()
+
+    def _encoding(self, provider, model):
+        """
+        取得模型對應的 tiktoken 編碼，無法取得時返回 None（改用估算）
+
+        首次載入可能需要下載編碼文件，在鎖外進行；載入期間其他線程直接使用估算，不等待下載。
+        """
+        if not TIKTOKEN_AVAILABLE or provider != 'openai':
+            return None
+        with self._lock:
+            if model in self._encodings:
+                return self._encodings[model]
+            if model in self._loading:
+                return None
+            self._loading.add(model)
+
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding(self.DEFAULT_OPENAI_ENCODING)
+        except Exception as e:
+            # 離線且沒有快取的編碼文件時只嘗試一次，之後都使用估算
+            print(f"[WARNING] 無法載入 {model} 的 tiktoken 編碼，改用估算: {e}")
+            encoding = None
+        with self._lock:
+            self._encodings[model] = encoding
+            self._loading.discard(model)
+        return encoding
+
+    def is_exact(self, provider, model):
+        """該模型的計數是否來自真正的 tokenizer"""
+        return self._encoding(provider, model) is not None
+
+    def count(self, text, provider, model):
+        """計算 text 的 token 數"""
+        if not text:
+            return 0
+        encoding = self._encoding(provider, model)
+        if encoding is None:
+            return heuristic_token_count(text)
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text, max_tokens, provider, model):
+        """
+        截斷 text 使其不超過 max_tokens（含截斷說明）
+
+        Returns:
+            str: 未超出時原樣返回
+        """
+        if self.count(text, provider, model) <= max_tokens:
+            return text
+        budget = max_tokens - self.count(TRUNCATION_NOTICE, provider, model)
+        if budget <= 0:
+            return ''
+
+        encoding = self._encoding(provider, model)
+        if encoding is not None:
+            tokens = encoding.encode(text, disallowed_special=())
+            return encoding.decode(tokens[:budget]) + TRUNCATION_NOTICE
+
+        # 估算模式下二分查找最長的前綴
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if heuristic_token_count(text[:middle]) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        return text[:low] + TRUNCATION_NOTICE
+
+
+class PromptBudget:
+    """輸入 token 預算 - 超出時按優先級截斷 prompt 的組成部分"""
+
+    def __init__(self, counter, budgets=None, default_budget=100000):
+        """
+        Args:
+            counter: TokenCounter
+            budgets: 按 'provider:model' 或 'provider' 配置的輸入上限，查找順序與 RateLimiter 相同
+            default_budget: 沒有配置時的輸入上限
+        """
+        self.counter = counter
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+
+    def limit_for(self, provider, model):
+        """返回該模型的輸入 token 上限"""
+        for key in (f"{provider}:{model}", provider):
+            if key in self.budgets:
+                return self.budgets[key]
+        return self.default_budget
+
+    def fit(self, parts, priority, build_prompt, provider, model):
+        """
+        使 build_prompt(parts) 構建的 prompt 不超過輸入上限
+
+        Args:
+            parts: dict，prompt 的各組成部分（名稱 -> 文字）
+            priority: 可截斷部分的名稱，優先級由低到高（最先截斷第一個）
+            build_prompt: 以 parts 構建完整 prompt 的函數
+            provider / model: 用於選擇 tokenizer 與上限
+
+        Returns:
+            tuple: (prompt, parts, report)，report 記錄預算、截斷前後的 token 數及各部分截斷的 token 數
+        """
+        limit = self.limit_for(provider, model)
+        prompt = build_prompt(parts)
+        total = self.counter.count(prompt, provider, model)
+        report = {
+            "budget": limit,
+            "prompt_tokens": total,
+            "original_prompt_tokens": total,
+            "trimmed": {},
+            "exact": self.counter.is_exact(provider, model),
+        }
+        if total <= limit:
+            return prompt, parts, report
+
+        parts = dict(parts)
+        original_total = total
+        for name in priority:
+            text = parts.get(name) or ''
+            target = self.counter.count(text, provider, model)
+            # 分段計數與整體計數不完全相加，截斷後仍略超出時在同一部分再縮減
+            while total > limit and target > 0:
+                target = max(0, target - (total - limit))
+                parts[name] = self.counter.truncate(text, target, provider, model)
+                prompt = build_prompt(parts)
+                total = self.counter.count(prompt, provider, model)
+            if parts.get(name) != text:
+                report["trimmed"][name] = original_total - total - sum(report["trimmed"].values())
+            if total <= limit:
+                break
+
+        report["prompt_tokens"] = total
+        if total > limit:
+            print(f"[WARNING] Prompt 截斷後仍有 {total} tokens，超出上限 {limit}")
+        return prompt, parts, report
@@ -1 +1,2 @@
 from .helpers import log_cost_to_file
+from .cost_ledger import CostLedger, configure_cost_ledger, get_cost_ledger
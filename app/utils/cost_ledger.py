@@ -0,0 +1,282 @@
+"""
+Cost Ledger
+LLM 成本記錄：
+- 調用方只把記錄放入佇列，由背景線程批次寫入，不阻塞請求線程
+- 存儲在 SQLite (WAL) 中，多個 worker 進程可安全地同時寫入
+- 寫入時同步更新每小時 / 每日按模型的彙總，範圍查詢只讀彙總表
+- 明細記錄超過保留天數後自動刪除（彙總保留）
+- 寫入失敗時保留該批記錄並退避重試，不丟棄任何記錄
+"""
+import os
+import csv
+import time
+import queue
+import atexit
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+
+from .db import ThreadLocalSQLite
+
+logger = logging.getLogger(__name__)
+
+
+class CostLedger:
+    """成本記錄（每個進程一份）"""
+
+    GRANULARITIES = {'hour': 'cost_rollup_hourly', 'day': 'cost_rollup_daily'}
+
+    def __init__(self, db_path, flush_interval=1.0, batch_size=500, retention_days=90,
+                 legacy_csv_path=None, retry_base_delay=0.5, retry_max_delay=30.0):
+        """
+        Args:
+            db_path: SQLite 文件路徑
+            flush_interval: 背景線程最長多久寫入一次（秒）
+            batch_size: 單次寫入的最大記錄數
+            retention_days: 明細保留天數，None 表示永久保留
+            legacy_csv_path: 舊版 cost_log.csv，資料庫首次建立時匯入
+            retry_base_delay / retry_max_delay: 寫入失敗後重試的初始 / 最長等待時間（秒），每次失敗加倍
+        """
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.retention_days = retention_days
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self._db = ThreadLocalSQLite(db_path)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pruned_at = 0.0
+        self._init_schema(legacy_csv_path)
+
+    def _init_schema(self, legacy_csv_path):
+        conn = self._db.connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cost_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts REAL NOT NULL,
+                model TEXT NOT NULL,
+                input_tokens INTEGER NOT NULL,
+                output_tokens INTEGER NOT NULL,
+                cost REAL NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_cost_events_ts ON cost_events (ts)')
+        for table in self.GRANULARITIES.values():
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    bucket TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    requests INTEGER NOT NULL,
+                    input_tokens INTEGER NOT NULL,
+                    output_tokens INTEGER NOT NULL,
+                    cost REAL NOT NULL,
+                    PRIMARY KEY (bucket, model)
+                )
+            """)
+        conn.execute("CREATE TABLE IF NOT EXISTS cost_meta (key TEXT PRIMARY KEY, value TEXT)")
+
+        if legacy_csv_path and os.path.exists(legacy_csv_path):
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                imported = conn.execute("SELECT 1 FROM cost_meta WHERE key = 'legacy_csv_imported'").fetchone()
+                if not imported:
+                    self._write(conn, self._read_legacy_csv(legacy_csv_path))
+                    conn.execute("INSERT INTO cost_meta (key, value) VALUES ('legacy_csv_imported', ?)",
+                                 (legacy_csv_path,))
+                conn.execute('COMMIT')
+            except (sqlite3.Error, OSError, ValueError) as e:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                logger.warning("匯入舊版成本記錄失敗: %s", e)
+
+    @staticmethod
+    def _read_legacy_csv(path):
+        records = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                ts = datetime.strptime(row['Timestamp'], '%Y-%m-%d %H:%M:%S').timestamp()
+                records.append((ts, row['Model'], int(row['Input Tokens']), int(row['Output Tokens']),
+                                float(row['Cost (USD)'])))
+        return records
+
+    # ==================== 寫入 ====================
+
+    def record(self, model, input_tokens, output_tokens, cost, timestamp=None):
+        """記錄一次調用的成本（只放入佇列，立即返回）"""
+        self._ensure_writer()
+        self._queue.put((timestamp or time.time(), model or 'unknown',
+                         int(input_tokens or 0), int(output_tokens or 0), float(cost or 0.0)))
+
+    def _ensure_writer(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._writer_loop, name='cost-ledger', daemon=True)
+                self._thread.start()
+
+    def _writer_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            # 等待一小段時間收集更多記錄，合併為一次交易
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write_with_retry(batch)
+
+    def _write_with_retry(self, batch):
+        """寫入一批記錄，失敗時退避重試直到提交成功，之後才標記為完成"""
+        delay = self.retry_base_delay
+        while True:
+            try:
+                self._write_batch(batch)
+                break
+            except Exception:
+                logger.exception("寫入成本記錄失敗（%d 筆），%.1f 秒後重試", len(batch), delay)
+                time.sleep(delay)
+                delay = min(self.retry_max_delay, delay * 2)
+        for _ in batch:
+            self._queue.task_done()
+        try:
+            self._prune(self._db.connect())
+        except sqlite3.Error as e:
+            logger.warning("刪除過期成本明細失敗: %s", e)
+
+    @staticmethod
+    def _buckets(ts):
+        moment = time.localtime(ts)
+        return time.strftime('%Y-%m-%d %H:00', moment), time.strftime('%Y-%m-%d', moment)
+
+    def _write(self, conn, records):
+        """在目前的交易中寫入明細並更新彙總"""
+        conn.executemany(
+            'INSERT INTO cost_events (ts, model, input_tokens, output_tokens, cost) VALUES (?, ?, ?, ?, ?)',
+            records
+        )
+        rollups = {}
+        for ts, model, input_tokens, output_tokens, cost in records:
+            for table, bucket in zip(self.GRANULARITIES.values(), self._buckets(ts)):
+                key = (table, bucket, model)
+                totals = rollups.setdefault(key, [0, 0, 0, 0.0])
+                totals[0] += 1
+                totals[1] += input_tokens
+                totals[2] += output_tokens
+                totals[3] += cost
+        for (table, bucket, model), (requests, input_tokens, output_tokens, cost) in rollups.items():
+            conn.execute(f"""
+                INSERT INTO {table} (bucket, model, requests, input_tokens, output_tokens, cost)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (bucket, model) DO UPDATE SET
+                    requests = requests + excluded.requests,
+                    input_tokens = input_tokens + excluded.input_tokens,
+                    output_tokens = output_tokens + excluded.output_tokens,
+                    cost = cost + excluded.cost
+            """, (bucket, model, requests, input_tokens, output_tokens, cost))
+
+    def _write_batch(self, records):
+        conn = self._db.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._write(conn, records)
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+
+    def _prune(self, conn):
+        """刪除超過保留天數的明細（每小時最多一次）"""
+        if not self.retention_days or time.time() - self._pruned_at < 3600:
+            return
+        self._pruned_at = time.time()
+        cutoff = time.time() - self.retention_days * 86400
+        conn.execute('DELETE FROM cost_events WHERE ts < ?', (cutoff,))
+
+    def flush(self, timeout=5.0):
+        """等待佇列中的記錄寫入完成（測試與關閉時使用）"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return not self._queue.unfinished_tasks
+
+    # ==================== 查詢 ====================
+
+    def query(self, start=None, end=None, granularity='day', model=None):
+        """
+        查詢彙總
+
+        Args:
+            start / end: 起訖 bucket（含），日粒度為 'YYYY-MM-DD'，小時粒度為 'YYYY-MM-DD HH:00'，
+                         也可傳入較短的前綴（例如小時粒度傳 '2025-11-19'）
+            granularity: 'hour' 或 'day'
+            model: 只查詢指定模型
+
+        Returns:
+            dict: {"rows": [...], "totals": {...}}
+        """
+        table = self.GRANULARITIES.get(granularity)
+        if table is None:
+            raise ValueError(f"不支持的粒度: {granularity}")
+
+        conditions, params = [], []
+        if start:
+            conditions.append('bucket >= ?')
+            params.append(start)
+        if end:
+            # end 為前綴時包含該前綴下的所有 bucket
+            conditions.append('bucket <= ?')
+            params.append(end + '\uffff')
+        if model:
+            conditions.append('model = ?')
+            params.append(model)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        rows = [dict(row) for row in self._db.connect().execute(
+            f"SELECT bucket, model, requests, input_tokens, output_tokens, cost FROM {table} "
+            f"{where} ORDER BY bucket, model", params
+        )]
+        totals = {
+            "requests": sum(row['requests'] for row in rows),
+            "input_tokens": sum(row['input_tokens'] for row in rows),
+            "output_tokens": sum(row['output_tokens'] for row in rows),
+            "cost": sum(row['cost'] for row in rows),
+        }
+        return {"rows": rows, "totals": totals}
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def configure_cost_ledger(db_path, **options):
+    """設定進程共用的成本記錄（應用啟動時調用；相同路徑重複調用時沿用已有實例）"""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None or _ledger.db_path != db_path:
+            if _ledger is not None:
+                _ledger.flush()
+            _ledger = CostLedger(db_path, **options)
+        return _ledger
+
+
+def get_cost_ledger():
+    """取得進程共用的成本記錄，尚未設定時使用預設路徑"""
+    if _ledger is None:
+        configure_cost_ledger(os.path.join('data', 'costs.db'),
+                              legacy_csv_path=os.path.join('logs', 'cost_log.csv'))
+    return _ledger
+
+
+@atexit.register
+def _flush_on_exit():
+    if _ledger is not None:
+        _ledger.flush(timeout=2.0)
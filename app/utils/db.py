@@ -0,0 +1,29 @@
+import os
+import sqlite3
+import threading
+
+
+class ThreadLocalSQLite:
+    """
+    SQLite 連線管理 - 每個線程使用獨立連線（sqlite3 連線不可跨線程共用）
+
+    使用 WAL 模式與自動提交，讓多個線程 / 進程可以同時讀寫同一個資料庫文件。
+    """
+
+    def __init__(self, db_path, timeout=30):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
@@ -0,0 +1,24 @@
+"""
+共用進程池
+CPU 密集的文件解析（PDF 頁面、大型簡報）在子進程中並行執行。
+進程池在首次使用時建立並重複使用，使用 spawn 啟動子進程（與 Windows 行為一致，且不受父進程中線程的影響）。
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def get_process_pool(workers):
+    """返回至少有 workers 個進程的共用進程池"""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers < workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pool_workers = workers
+        return _pool
@@ -0,0 +1,86 @@
+"""
+PPTX 圖片優化基準測試
+
+產生多張全解析度截圖（介面色塊、文字行與一塊照片區域），比較 markdown_to_pptx 直接嵌入原圖與
+先按顯示尺寸縮小 / 重新壓縮（首次與快取命中）的生成耗時、prs.save 耗時與輸出大小。
+
+用法:
+    python benchmarks/bench_image_optimize.py [--images 20] [--width 2560] [--height 1440] [--workers 1 4]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from app.services.format_service import FormatConverter
+from app.services.image_optimizer import configure_image_optimizer
+
+
+def build_screenshot(path, width, height, seed):
+    """介面截圖：標題列、側欄、文字行，以及一塊照片（雜訊）區域"""
+    rng = np.random.default_rng(seed)
+    img = Image.new('RGB', (width, height), (245, 246, 248))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, width, 80), fill=(32, 86, 180))
+    draw.rectangle((0, 80, 320, height), fill=(228, 231, 236))
+    for row in range(120, height - 400, 36):
+        length = int(rng.integers(width // 4, width - 500))
+        draw.text((360, row), 'Lorem ipsum dolor sit amet ' * (length // 160), fill=(40, 40, 40))
+    photo = rng.integers(0, 256, (360, width // 3, 3), dtype=np.uint8)
+    img.paste(Image.fromarray(photo), (width // 2, height - 380))
+    img.save(path, 'PNG')
+
+
+def build_deck(content, image_folder, output_path):
+    started = time.perf_counter()
+    prs = FormatConverter.markdown_to_pptx(content, {'title': 'Benchmark'}, image_folder)
+    built = time.perf_counter()
+    prs.save(output_path)
+    saved = time.perf_counter()
+    return built - started, saved - built, os.path.getsize(output_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=20)
+    parser.add_argument('--width', type=int, default=2560)
+    parser.add_argument('--height', type=int, default=1440)
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({1, 4}))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        image_folder = os.path.join(tmp, 'images')
+        os.makedirs(image_folder)
+        lines = []
+        for number in range(1, args.images + 1):
+            build_screenshot(os.path.join(image_folder, f"slide_{number}_image_1.png"),
+                             args.width, args.height, number)
+            lines += [f"## 步驟 {number}", "- 開啟設定頁面", f"[圖片 {number}-1: 來自投影片 {number}]"]
+        content = '\n'.join(lines)
+        total = sum(os.path.getsize(os.path.join(image_folder, name)) for name in os.listdir(image_folder))
+
+        print(f"CPU 核心數: {os.cpu_count()}")
+        print(f"{args.images} 張 {args.width}x{args.height} 截圖，原圖合計 {total / 1024 / 1024:.1f} MB")
+        print(f"  {'mode':<20}{'build s':>10}{'save s':>10}{'total s':>10}{'output MB':>12}")
+
+        def report(label, build, save, size):
+            print(f"  {label:<20}{build:>10.3f}{save:>10.3f}{build + save:>10.3f}{size / 1024 / 1024:>12.2f}")
+
+        configure_image_optimizer(os.path.join(tmp, 'cache_off'), enabled=False)
+        report('original', *build_deck(content, image_folder, os.path.join(tmp, 'original.pptx')))
+
+        for workers in args.workers:
+            cache = os.path.join(tmp, f"cache_{workers}")
+            configure_image_optimizer(cache, max_workers=workers)
+            report(f"optimized x{workers}", *build_deck(content, image_folder, os.path.join(tmp, 'cold.pptx')))
+            report(f"  cached x{workers}", *build_deck(content, image_folder, os.path.join(tmp, 'warm.pptx')))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@ class Config:
     UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
     TEMPLATE_STORAGE_FOLDER = os.path.join(BASE_DIR, 'templates_storage')
     OUTPUT_FOLDER = os.path.join(BASE_DIR, 'output')
+    DATA_FOLDER = os.path.join(BASE_DIR, 'data')  # 服務內部狀態（任務佇列等）
     ALLOWED_EXTENSIONS = {'pdf', 'docx', 'doc', 'pptx', 'ppt', 'txt', 'md'}
     OUTPUT_FORMATS = ['docx', 'pptx', 'pdf', 'md']
 
@@ -39,9 +40,138 @@ class Config:
         }
     }
 
+    # 生成任務佇列配置
+    JOB_DB_PATH = os.path.join(DATA_FOLDER, 'jobs.db')
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 4)  # 每個進程的 worker 數量
+    # 應用啟動時即啟動 worker 並接手重啟前未完成的任務（測試時不啟動，JOB_QUEUE_AUTOSTART=0 關閉）；
+    # 關閉時 worker 在第一次提交 / 查詢任務時才啟動，進程結束時自動停止
+    JOB_QUEUE_AUTOSTART = os.environ.get('JOB_QUEUE_AUTOSTART', '1').lower() in ('1', 'true', 'yes')
+    JOB_STALE_SECONDS = 120  # 超過此時間未更新心跳的執行中任務視為 worker 已中斷
+    JOB_MAX_ATTEMPTS = 3  # 任務最多被執行的次數（含中斷後的重新排隊）
+
+    # LLM 客戶端連線配置
+    LLM_CONNECT_TIMEOUT = 10  # 連線超時（秒）
+    LLM_READ_TIMEOUT = 120  # 讀取超時（秒），長文檔生成需要較長時間
+    LLM_HTTP_POOL_SIZE = 32  # 每個進程保持的 keep-alive 連線數上限
+
+    # LLM 重試與限流配置
+    LLM_RETRY_MAX_ATTEMPTS = 4  # 每次生成最多嘗試次數
+    LLM_RETRY_BASE_DELAY = 1.0  # 指數退避的基礎等待秒數
+    LLM_RETRY_MAX_DELAY = 30.0  # 單次等待上限
+    LLM_RETRY_DEADLINE = 180.0  # 含重試與限流等待的整體截止時間
+    # 客戶端限流（每分鐘請求數 rpm / token 數 tpm），鍵為 'provider:model' 或 'provider'
+    LLM_RATE_LIMITS = {
+        'gemini': {'rpm': 15, 'tpm': 1000000},
+        'openai:gpt-4o-mini': {'rpm': 500, 'tpm': 200000},
+        'openai:gpt-4o': {'rpm': 500, 'tpm': 30000},
+    }
+
+    # LLM 響應快取配置
+    LLM_CACHE_ENABLED = True
+    LLM_CACHE_DB_PATH = os.path.join(DATA_FOLDER, 'llm_cache.db')
+    LLM_CACHE_MEMORY_ENTRIES = 256  # 記憶體 LRU 條目上限
+    LLM_CACHE_TTL_SECONDS = 7 * 24 * 3600  # 快取有效期
+    LLM_CACHE_MAX_DISK_MB = 200  # 磁碟層容量上限
+
+    # 並發相同請求合併（single-flight）配置
+    LLM_SINGLEFLIGHT_ENABLED = True
+    LLM_SINGLEFLIGHT_DB_PATH = os.path.join(DATA_FOLDER, 'llm_cache.db')  # 跨進程租約
+    LLM_SINGLEFLIGHT_LEASE_SECONDS = 300  # 應大於單次生成（含重試）的最長時間
+
+    # 分段生成（generation_mode=sections）配置
+    SECTION_GENERATION_WORKERS = 4  # 同時生成的章節數
+    SECTION_GENERATION_MIN_SECTIONS = 2  # 少於此章節數時改用整份生成
+    SECTION_GENERATION_MAX_SECTIONS = 16  # 超過時合併相鄰章節
+
+    # 分段 SOP 優化（generation_mode=chunked）配置
+    SOP_CHUNK_SLIDES = 5  # 每段最多投影片數
+    SOP_CHUNK_MAX_CHARS = 6000  # 每段字數上限
+    SOP_CHUNK_WORKERS = 4  # 同時處理的段數
+    SOP_CHUNK_MAX_RETRIES = 2  # 圖片標記缺失時重新請求的次數
+    SOP_CHUNK_TEMPLATE_EXCERPT_CHARS = 1500  # 每段附上的模板範例字數（另附模板標題骨架）
+
+    # 輸入 token 預算：按 'provider:model' 或 'provider' 查找，超出時截斷模板 → Profile → 用戶需求
+    LLM_INPUT_TOKEN_BUDGET = 100000
+    LLM_INPUT_TOKEN_BUDGETS = {
+        'gemini': 900000,
+        'openai:gpt-4o': 120000,
+        'openai:gpt-4o-mini': 120000,
+        'openai:gpt-4-turbo': 120000,
+        'openai:gpt-4': 7000,
+        'openai:gpt-3.5-turbo': 14000,
+    }
+
+    # 試算（/api/estimate）使用的輸出長度與速度假設
+    LLM_ESTIMATED_OUTPUT_TOKENS = 3000  # 每次請求的預估輸出 token
+    LLM_LATENCY_PROFILES = {
+        'gemini': {'first_token_seconds': 1.5, 'output_tokens_per_second': 150},
+        'openai': {'first_token_seconds': 1.0, 'output_tokens_per_second': 60},
+        'mock': {'first_token_seconds': 1.0},
+    }
+
+    # 供應商路由：備用目標，預設不啟用，避免故障或對沖時把請求（與費用）轉到另一個付費供應商。
+    # 啟用時在 api_config.json 設定 fallback_targets（優先於此設定），或在此列出，例如：
+    #   [{'api_type': 'openai', 'model': 'gpt-4o-mini'}, {'api_type': 'gemini', 'model': 'gemini-2.0-flash-exp'}]
+    # 只有已配置憑證的目標會被使用
+    LLM_FALLBACK_TARGETS = []
+    # 對沖：主目標超過其 p95 延遲仍未返回時請求下一個目標
+    LLM_HEDGE_PERCENTILE = 0.95
+    LLM_HEDGE_MIN_SAMPLES = 20  # 樣本不足時使用預設閾值
+    LLM_HEDGE_DEFAULT_DELAY = 30.0
+    LLM_HEDGE_MIN_DELAY = 2.0
+    LLM_HEDGE_MAX_DELAY = 60.0
+    LLM_ROUTER_WORKERS = int(os.environ.get('LLM_ROUTER_WORKERS') or 16)  # 有備用目標時執行調用的線程數（每進程）
+    # 熔斷器
+    LLM_BREAKER_FAILURE_THRESHOLD = 3  # 連續失敗次數
+    LLM_BREAKER_SLO_SECONDS = 90.0  # 延遲 SLO
+    LLM_BREAKER_SLO_BREACHES = 3  # 連續超出 SLO 次數
+    LLM_BREAKER_RESET_SECONDS = 30.0  # 打開後多久半開試探
+
+    # 調用遙測與自適應模型選擇
+    LLM_TELEMETRY_WINDOW = 500  # 每個模型保留的最近調用數
+    # 預設關閉：開啟後只在觀測到配置的模型較慢（或錯誤率過高）時改用同一供應商的其他候選模型
+    LLM_ADAPTIVE_ROUTING_ENABLED = os.environ.get('LLM_ADAPTIVE_ROUTING_ENABLED', '').lower() in ('1', 'true', 'yes')
+    LLM_ROUTING_CANDIDATES = {  # 同一供應商內可互換的模型，route='fast' 且無觀測資料時使用第一個
+        'openai': ['gpt-4o-mini', 'gpt-4o'],
+        'gemini': ['gemini-2.0-flash-exp', 'gemini-1.5-flash'],
+    }
+    LLM_ROUTING_SHORT_PROMPT_TOKENS = 1500  # 不超過此長度的 prompt 自動選擇最快的模型
+    LLM_ROUTING_MIN_SAMPLES = 5
+    LLM_ROUTING_MAX_ERROR_RATE = 0.2
+
+    # 模板文字快取：上傳時預先提取，按文件大小 / 修改時間 / 內容雜湊判斷是否有效
+    TEMPLATE_TEXT_CACHE_DB_PATH = os.path.join(DATA_FOLDER, 'templates.db')
+    TEMPLATE_TEXT_CACHE_MEMORY_ENTRIES = 32
+    TEMPLATE_ASSET_FOLDER = os.path.join(DATA_FOLDER, 'template_assets')  # 上傳時背景提取的模板圖片
+
+    # Profile (角色設定) 文件：載入後快取，按修改時間自動重新載入
+    PROFILE_FOLDER = BASE_DIR
+    PROFILE_RELOAD_INTERVAL = 2.0  # 最短多久檢查一次文件是否修改（秒）
+
+    # 成本記錄：背景批次寫入 SQLite，並維護每小時 / 每日按模型的彙總（/api/costs）
+    COST_DB_PATH = os.path.join(DATA_FOLDER, 'costs.db')
+    COST_LEGACY_CSV_PATH = os.path.join(BASE_DIR, 'logs', 'cost_log.csv')  # 首次建立資料庫時匯入
+    COST_LOG_FLUSH_INTERVAL = 1.0  # 背景寫入間隔（秒）
+    COST_LOG_BATCH_SIZE = 500  # 單次寫入的最大記錄數
+    COST_LOG_RETENTION_DAYS = 90  # 明細保留天數（彙總永久保留）
+
+    # 圖片存放區：提取出的圖片以內容雜湊存放，相同圖片只寫入一次，每次上傳一份清單
+    IMAGE_STORE_FOLDER = os.path.join(OUTPUT_FOLDER, 'image_store')
+    IMAGE_NEAR_DUPLICATE_THRESHOLD = 5  # 感知雜湊的漢明距離門檻（64 位元中不同的位元數），None 表示不檢查
+    # 'store'：提取時存入圖片存放區；'lazy'：只記錄圖片在上傳 PPTX 中的位置，需要時再從 zip 讀取
+    IMAGE_EXTRACTION_MODE = 'store'
+
+    # 圖片優化：插入 PPTX 前按顯示尺寸縮小並重新壓縮，結果按內容雜湊與目標像素快取
+    IMAGE_OPTIMIZE_ENABLED = True
+    IMAGE_OPTIMIZE_CACHE_FOLDER = os.path.join(OUTPUT_FOLDER, 'image_cache')
+    IMAGE_OPTIMIZE_DPI = 150  # 目標顯示解析度
+    IMAGE_OPTIMIZE_JPEG_QUALITY = 85
+    IMAGE_OPTIMIZE_WORKERS = 4
+
     # 確保目錄存在
     @staticmethod
     def init_app(app):
-        for folder in [Config.UPLOAD_FOLDER, Config.TEMPLATE_STORAGE_FOLDER, Config.OUTPUT_FOLDER]:
+        for key in ['UPLOAD_FOLDER', 'TEMPLATE_STORAGE_FOLDER', 'OUTPUT_FOLDER', 'DATA_FOLDER']:
+            folder = app.config[key]
             if not os.path.exists(folder):
                 os.makedirs(folder)
@@ -35,18 +35,32 @@ async function generateDocument() {
             output_format: format
         };
 
+        // SOP 優化按投影片分段並發處理，避免長簡報被壓縮且縮短等待時間
+        if (docType === 'sop_optimize') {
+            requestData.generation_mode = 'chunked';
+        }
+
         // 如果有圖片文件夾，添加到請求中
         if (window.extractedImageFolder) {
             requestData.image_folder = window.extractedImageFolder;
         }
 
-        const response = await fetch(`${API_BASE_URL}/generate`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(requestData)
-        });
-
-        const data = await response.json();
+        let data;
+        if (window.ReadableStream && window.TextDecoder) {
+            // 串流模式：邊生成邊顯示預覽
+            data = await streamGeneration(requestData, showStreamingPreview);
+        } else {
+            // 瀏覽器不支援串流時改用背景任務模式，輪詢任務狀態直到完成
+            const response = await fetch(`${API_BASE_URL}/generate`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ ...requestData, async: true })
+            });
+            data = await response.json();
+            if (data.success && data.job_id) {
+                data = await waitForJob(data.job_id);
+            }
+        }
 
         if (data.success) {
             showAlert(alertElement, 'success', '✅ 文檔生成成功！');
@@ -63,6 +77,99 @@ async function generateDocument() {
     }
 }
 
+/**
+ * 以 Server-Sent Events 串流生成文檔
+ * @param {Object} requestData - 生成參數
+ * @param {Function} onChunk - 收到片段時的回調，參數為目前累積的全文
+ * @returns {Promise<Object>} 生成結果（與同步生成響應格式相同）
+ */
+async function streamGeneration(requestData, onChunk) {
+    const response = await fetch(`${API_BASE_URL}/generate/stream`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(requestData)
+    });
+
+    // 參數錯誤等情況會直接返回 JSON
+    if (!response.ok || !response.body) {
+        return await response.json();
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let text = '';
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // SSE 事件以空行分隔
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let eventName = 'message';
+            let eventData = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                else if (line.startsWith('data:')) eventData += line.slice(5).trim();
+            });
+            if (!eventData) continue;
+
+            const payload = JSON.parse(eventData);
+            if (eventName === 'chunk') {
+                text += payload.text;
+                onChunk(text);
+            } else if (eventName === 'done') {
+                return payload;
+            } else if (eventName === 'error') {
+                return { success: false, error: payload.error };
+            }
+        }
+    }
+    return { success: false, error: '串流連線中斷' };
+}
+
+/**
+ * 顯示串流中的生成內容預覽
+ * @param {string} text - 目前已生成的內容
+ */
+function showStreamingPreview(text) {
+    document.getElementById('no-result').style.display = 'none';
+    document.getElementById('result-section').style.display = 'block';
+
+    const resultContent = document.getElementById('result-content');
+    let preview = document.getElementById('streaming-preview');
+    if (!preview) {
+        resultContent.innerHTML = `
+            <h4 style="margin-bottom: 15px; color: var(--dark);">⏳ 生成中...</h4>
+            <div id="streaming-preview" class="result-preview"></div>
+        `;
+        preview = document.getElementById('streaming-preview');
+    }
+    preview.textContent = text;
+}
+
+/**
+ * 輪詢生成任務直到完成
+ * @param {string} jobId - 任務 ID
+ * @param {number} interval - 輪詢間隔(毫秒)
+ * @returns {Promise<Object>} 任務結果（與同步生成響應格式相同）
+ */
+async function waitForJob(jobId, interval = 2000) {
+    while (true) {
+        const response = await fetch(`${API_BASE_URL}/jobs/${jobId}/result`);
+        // 202 表示任務仍在排隊或執行中
+        if (response.status !== 202) {
+            return await response.json();
+        }
+        await new Promise(resolve => setTimeout(resolve, interval));
+    }
+}
+
 /**
  * 顯示生成結果
  * @param {Object} result - 生成結果
@@ -34,6 +34,19 @@ async function uploadTemplate() {
     fileInput.value = '';
 }
 
+/**
+ * 模板背景預處理狀態
+ */
+function formatProcessingStatus(processing) {
+    const labels = {
+        queued: '⏳ 等待預處理',
+        processing: '⚙️ 預處理中',
+        failed: '⚠️ 預處理失敗'
+    };
+    const label = processing && labels[processing.status];
+    return label ? `<span title="${processing.error || ''}">${label}</span>` : '';
+}
+
 /**
  * 載入模板列表
  */
@@ -57,6 +70,7 @@ async function loadTemplates() {
                         <div class="list-item-meta">
                             <span>📦 ${formatFileSize(template.size)}</span>
                             <span>📅 ${template.modified}</span>
+                            ${formatProcessingStatus(template.processing)}
                         </div>
                     </div>
                     <div style="display: flex; gap: 8px;">
@@ -1,18 +1,180 @@
 import unittest
 import sys
 import os
+import shutil
+import tempfile
 
 # 添加項目根目錄到 path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app import create_app
+from config import Config
+
+
+class OpenAIStubServer:
+    """本地 OpenAI 相容 stub 服務，用於測試 OpenAI 調用路徑（含串流）"""
+
+    def __init__(self, content='stub content', usage=None, fail_times=0, fail_status=429, fail_headers=None,
+                 delay=0):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        import json
+        import threading
+        import time
+
+        self.content = content
+        self.usage = usage or {'prompt_tokens': 10, 'completion_tokens': 20}
+        self.requests = []
+        self.fail_times = fail_times
+        self.fail_status = fail_status
+        self.fail_headers = fail_headers or {'Retry-After': '0'}
+        self.delay = delay
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                stub.requests.append(body)
+                if stub.delay:
+                    # 模擬供應商響應緩慢
+                    time.sleep(stub.delay)
+                if len(stub.requests) <= stub.fail_times:
+                    # 模擬限流 / 服務錯誤
+                    payload = b'{"error": {"message": "rate limited"}}'
+                    self.send_response(stub.fail_status)
+                    for name, value in stub.fail_headers.items():
+                        self.send_header(name, value)
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                    return
+                if body.get('stream'):
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.end_headers()
+                    for word in stub.content.split(' '):
+                        chunk = {'choices': [{'delta': {'content': word + ' '}}]}
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                        self.wfile.flush()
+                    final = {'choices': [], 'usage': stub.usage}
+                    self.wfile.write(f"data: {json.dumps(final)}\n\n".encode())
+                    self.wfile.write(b"data: [DONE]\n\n")
+                else:
+                    payload = json.dumps({
+                        'choices': [{'message': {'content': stub.content}}],
+                        'usage': stub.usage
+                    }).encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def write_ole_file(path, streams):
+    """寫出最簡單的 OLE2 複合文件（512 位元組磁區，所有資料流放在根目錄、不使用 mini stream）"""
+    import struct
+    end_of_chain, free, fat_sector, no_stream = 0xFFFFFFFE, 0xFFFFFFFF, 0xFFFFFFFD, 0xFFFFFFFF
+    # 小於 4096 位元組的資料流會被視為存放在 mini stream，補齊到 4096 以上
+    blobs = [(name, data.ljust(4096, b'\0')) for name, data in streams.items()]
+    entries = 1 + len(blobs)
+    dir_sectors = -(-entries * 128 // 512)
+    data_sectors = sum(-(-len(blob) // 512) for _, blob in blobs)
+    fat_sectors = 1
+    while fat_sectors * 128 < fat_sectors + dir_sectors + data_sectors:
+        fat_sectors += 1
+
+    fat = [fat_sector] * fat_sectors
+    chains = []
+    for count in [dir_sectors] + [-(-len(blob) // 512) for _, blob in blobs]:
+        start = len(fat)
+        fat.extend(range(start + 1, start + count))
+        fat.append(end_of_chain)
+        chains.append(start)
+    fat.extend([free] * (fat_sectors * 128 - len(fat)))
+
+    def entry(name, kind, start, size, child=no_stream, right=no_stream):
+        encoded = (name + '\0').encode('utf-16-le')
+        return (encoded.ljust(64, b'\0') + struct.pack('<HBB', len(encoded), kind, 1)
+                + struct.pack('<III', no_stream, right, child) + b'\0' * 36 + struct.pack('<IQ', start, size))
+
+    directory = entry('Root Entry', 5, end_of_chain, 0, child=1 if blobs else no_stream)
+    for index, (name, blob) in enumerate(blobs):
+        right = index + 2 if index + 1 < len(blobs) else no_stream
+        directory += entry(name, 2, chains[index + 1], len(blob), right=right)
+    directory = directory.ljust(dir_sectors * 512, b'\0')
+
+    header = (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1' + b'\0' * 16
+              + struct.pack('<HHHHH', 0x3E, 3, 0xFFFE, 9, 6) + b'\0' * 6
+              + struct.pack('<IIIIIIIII', 0, fat_sectors, chains[0], 0, 4096, end_of_chain, 0, end_of_chain, 0)
+              + struct.pack('<109I', *(list(range(fat_sectors)) + [free] * (109 - fat_sectors))))
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(struct.pack(f'<{len(fat)}I', *fat))
+        f.write(directory)
+        for _, blob in blobs:
+            f.write(blob.ljust(-(-len(blob) // 512) * 512, b'\0'))
+
+
+def make_test_config(root):
+    """測試配置：上傳、模板、輸出與內部狀態（任務、成本、快取、圖片）都放在臨時目錄 root 下"""
+    output_folder = os.path.join(root, 'output')
+    data_folder = os.path.join(root, 'data')
+
+    class TestConfig(Config):
+        TESTING = True
+        UPLOAD_FOLDER = os.path.join(root, 'uploads')
+        TEMPLATE_STORAGE_FOLDER = os.path.join(root, 'templates_storage')
+        OUTPUT_FOLDER = output_folder
+        DATA_FOLDER = data_folder
+        JOB_DB_PATH = os.path.join(data_folder, 'jobs.db')
+        JOB_QUEUE_AUTOSTART = False
+        COST_DB_PATH = os.path.join(data_folder, 'costs.db')
+        COST_LEGACY_CSV_PATH = None
+        LLM_CACHE_DB_PATH = os.path.join(data_folder, 'llm_cache.db')
+        LLM_SINGLEFLIGHT_DB_PATH = os.path.join(data_folder, 'llm_cache.db')
+        TEMPLATE_TEXT_CACHE_DB_PATH = os.path.join(data_folder, 'templates.db')
+        TEMPLATE_ASSET_FOLDER = os.path.join(data_folder, 'template_assets')
+        IMAGE_STORE_FOLDER = os.path.join(output_folder, 'image_store')
+        IMAGE_OPTIMIZE_CACHE_FOLDER = os.path.join(output_folder, 'image_cache')
+
+    return TestConfig
+
 
 class BasicTestCase(unittest.TestCase):
     def setUp(self):
-        self.app = create_app()
+        self.tmp_root = tempfile.mkdtemp(prefix='doc-gen-test-')
+        self.app = create_app(make_test_config(self.tmp_root))
         self.app.testing = True
         self.client = self.app.test_client()
 
+    def tearDown(self):
+        from app.utils import get_cost_ledger
+
+        queue = getattr(self.app, 'job_queue', None)
+        if queue is not None:
+            queue.stop()
+        get_cost_ledger().flush()
+        shutil.rmtree(self.tmp_root, ignore_errors=True)
+
     def test_index(self):
         """測試首頁是否可以訪問"""
         response = self.client.get('/')
@@ -85,7 +247,8 @@ class BasicTestCase(unittest.TestCase):
             "doc_type": "sop",
             "template": filename, # 前端使用 template
             "requirements": "test requirements",
-            "output_format": "md"
+            "output_format": "md",
+            "async": False
         })
         
         # 如果返回 500，說明參數驗證通過了（進入了生成邏輯但失敗了）
@@ -121,7 +284,7 @@ class BasicTestCase(unittest.TestCase):
             'openai_model': '' # 空字符串
         }
         
-        with patch('requests.post') as mock_post:
+        with patch('requests.Session.post') as mock_post:
             mock_response = MagicMock()
             mock_response.status_code = 200
             mock_response.json.return_value = {
@@ -193,7 +356,8 @@ class BasicTestCase(unittest.TestCase):
                 "doc_type": "sop",
                 "template": filename,
                 "requirements": "test req",
-                "output_format": "md"
+                "output_format": "md",
+                "async": False
             })
             
             self.assertEqual(response.status_code, 200)
@@ -264,7 +428,8 @@ class BasicTestCase(unittest.TestCase):
                     "doc_type": "sop",
                     "template": filename,
                     "requirements": "test req",
-                    "output_format": "md"
+                    "output_format": "md",
+                    "async": False
                 })
                 
                 self.assertEqual(response.status_code, 200)
@@ -280,5 +445,1579 @@ class BasicTestCase(unittest.TestCase):
                 except PermissionError:
                     pass
 
+    def test_async_generation_job(self):
+        """測試背景任務模式生成"""
+        from unittest.mock import patch
+        import time
+
+        folder = self.app.config['TEMPLATE_STORAGE_FOLDER']
+        filename = 'test_async_job.txt'
+        file_path = os.path.join(folder, filename)
+        with open(file_path, 'w') as f:
+            f.write('test content')
+
+        try:
+            with patch('app.services.ai_service.AIService.generate_content') as mock_generate:
+                mock_generate.return_value = ("# Async Content", {
+                    "model": "mock-model",
+                    "input_tokens": 10,
+                    "output_tokens": 20,
+                    "cost": 0.0
+                })
+
+                response = self.client.post('/api/generate', json={
+                    "doc_type": "sop",
+                    "template": filename,
+                    "requirements": "test req",
+                    "output_format": "md"
+                })
+                self.assertEqual(response.status_code, 202)
+                job_id = response.json['job_id']
+
+                # 輪詢直到任務完成
+                for _ in range(50):
+                    result = self.client.get(f'/api/jobs/{job_id}/result')
+                    if result.status_code != 202:
+                        break
+                    time.sleep(0.1)
+
+                self.assertEqual(result.status_code, 200)
+                self.assertTrue(result.json.get('success'))
+                self.assertTrue(result.json['filename'].endswith('.md'))
+
+                status = self.client.get(f'/api/jobs/{job_id}')
+                self.assertEqual(status.json['status'], 'done')
+        finally:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+        # 不存在的任務
+        response = self.client.get('/api/jobs/not-exists')
+        self.assertEqual(response.status_code, 404)
+
+    def test_job_store_recovers_stale_jobs(self):
+        """測試 worker 中斷後任務重新排隊"""
+        import tempfile
+        from app.services.job_service import JobStore
+
+        with tempfile.TemporaryDirectory() as tmp:
+            store = JobStore(os.path.join(tmp, 'jobs.db'))
+            job = store.create('generate', {'doc_type': 'sop'})
+            claimed = store.claim_next('worker-1', ['generate'])
+            self.assertEqual(claimed['id'], job['id'])
+            self.assertEqual(claimed['status'], 'running')
+            self.assertIsNone(store.claim_next('worker-2', ['generate']))
+
+            # 模擬 worker 崩潰：心跳超時後任務回到佇列
+            self.assertEqual(store.recover_stale(stale_seconds=-1, max_attempts=3), 1)
+            reclaimed = store.claim_next('worker-2', ['generate'])
+            self.assertEqual(reclaimed['id'], job['id'])
+            self.assertEqual(reclaimed['attempts'], 2)
+            self.assertEqual(reclaimed['payload'], {'doc_type': 'sop'})
+
+    def test_job_queue_autostart_recovers_on_startup(self):
+        """測試非測試環境下應用啟動時即啟動 worker 並接手中斷的任務"""
+        from app.services.job_service import JobStore
+
+        class StartupConfig(make_test_config(self.tmp_root)):
+            TESTING = False
+            JOB_QUEUE_AUTOSTART = True
+            JOB_STALE_SECONDS = -1
+
+        store = JobStore(StartupConfig.JOB_DB_PATH)
+        job = store.create('unknown', {})
+        store.claim_next('crashed-worker', ['unknown'])
+
+        app = create_app(StartupConfig)
+        try:
+            self.assertTrue(hasattr(app, 'job_queue'))
+            self.assertEqual(store.get(job['id'])['status'], 'queued')
+        finally:
+            app.job_queue.stop(timeout=1.0)
+
+    def test_stream_generation_mock(self):
+        """測試串流生成 (SSE) - 模擬模式"""
+        from unittest.mock import patch
+        import json
+
+        folder = self.app.config['TEMPLATE_STORAGE_FOLDER']
+        filename = 'test_stream.txt'
+        file_path = os.path.join(folder, filename)
+        with open(file_path, 'w') as f:
+            f.write('test content')
+
+        try:
+            with patch('app.services.ai_service.AIService.load_api_config') as mock_load:
+                mock_load.return_value = {'api_type': 'mock'}
+                response = self.client.post('/api/generate/stream', json={
+                    "doc_type": "sop",
+                    "template": filename,
+                    "requirements": "test req",
+                    "output_format": "md",
+                    "no_cache": True
+                })
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.mimetype.startswith('text/event-stream'))
+                body = response.get_data(as_text=True)
+
+            events = []
+            for raw in body.strip().split('\n\n'):
+                lines = dict(line.split(': ', 1) for line in raw.split('\n'))
+                events.append((lines['event'], json.loads(lines['data'])))
+
+            chunks = [data['text'] for name, data in events if name == 'chunk']
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(events[-1][0], 'done')
+            done = events[-1][1]
+            self.assertTrue(done['success'])
+            self.assertEqual(done['usage']['model'], 'mock-model')
+            self.assertIn('模擬生成文檔', ''.join(chunks))
+        finally:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+        # 參數錯誤直接返回 400，不進入串流
+        response = self.client.post('/api/generate/stream', json={})
+        self.assertEqual(response.status_code, 400)
+
+    def test_stream_openai_stub(self):
+        """測試 OpenAI 串流調用 - 本地 stub 服務"""
+        from app.services.ai_service import AIService
+        from unittest.mock import patch
+
+        service = AIService({'OPENAI_PRICING': {'gpt-4o-mini': {'input': 1.0, 'output': 2.0}}})
+        with OpenAIStubServer(content='hello streaming world') as stub:
+            config = {
+                'api_type': 'openai',
+                'openai_api_key': 'test_key',
+                'openai_model': 'gpt-4o-mini',
+                'openai_base_url': stub.base_url
+            }
+            with patch.object(AIService, 'load_api_config', return_value=config), \
+                    patch('app.services.ai_service.log_cost_to_file') as mock_log:
+                events = list(service.stream_content('test prompt'))
+
+            self.assertTrue(stub.requests[0]['stream'])
+            chunks = [value for kind, value in events if kind == 'chunk']
+            self.assertEqual(''.join(chunks).strip(), 'hello streaming world')
+            kind, usage = events[-1]
+            self.assertEqual(kind, 'usage')
+            self.assertEqual(usage['input_tokens'], 10)
+            self.assertEqual(usage['output_tokens'], 20)
+            self.assertAlmostEqual(usage['cost'], (10 * 1.0 + 20 * 2.0) / 1000000)
+            mock_log.assert_called_once()
+
+    def test_response_cache_tiers(self):
+        """測試 LLM 響應快取：記憶體 LRU、磁碟層、TTL 與容量淘汰"""
+        import tempfile
+        from app.services.cache_service import ResponseCache
+
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'cache.db')
+            cache = ResponseCache(db_path=db_path, max_memory_entries=1)
+            key_a = ResponseCache.make_key('openai', 'gpt-4o', {'temperature': 0.7}, 'prompt a')
+            key_b = ResponseCache.make_key('openai', 'gpt-4o', {'temperature': 0.7}, 'prompt b')
+            self.assertNotEqual(key_a, ResponseCache.make_key('openai', 'gpt-4o', {'temperature': 0.2}, 'prompt a'))
+
+            self.assertIsNone(cache.get(key_a))
+            cache.set(key_a, 'content a', {'model': 'gpt-4o', 'cost': 0.01})
+            cache.set(key_b, 'content b', {'model': 'gpt-4o', 'cost': 0.02})
+
+            # key_a 已被擠出記憶體層，但仍可從磁碟層讀取
+            self.assertEqual(cache.get(key_a), ('content a', {'model': 'gpt-4o', 'cost': 0.01}))
+            stats = cache.stats()
+            self.assertEqual(stats['disk_hits'], 1)
+            self.assertEqual(stats['misses'], 1)
+            self.assertEqual(stats['disk_entries'], 2)
+
+            # 重啟後磁碟層仍然有效
+            reopened = ResponseCache(db_path=db_path)
+            self.assertEqual(reopened.get(key_b)[0], 'content b')
+
+            # 容量淘汰：只保留最近使用的條目
+            reopened.max_disk_bytes = len('content b')
+            reopened.prune()
+            self.assertEqual(reopened.stats()['disk_entries'], 1)
+
+            # TTL 過期
+            expired = ResponseCache(db_path=db_path, ttl_seconds=-1)
+            self.assertIsNone(expired.get(key_b))
+
+    def test_ai_service_cache_hit(self):
+        """測試重複 prompt 命中快取且成本為 0"""
+        from app.services.ai_service import AIService
+        from unittest.mock import patch
+
+        service = AIService({'OPENAI_PRICING': {}})
+        with patch.object(AIService, 'load_api_config', return_value={'api_type': 'mock'}), \
+                patch.object(AIService, 'call_mock_api', return_value=('content', {
+                    'model': 'mock-model', 'input_tokens': 5, 'output_tokens': 7, 'cost': 0.5
+                })) as mock_call:
+            first, first_usage = service.generate_content('same prompt')
+            second, second_usage = service.generate_content('same prompt')
+            self.assertEqual(mock_call.call_count, 1)
+            self.assertEqual(first, second)
+            self.assertNotIn('cached', first_usage)
+            self.assertTrue(second_usage['cached'])
+            self.assertEqual(second_usage['cost'], 0.0)
+            self.assertEqual(second_usage['model'], 'mock-model')
+
+            # 單次請求略過快取
+            service.generate_content('same prompt', use_cache=False)
+            self.assertEqual(mock_call.call_count, 2)
+
+            # 未通過檢查的輸出不寫入快取
+            service.generate_content('rejected prompt', accept=lambda content: False)
+            service.generate_content('rejected prompt')
+            self.assertEqual(mock_call.call_count, 4)
+
+        response = self.client.get('/api/cache/stats')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hits', response.json['stats'])
+
+    def test_provider_clients_reused(self):
+        """測試供應商客戶端重用與憑證變更時重建"""
+        from app.services.provider_clients import ProviderClients
+        from unittest.mock import patch
+
+        clients = ProviderClients(connect_timeout=3, read_timeout=30)
+        self.assertIs(clients.http_session(), clients.http_session())
+        self.assertEqual(clients.timeout, (3, 30))
+
+        with patch('app.services.provider_clients.genai') as mock_genai:
+            config = {'temperature': 0.7}
+            first = clients.gemini_model('key-1', 'gemini-x', config)
+            second = clients.gemini_model('key-1', 'gemini-x', dict(config))
+            self.assertIs(first, second)
+            self.assertEqual(mock_genai.configure.call_count, 1)
+            self.assertEqual(mock_genai.GenerativeModel.call_count, 1)
+
+            # 不同生成參數使用不同的模型物件
+            clients.gemini_model('key-1', 'gemini-x', {'temperature': 0.1})
+            self.assertEqual(mock_genai.GenerativeModel.call_count, 2)
+
+            # API Key 變更時重新配置
+            clients.gemini_model('key-2', 'gemini-x', config)
+            self.assertEqual(mock_genai.configure.call_count, 2)
+
+        session = clients.http_session()
+        clients.reset()
+        self.assertIsNot(session, clients.http_session())
+
+    def test_openai_stub_uses_pooled_session(self):
+        """測試 OpenAI 調用經由共用 Session 與本地 stub 通訊"""
+        from app.services.ai_service import AIService
+        from unittest.mock import patch
+
+        service = AIService({'OPENAI_PRICING': {}, 'LLM_CACHE_ENABLED': False})
+        with OpenAIStubServer(content='pooled') as stub:
+            service.api_config = {
+                'openai_api_key': 'test_key',
+                'openai_base_url': stub.base_url
+            }
+            with patch('app.services.ai_service.log_cost_to_file'):
+                session = service.clients.http_session()
+                for _ in range(2):
+                    content, usage = service.call_openai_api('test prompt')
+                    self.assertEqual(content, 'pooled')
+                self.assertIs(session, service.clients.http_session())
+            self.assertEqual(len(stub.requests), 2)
+
+    def test_config_store_snapshots(self):
+        """測試 API 配置快照：按文件簽名重新加載、不可變、保存後立即生效"""
+        import json
+        import tempfile
+        from app.services.config_store import ConfigStore
+        from unittest.mock import patch
+
+        with tempfile.TemporaryDirectory() as tmp:
+            config_path = os.path.join(tmp, 'api_config.json')
+            with open(config_path, 'w', encoding='utf-8') as f:
+                json.dump({'api_type': 'mock'}, f)
+
+            with patch.dict(os.environ, {'OPENAI_MODEL': 'gpt-4o'}, clear=False):
+                store = ConfigStore(config_path, check_interval=0)
+            snapshot = store.snapshot()
+            self.assertEqual(snapshot['api_type'], 'mock')
+            self.assertEqual(snapshot['openai_model'], 'gpt-4o')
+            with self.assertRaises(TypeError):
+                snapshot['api_type'] = 'openai'
+
+            # 文件未變更時返回同一份快照，不重新解析
+            with patch('app.services.config_store.json.load') as mock_load:
+                self.assertIs(store.snapshot(), snapshot)
+                mock_load.assert_not_called()
+
+            # 保存後立即切換，舊快照保持不變
+            saved = store.save({'api_type': 'openai'})
+            self.assertIs(store.snapshot(), saved)
+            self.assertEqual(saved['api_type'], 'openai')
+            self.assertEqual(snapshot['api_type'], 'mock')
+
+            # 文件被外部修改後重新加載
+            with open(config_path, 'w', encoding='utf-8') as f:
+                json.dump({'api_type': 'gemini', 'gemini_model': 'gemini-x'}, f)
+            self.assertEqual(store.snapshot()['gemini_model'], 'gemini-x')
+
+    def test_retry_after_parsing(self):
+        """測試 Retry-After 與供應商限流標頭解析"""
+        from app.services.retry_service import parse_retry_after
+
+        self.assertEqual(parse_retry_after({'Retry-After': '2'}), 2.0)
+        self.assertEqual(parse_retry_after({'retry-after-ms': '1500'}), 1.5)
+        self.assertEqual(parse_retry_after({'x-ratelimit-reset-requests': '6m0s',
+                                            'x-ratelimit-reset-tokens': '20ms'}), 360.0)
+        self.assertIsNone(parse_retry_after({}))
+
+    def test_openai_retries_429_from_stub(self):
+        """測試 OpenAI 遇到 429 時退避重試，非重試類錯誤立即失敗"""
+        from app.services.ai_service import AIService
+        from unittest.mock import patch
+
+        config = {'OPENAI_PRICING': {}, 'LLM_CACHE_ENABLED': False, 'LLM_RETRY_BASE_DELAY': 0.01}
+        service = AIService(config)
+        with patch('app.services.ai_service.log_cost_to_file'):
+            with OpenAIStubServer(content='after retry', fail_times=2) as stub:
+                service.api_config = {'openai_api_key': 'k', 'openai_base_url': stub.base_url}
+                content, _ = service.call_openai_api('prompt')
+                self.assertEqual(content, 'after retry')
+                self.assertEqual(len(stub.requests), 3)
+
+            # 超過最大嘗試次數
+            with OpenAIStubServer(fail_times=10) as stub:
+                service.api_config = {'openai_api_key': 'k', 'openai_base_url': stub.base_url}
+                with self.assertRaises(Exception):
+                    service.call_openai_api('prompt')
+                self.assertEqual(len(stub.requests), service.retry_policy.max_attempts)
+
+            # 400 不可重試
+            with OpenAIStubServer(fail_times=10, fail_status=400) as stub:
+                service.api_config = {'openai_api_key': 'k', 'openai_base_url': stub.base_url}
+                with self.assertRaises(Exception):
+                    service.call_openai_api('prompt')
+                self.assertEqual(len(stub.requests), 1)
+
+    def test_retry_policy_honors_deadline(self):
+        """測試 Retry-After 超過截止時間時不再等待"""
+        from app.services.retry_service import RetryPolicy, ProviderHTTPError
+
+        sleeps = []
+        policy = RetryPolicy(max_attempts=5, deadline=10, sleep=sleeps.append)
+
+        def always_limited(deadline):
+            raise ProviderHTTPError('429', status_code=429, retry_after=60)
+
+        with self.assertRaises(ProviderHTTPError):
+            policy.call(always_limited)
+        self.assertEqual(sleeps, [])
+
+    def test_rate_limiter_token_bucket(self):
+        """測試客戶端令牌桶限制每分鐘請求數"""
+        from app.services.retry_service import RateLimiter, RateLimitTimeout
+
+        now = [0.0]
+        sleeps = []
+        limiter = RateLimiter({'openai:gpt-4o': {'rpm': 2, 'tpm': 1000}},
+                              sleep=sleeps.append, clock=lambda: now[0])
+        self.assertEqual(limiter.acquire('openai', 'gpt-4o', tokens=100), 0.0)
+        self.assertEqual(limiter.acquire('openai', 'gpt-4o', tokens=100), 0.0)
+        # 第三個請求需要等待補充（每 30 秒補 1 個請求配額）
+        self.assertAlmostEqual(limiter.acquire('openai', 'gpt-4o', tokens=100), 30.0)
+        self.assertEqual(len(sleeps), 1)
+        # 截止時間內拿不到配額時直接失敗
+        with self.assertRaises(RateLimitTimeout):
+            limiter.acquire('openai', 'gpt-4o', tokens=100, deadline=1.0)
+        # 未配置的模型不限流
+        self.assertEqual(limiter.acquire('openai', 'gpt-3.5-turbo', tokens=10 ** 6), 0.0)
+
+    def test_concurrent_identical_requests_coalesced(self):
+        """測試並發的相同請求只調用一次模型"""
+        from app.services.ai_service import AIService
+        from unittest.mock import patch
+        import threading
+        import time
+
+        service = AIService({'OPENAI_PRICING': {}, 'LLM_CACHE_ENABLED': False})
+        started = threading.Event()
+
+        def slow_call(prompt, api_config=None):
+            started.set()
+            time.sleep(0.3)
+            return 'content', {'model': 'mock-model', 'input_tokens': 5, 'output_tokens': 7, 'cost': 0.5}
+
+        results = []
+        with patch.object(AIService, 'load_api_config', return_value={'api_type': 'mock'}), \
+                patch.object(AIService, 'call_mock_api', side_effect=slow_call) as mock_call:
+            leader = threading.Thread(target=lambda: results.append(service.generate_content('same prompt')))
+            leader.start()
+            started.wait(2)
+            followers = [threading.Thread(target=lambda: results.append(service.generate_content('same prompt')))
+                         for _ in range(4)]
+            for t in followers:
+                t.start()
+            for t in [leader] + followers:
+                t.join()
+
+        self.assertEqual(mock_call.call_count, 1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(content == 'content' for content, _ in results))
+        coalesced = [usage for _, usage in results if usage.get('coalesced')]
+        self.assertEqual(len(coalesced), 4)
+        self.assertTrue(all(usage['cost'] == 0.0 for usage in coalesced))
+        self.assertEqual(service.singleflight.in_flight(), 0)
+
+    def test_singleflight_cross_process_lease(self):
+        """測試其他進程持有租約時等待其結果，租約過期後自行接手"""
+        from app.services.coalesce_service import SingleFlight
+        import tempfile
+        import time
+
+        with tempfile.TemporaryDirectory() as tmp:
+            flight = SingleFlight(db_path=os.path.join(tmp, 'inflight.db'), poll_interval=0.01)
+            conn = flight._db.connect()
+            conn.execute('INSERT INTO llm_inflight (key, owner, expires_at) VALUES (?, ?, ?)',
+                         ('k', 'other-host:1', time.time() + 60))
+
+            result, shared = flight.do('k', lambda: 'own', lookup=lambda: 'from other process')
+            self.assertEqual(result, 'from other process')
+            self.assertTrue(shared)
+
+            conn.execute('UPDATE llm_inflight SET expires_at = ?', (time.time() - 1,))
+            result, shared = flight.do('k', lambda: 'own', lookup=lambda: None)
+            self.assertEqual(result, 'own')
+            self.assertFalse(shared)
+            # 完成後釋放租約
+            self.assertIsNone(conn.execute('SELECT 1 FROM llm_inflight').fetchone())
+
+            # 沒有 lookup（略過快取）時拿不到其他進程的結果，不等待租約直接執行
+            conn.execute('INSERT INTO llm_inflight (key, owner, expires_at) VALUES (?, ?, ?)',
+                         ('k', 'other-host:1', time.time() + 60))
+            started = time.monotonic()
+            result, shared = flight.do('k', lambda: 'own')
+            self.assertEqual((result, shared), ('own', False))
+            self.assertLess(time.monotonic() - started, 1.0)
+            self.assertEqual(conn.execute('SELECT owner FROM llm_inflight').fetchone()['owner'], 'other-host:1')
+
+    def test_response_cache_peek_skips_stats(self):
+        """測試 peek 讀取快取但不計入命中統計"""
+        from app.services.cache_service import ResponseCache
+
+        cache = ResponseCache()
+        self.assertIsNone(cache.peek('k'))
+        cache.set('k', 'content', {'input_tokens': 1})
+        self.assertEqual(cache.peek('k'), ('content', {'input_tokens': 1}))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (0, 0))
+        self.assertEqual(cache.get('k')[0], 'content')
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_split_template_sections(self):
+        """測試按最高層級標題切分模板"""
+        from app.services.section_service import SectionGenerator
+
+        generator = SectionGenerator(ai_service=None)
+        template = "文件說明\n1. 目的\n說明目的\n1.1 背景\n背景內容\n2. 範圍\n適用範圍\n3、職責\n各部門職責"
+        sections = generator.split_sections(template)
+        self.assertEqual([s.title for s in sections], ['1. 目的', '2. 範圍', '3、職責'])
+        # 下級標題與前言保留在章節內
+        self.assertIn('1.1 背景', sections[0].body)
+        self.assertIn('文件說明', sections[0].body)
+        self.assertEqual(generator.split_sections('# 標題一\n內容\n## 小節\n# 標題二')[1].title, '標題二')
+        self.assertEqual(generator.split_sections('沒有任何標題的內容'), [])
+
+        # 章節過多時合併相鄰章節
+        small = SectionGenerator(ai_service=None, max_sections=2)
+        merged = small.split_sections('# A\na\n# B\nb\n# C\nc')
+        self.assertEqual(len(merged), 2)
+        self.assertIn('B', merged[0].body)
+
+    def test_section_generation_mode(self):
+        """測試分段生成：章節並發生成並按模板順序拼接"""
+        from app.services.ai_service import AIService
+        from unittest.mock import patch
+        import re
+        import time
+
+        folder = self.app.config['TEMPLATE_STORAGE_FOLDER']
+        filename = 'test_sections.md'
+        file_path = os.path.join(folder, filename)
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write('# 目的\n說明\n# 範圍\n說明\n# 職責\n說明\n# 流程\n說明')
+
+        def fake_call(prompt, api_config=None):
+            title = re.search(r'只撰寫第 \d+ 章「(.+?)」', prompt).group(1)
+            # 越前面的章節越慢，驗證結果仍按順序拼接
+            time.sleep({'目的': 0.3, '範圍': 0.2}.get(title, 0.05))
+            return f"# {title}\n內容", {'model': 'mock-model', 'input_tokens': 10, 'output_tokens': 5, 'cost': 0.1}
+
+        try:
+            with patch.object(AIService, 'load_api_config', return_value={'api_type': 'mock'}), \
+                    patch.object(AIService, 'call_mock_api', side_effect=fake_call) as mock_call:
+                started = time.time()
+                response = self.client.post('/api/generate', json={
+                    "doc_type": "system_doc",
+                    "template": filename,
+                    "requirements": "section test",
+                    "output_format": "md",
+                    "generation_mode": "sections",
+                    "no_cache": True,
+                    "async": False
+                })
+                elapsed = time.time() - started
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(mock_call.call_count, 4)
+            self.assertLess(elapsed, 0.6)
+            prompt = mock_call.call_args_list[0][0][0]
+            self.assertIn('1. 目的\n2. 範圍\n3. 職責\n4. 流程', prompt)
+
+            usage = response.json['usage']
+            self.assertEqual(usage['sections'], 4)
+            self.assertEqual(usage['input_tokens'], 40)
+            self.assertAlmostEqual(usage['cost'], 0.4)
+
+            md_path = os.path.join(self.app.config['OUTPUT_FOLDER'], response.json['files']['md'])
+            with open(md_path, encoding='utf-8') as f:
+                content = f.read()
+            titles = re.findall(r'^# (.+)$', content, re.M)
+            self.assertEqual(titles, ['目的', '範圍', '職責', '流程'])
+        finally:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def test_chunked_sop_optimize(self):
+        """測試分段 SOP 優化：按投影片切分，只重新請求遺漏圖片標記的窗口"""
+        from app.services.section_service import ChunkedSOPOptimizer
+        import re
+        import threading
+
+        slides = []
+        for n in range(1, 8):
+            body = f"[投影片 {n}]\n步驟 {n}"
+            if n in (2, 6):
+                body += f"\n\n[圖片 {n}-1: 來自投影片 {n}]\n"
+            slides.append(body)
+        deck = '\n\n'.join(slides)
+
+        class FakeAI:
+            def __init__(self):
+                self.prompts = []
+                self.cache_flags = []
+                self.lock = threading.Lock()
+
+            def generate_content(self, prompt, use_cache=True, accept=None):
+                with self.lock:
+                    self.prompts.append(prompt)
+                    self.cache_flags.append(use_cache)
+                source = prompt.split('=== 本段原始 SOP 內容 ===')[1].split('=== 優化要求 ===')[0]
+                output = re.sub(r'\[投影片 \d+\]\n?', '', source).strip()
+                # 第二段第一次輸出時遺漏圖片標記
+                if '投影片 6-7' in prompt and '遺漏' not in prompt:
+                    output = re.sub(r'\[圖片 6-1.*?\]', '', output)
+                return output, {'model': 'fake', 'input_tokens': 1, 'output_tokens': 1, 'cost': 0.01}
+
+        fake = FakeAI()
+        optimizer = ChunkedSOPOptimizer(fake, slides_per_window=5)
+        windows = optimizer.split_windows(deck)
+        self.assertEqual([w.slides for w in windows], [[1, 2, 3, 4, 5], [6, 7]])
+        self.assertEqual(windows[0].markers, ['2-1'])
+
+        content, usage = optimizer.generate('', 'template', windows)
+        self.assertEqual(len(fake.prompts), 3)
+        self.assertEqual(usage['chunks'], 2)
+        self.assertEqual(usage['retries'], 1)
+        # 重新請求略過快取
+        self.assertEqual(sorted(fake.cache_flags), [False, True, True])
+        self.assertIn('[圖片 2-1', content)
+        self.assertIn('[圖片 6-1', content)
+        self.assertLess(content.index('步驟 1'), content.index('步驟 7'))
+        self.assertNotIn('[投影片', content)
+
+        # 模型始終遺漏時，標記補在段落末尾
+        class ForgetfulAI(FakeAI):
+            def generate_content(self, prompt, use_cache=True, accept=None):
+                output, usage_info = super().generate_content(prompt, use_cache, accept)
+                return re.sub(r'\[圖片.*?\]', '', output), usage_info
+
+        content, usage = ChunkedSOPOptimizer(ForgetfulAI(), slides_per_window=5, max_retries=1).generate('', '', windows)
+        self.assertEqual(usage['requests'], 4)
+        self.assertIn('[圖片 6-1: 來自投影片 6]', content)
+
+        # 長模板只以骨架與開頭範例出現在每段 Prompt 中
+        template = '\n'.join(f"{n}. 章節{n}\n" + '範例內容' * 100 for n in range(1, 11))
+        fake = FakeAI()
+        ChunkedSOPOptimizer(fake, slides_per_window=5, template_excerpt_chars=500).generate('', template, windows)
+        for prompt in fake.prompts:
+            self.assertIn('章節10', prompt)
+            self.assertLess(len(prompt), len(template))
+        prompts = ChunkedSOPOptimizer(fake, slides_per_window=5, template_excerpt_chars=500).build_prompts(
+            '', template, windows)
+        self.assertEqual(len(prompts), 2)
+        self.assertTrue(all(len(prompt) < len(template) for prompt in prompts))
+        # 上傳時預處理的標題骨架優先於從模板文字產生
+        reference = ChunkedSOPOptimizer(fake, template_excerpt_chars=500).template_reference(
+            template, [{'title': '預處理標題', 'level': 1}])
+        self.assertIn('預處理標題', reference)
+        self.assertNotIn('章節10', reference)
+
+        # 沒有投影片標記時按空行分段
+        self.assertEqual(len(ChunkedSOPOptimizer.split_slides('第一段\n\n第二段\n\n\n第三段')), 3)
+
+    def test_prompt_budget_trims_low_priority_parts(self):
+        """測試輸入超出預算時先截斷模板，再截斷 Profile，最後才截斷需求"""
+        from app.services.token_service import TokenCounter, PromptBudget, TRUNCATION_NOTICE
+
+        counter = TokenCounter()
+        build = lambda p: f"{p['profile']}\n模板：{p['template']}\n需求：{p['requirements']}"
+        parts = {'template': '模' * 500, 'profile': '角' * 100, 'requirements': '需' * 50}
+
+        budget = PromptBudget(counter, budgets={'mock': 300})
+        prompt, fitted, report = budget.fit(parts, ('template', 'profile', 'requirements'), build, 'mock', 'mock-model')
+        self.assertLessEqual(counter.count(prompt, 'mock', 'mock-model'), 300)
+        self.assertTrue(fitted['template'].endswith(TRUNCATION_NOTICE))
+        self.assertEqual(fitted['profile'], parts['profile'])
+        self.assertEqual(fitted['requirements'], parts['requirements'])
+        self.assertEqual(list(report['trimmed']), ['template'])
+
+        # 編碼載入（可能下載）期間不佔用鎖：其他線程直接使用估算
+        from unittest.mock import patch, MagicMock
+        from app.services.token_service import heuristic_token_count
+        import threading
+
+        release = threading.Event()
+        fake_tiktoken = MagicMock()
+        fake_encoding = MagicMock()
+        fake_encoding.encode.side_effect = lambda text, disallowed_special=(): list(text)
+        fake_tiktoken.encoding_for_model.side_effect = lambda model: release.wait(5) and fake_encoding
+        with patch('app.services.token_service.TIKTOKEN_AVAILABLE', True), \
+                patch('app.services.token_service.tiktoken', fake_tiktoken, create=True):
+            counter = TokenCounter()
+            loader = threading.Thread(target=counter.count, args=('abc', 'openai', 'gpt-4o'))
+            loader.start()
+            while not fake_tiktoken.encoding_for_model.called:
+                time.sleep(0.01)
+            self.assertEqual(counter.count('abcdef', 'openai', 'gpt-4o'), heuristic_token_count('abcdef'))
+            release.set()
+            loader.join(5)
+            self.assertEqual(counter.count('abcdef', 'openai', 'gpt-4o'), 6)
+            self.assertEqual(fake_tiktoken.encoding_for_model.call_count, 1)
+        self.assertGreater(report['original_prompt_tokens'], report['prompt_tokens'])
+
+        # 模板截斷完仍超出時繼續截斷 Profile
+        prompt, fitted, report = PromptBudget(counter, budgets={'mock': 100}).fit(
+            parts, ('template', 'profile', 'requirements'), build, 'mock', 'mock-model')
+        self.assertLessEqual(counter.count(prompt, 'mock', 'mock-model'), 100)
+        self.assertEqual(fitted['requirements'], parts['requirements'])
+        self.assertIn('profile', report['trimmed'])
+
+        # 未超出時不變
+        prompt, fitted, report = PromptBudget(counter).fit(parts, ('template',), build, 'mock', 'mock-model')
+        self.assertEqual(prompt, build(parts))
+        self.assertEqual(report['trimmed'], {})
+
+    def test_estimate_endpoint_and_usage_estimate(self):
+        """測試試算端點與 usage 中的調用前估算"""
+        from app.services.ai_service import AIService
+        from unittest.mock import patch
+
+        folder = self.app.config['TEMPLATE_STORAGE_FOLDER']
+        filename = 'test_estimate.md'
+        file_path = os.path.join(folder, filename)
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write('# 目的\n' + '說明' * 2000 + '\n# 範圍\n說明')
+
+        payload = {"doc_type": "system_doc", "template": filename, "requirements": "estimate", "output_format": "md"}
+        try:
+            with patch.object(AIService, 'load_api_config', return_value={'api_type': 'mock'}):
+                response = self.client.post('/api/estimate', json=payload)
+                self.assertEqual(response.status_code, 200)
+                estimate = response.json['estimate']
+                self.assertEqual(response.json['mode'], 'single')
+                self.assertEqual(estimate['requests'], 1)
+                self.assertGreater(estimate['input_tokens'], 4000)
+                self.assertEqual(estimate['estimated_cost'], 0.0)
+
+                response = self.client.post('/api/estimate', json=dict(payload, generation_mode='sections'))
+                self.assertEqual(response.json['mode'], 'sections')
+                self.assertEqual(response.json['estimate']['requests'], 2)
+
+                # 超出輸入預算時模板被截斷，usage 中帶有調用前估算
+                self.app.ai_service.prompt_budget.budgets = {'mock': 1500}
+                response = self.client.post('/api/generate', json={**payload, 'no_cache': True, 'async': False})
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('template', response.json['token_budget']['trimmed'])
+                self.assertLessEqual(response.json['usage']['estimated_input_tokens'], 1500)
+        finally:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def test_circuit_breaker_opens_and_recovers(self):
+        """測試熔斷器：連續失敗後打開，冷卻後半開試探並恢復"""
+        from app.services.router_service import CircuitBreaker
+
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, slo_seconds=5, slo_breaches=2, reset_timeout=10,
+                                 clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+        now[0] = 11
+        self.assertTrue(breaker.allow())
+        # 半開時只放行一個試探請求
+        self.assertFalse(breaker.allow())
+        breaker.record_success(latency=1)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+        # 連續超出延遲 SLO 也會打開
+        breaker.record_success(latency=6)
+        breaker.record_success(latency=7)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        # 請求本身無效（4xx）不計入熔斷器；單一目標在調用方線程直接執行
+        from app.services.router_service import ProviderRouter
+        from app.services.retry_service import ProviderHTTPError
+        import threading
+
+        router = ProviderRouter(failure_threshold=1, max_workers=1)
+        target = {'api_type': 'mock', 'model': 'm'}
+
+        def bad_request(target):
+            raise ProviderHTTPError('prompt too long', status_code=400)
+
+        for _ in range(3):
+            with self.assertRaises(ProviderHTTPError):
+                router.call([target], bad_request)
+        self.assertEqual(router.breaker(target).state, CircuitBreaker.CLOSED)
+        result, _, hedged = router.call([target], lambda target: threading.current_thread())
+        self.assertIs(result, threading.current_thread())
+        self.assertFalse(hedged)
+        with self.assertRaises(ProviderHTTPError):
+            router.call([target], lambda target: (_ for _ in ()).throw(ProviderHTTPError('down', status_code=503)))
+        self.assertEqual(router.breaker(target).state, CircuitBreaker.OPEN)
+
+    def test_router_hedges_and_fails_over_with_stub_providers(self):
+        """測試主供應商過慢時對沖、失敗時轉移到備用供應商"""
+        from app.services.ai_service import AIService
+        from unittest.mock import patch
+        import time
+
+        with OpenAIStubServer(content='slow primary', delay=1.5) as slow, \
+                OpenAIStubServer(content='fast backup') as backup, \
+                OpenAIStubServer(fail_times=100, fail_status=503) as broken:
+            service = AIService({
+                'OPENAI_PRICING': {}, 'LLM_CACHE_ENABLED': False, 'LLM_SINGLEFLIGHT_ENABLED': False,
+                'LLM_HEDGE_DEFAULT_DELAY': 0.2, 'LLM_RETRY_MAX_ATTEMPTS': 1,
+                'LLM_BREAKER_FAILURE_THRESHOLD': 2, 'LLM_BREAKER_RESET_SECONDS': 60
+            })
+            backup_target = {'api_type': 'openai', 'model': 'gpt-4o-mini', 'base_url': backup.base_url}
+
+            # 主供應商過慢：對沖請求先返回
+            config = {'api_type': 'openai', 'openai_api_key': 'k', 'openai_model': 'gpt-4o',
+                      'openai_base_url': slow.base_url, 'fallback_targets': [backup_target]}
+            with patch.object(AIService, 'load_api_config', return_value=config):
+                started = time.time()
+                content, usage = service.generate_content('hedge me')
+                self.assertLess(time.time() - started, 1.2)
+            self.assertEqual(content, 'fast backup')
+            self.assertTrue(usage['fallback'])
+            self.assertTrue(usage['hedged'])
+
+            # 主供應商出錯：立即轉移，連續失敗後熔斷不再請求
+            config = dict(config, openai_base_url=broken.base_url)
+            with patch.object(AIService, 'load_api_config', return_value=config):
+                for _ in range(3):
+                    content, usage = service.generate_content('fail over')
+                    self.assertEqual(content, 'fast backup')
+            self.assertEqual(len(broken.requests), 2)
+            self.assertEqual(service.router.stats()['openai:gpt-4o']['state'], 'open')
+
+        # 預設不啟用備用目標：即使配置了其他供應商的憑證也不會轉移
+        service = AIService({'LLM_FALLBACK_TARGETS': Config.LLM_FALLBACK_TARGETS, 'LLM_CACHE_ENABLED': False})
+        targets = service._route_targets('openai', {'openai_api_key': 'k', 'openai_model': 'gpt-4o',
+                                                    'gemini_api_key': 'g'})
+        self.assertEqual([target['api_type'] for target in targets], ['openai'])
+
+        response = self.client.get('/api/providers/status')
+        self.assertEqual(response.status_code, 200)
+
+    def test_telemetry_records_calls(self):
+        """測試每次調用記錄延遲、重試、錯誤類型與串流首字延遲"""
+        from app.services.ai_service import AIService
+        from unittest.mock import patch
+
+        with OpenAIStubServer(content='hello telemetry world', fail_times=1) as stub:
+            service = AIService({'OPENAI_PRICING': {'gpt-4o-mini': {'input': 1.0, 'output': 2.0}},
+                                 'LLM_CACHE_ENABLED': False, 'LLM_RETRY_BASE_DELAY': 0.01})
+            config = {'api_type': 'openai', 'openai_api_key': 'k', 'openai_model': 'gpt-4o-mini',
+                      'openai_base_url': stub.base_url}
+            with patch.object(AIService, 'load_api_config', return_value=config):
+                service.generate_content('first call')
+                list(service.stream_content('stream call'))
+
+        summary = service.telemetry.summary('openai', 'gpt-4o-mini')
+        self.assertEqual(summary['calls'], 2)
+        self.assertEqual(summary['retries'], 1)
+        self.assertIsNotNone(summary['ttft_p50'])
+        self.assertIsNotNone(summary['output_tokens_per_second_p50'])
+        self.assertGreater(summary['cost_per_1k_tokens'], 0)
+
+        from app.services.retry_service import ProviderHTTPError
+        from app.services.telemetry_service import error_class
+        try:
+            try:
+                raise ProviderHTTPError('boom', status_code=503)
+            except ProviderHTTPError as e:
+                raise Exception(f"OpenAI API 調用失敗: {e}")
+        except Exception as wrapped:
+            self.assertEqual(error_class(wrapped), 'http_503')
+
+        response = self.client.get('/api/telemetry')
+        self.assertEqual(response.status_code, 200)
+
+    def test_adaptive_model_routing(self):
+        """測試短 prompt 按觀測延遲與成本選擇模型"""
+        from app.services.telemetry_service import Telemetry
+        from app.services.router_service import ModelRoutingPolicy
+
+        telemetry = Telemetry()
+        policy = ModelRoutingPolicy(telemetry, {'openai': ['gpt-4o-mini', 'gpt-4o']},
+                                    short_prompt_tokens=1000, min_samples=3)
+        # 沒有觀測資料時維持配置的模型，只有 force（route='fast'）才使用候選列表的第一個
+        self.assertEqual(policy.choose('openai', 'gpt-4o', 100), 'gpt-4o')
+        self.assertEqual(policy.choose('openai', 'gpt-4o', 100, force=True), 'gpt-4o-mini')
+        # 長 prompt 維持配置的模型
+        self.assertEqual(policy.choose('openai', 'gpt-4o', 5000), 'gpt-4o')
+        # 配置的模型不在候選中時不替換
+        self.assertEqual(policy.choose('openai', 'gpt-4-turbo', 100), 'gpt-4-turbo')
+        self.assertEqual(policy.choose('gemini', 'gemini-1.5-pro', 100), 'gemini-1.5-pro')
+
+        # 只有其他模型的觀測資料時，沒有依據判斷配置的模型較慢
+        for _ in range(3):
+            telemetry.record('openai', 'gpt-4o', 1.0, input_tokens=100, output_tokens=100, cost=0.01)
+        self.assertEqual(policy.choose('openai', 'gpt-4o-mini', 100), 'gpt-4o-mini')
+
+        for _ in range(3):
+            telemetry.record('openai', 'gpt-4o-mini', 4.0, input_tokens=100, output_tokens=100, cost=0.001)
+        self.assertEqual(policy.choose('openai', 'gpt-4o-mini', 100), 'gpt-4o')
+        # 強制路由時不論長度
+        self.assertEqual(policy.choose('openai', 'gpt-4o-mini', 5000, force=True), 'gpt-4o')
+
+        # 錯誤率過高的模型不參與選擇
+        for _ in range(3):
+            telemetry.record('openai', 'gpt-4o', 1.0, error='http_503')
+        self.assertEqual(policy.choose('openai', 'gpt-4o', 100), 'gpt-4o-mini')
+        self.assertEqual(telemetry.summary('openai', 'gpt-4o')['errors'], {'http_503': 3})
+
+    def test_cost_ledger_rollups(self):
+        """測試成本記錄：背景批次寫入、每小時 / 每日彙總、舊版 CSV 匯入與查詢接口"""
+        import tempfile
+        import time
+        import sqlite3
+        from app.utils.cost_ledger import CostLedger
+
+        with tempfile.TemporaryDirectory() as tmp:
+            legacy_csv = os.path.join(tmp, 'cost_log.csv')
+            with open(legacy_csv, 'w', encoding='utf-8') as f:
+                f.write("Timestamp,Model,Input Tokens,Output Tokens,Cost (USD)\n")
+                f.write("2025-01-02 08:15:00,gpt-4o,100,50,0.010000\n")
+
+            db_path = os.path.join(tmp, 'costs.db')
+            ledger = CostLedger(db_path, flush_interval=0.05, legacy_csv_path=legacy_csv)
+            base = time.mktime((2025, 1, 2, 9, 0, 0, 0, 0, -1))
+            for minute in range(3):
+                ledger.record('gpt-4o', 10, 20, 0.001, timestamp=base + minute * 60)
+            ledger.record('gemini-1.5-flash', 5, 5, 0.0, timestamp=base + 3600)
+            self.assertTrue(ledger.flush())
+
+            daily = ledger.query('2025-01-02', '2025-01-02')
+            self.assertEqual(daily['totals']['requests'], 5)
+            gpt = [row for row in daily['rows'] if row['model'] == 'gpt-4o'][0]
+            self.assertEqual(gpt['requests'], 4)
+            self.assertEqual(gpt['input_tokens'], 130)
+            self.assertAlmostEqual(gpt['cost'], 0.013)
+
+            hourly = ledger.query('2025-01-02 09:00', '2025-01-02 09:00', granularity='hour')
+            self.assertEqual([row['requests'] for row in hourly['rows']], [3])
+            self.assertEqual(ledger.query('2025-01-02', granularity='hour', model='gemini-1.5-flash')
+                             ['rows'][0]['bucket'], '2025-01-02 10:00')
+
+            # 重新開啟不會重複匯入舊版 CSV
+            reopened = CostLedger(db_path, legacy_csv_path=legacy_csv)
+            self.assertEqual(reopened.query()['totals']['requests'], 5)
+            with self.assertRaises(ValueError):
+                reopened.query(granularity='minute')
+
+            # 寫入失敗時保留記錄並重試，提交後才算完成
+            from unittest.mock import patch
+            flaky = CostLedger(db_path, flush_interval=0.01, retry_base_delay=0.01)
+            failures = [sqlite3.OperationalError('database is locked')] * 2
+            original = flaky._write_batch
+
+            def write_batch(records):
+                if failures:
+                    raise failures.pop()
+                original(records)
+
+            with patch.object(flaky, '_write_batch', side_effect=write_batch), \
+                    self.assertLogs('app.utils.cost_ledger', level='ERROR'):
+                flaky.record('gpt-4o', 1, 1, 0.5, timestamp=base)
+                self.assertTrue(flaky.flush())
+            self.assertEqual(failures, [])
+            self.assertEqual(flaky.query('2025-01-02', '2025-01-02')['totals']['requests'], 6)
+
+        response = self.client.get('/api/costs?granularity=hour')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('totals', response.json)
+        self.assertEqual(self.client.get('/api/costs?granularity=week').status_code, 400)
+
+    def test_prompt_registry_and_profile_cache(self):
+        """測試 Prompt 登記處只構建所選 Prompt，Profile 快取按修改時間重新載入"""
+        import tempfile
+        from app.services.prompt_service import PromptRegistry, ProfileLoader, PROFILE_SEPARATOR
+
+        with tempfile.TemporaryDirectory() as tmp:
+            profile_path = os.path.join(tmp, 'PTT_PROFILE.md')
+            with open(profile_path, 'w', encoding='utf-8') as f:
+                f.write('角色 v1')
+            loader = ProfileLoader(tmp, reload_interval=0)
+            registry = PromptRegistry(loader)
+
+            self.assertEqual(registry.profile('sop'), '角色 v1' + PROFILE_SEPARATOR)
+            # 缺少的 Profile 返回空字串
+            self.assertEqual(registry.profile('system_doc'), '')
+
+            with open(profile_path, 'w', encoding='utf-8') as f:
+                f.write('角色 v2 已更新')
+            os.utime(profile_path, ns=(0, os.stat(profile_path).st_mtime_ns + 10 ** 9))
+            self.assertTrue(registry.profile('sop_optimize').startswith('角色 v2'))
+
+            prompt = registry.build('sop_optimize', 'PROFILE', '模板文字', '[投影片 1]\n舊內容')
+            self.assertIn('=== 原始 SOP 內容 ===\n[投影片 1]\n舊內容', prompt)
+            self.assertIn('=== 參考模板風格 ===\n模板文字', prompt)
+            self.assertEqual(registry.doc_config('tech_report'), {'name': '技術報告', 'title': '技術分析報告'})
+            self.assertIsNone(registry.doc_config('unknown'))
+
+            # 沒有 Profile 時 SOP 需求優化使用預設角色，未定義的類型使用通用模板
+            self.assertIn('SOP 工程師', PromptRegistry(ProfileLoader(os.path.join(tmp, 'none'))).build_optimize('sop', '需求'))
+            self.assertIn('請優化以下需求描述', registry.build_optimize('other', '需求'))
+
+    def test_template_text_cache(self):
+        """測試模板文字快取：持久化、修改後重新提取、相同內容共用結果、刪除時清除"""
+        import tempfile
+        from unittest.mock import MagicMock
+        from app.services.template_cache import TemplateTextCache
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'template.txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('1. 目的')
+            extractor = MagicMock(side_effect=lambda p: open(p, encoding='utf-8').read())
+            db_path = os.path.join(tmp, 'templates.db')
+            cache = TemplateTextCache(db_path, extractor=extractor)
+
+            self.assertEqual(cache.get_text(path), '1. 目的')
+            self.assertEqual(cache.get_text(path), '1. 目的')
+            self.assertEqual(extractor.call_count, 1)
+
+            # 重啟後從磁碟層讀取
+            reopened = TemplateTextCache(db_path, extractor=extractor)
+            self.assertEqual(reopened.get_text(path), '1. 目的')
+            self.assertEqual(reopened.stats()['disk_hits'], 1)
+
+            # 內容相同的新文件不重新提取
+            copy_path = os.path.join(tmp, 'template_copy.txt')
+            with open(copy_path, 'w', encoding='utf-8') as f:
+                f.write('1. 目的')
+            self.assertEqual(reopened.get_text(copy_path), '1. 目的')
+            self.assertEqual(extractor.call_count, 1)
+
+            # 文件修改後重新提取
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('1. 目的\n2. 範圍')
+            os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+            self.assertEqual(reopened.get_text(path), '1. 目的\n2. 範圍')
+            self.assertEqual(extractor.call_count, 2)
+
+            # 提取失敗的結果不快取
+            failing = TemplateTextCache(db_path, extractor=lambda p: '讀取 PPTX 失敗: broken')
+            broken_path = os.path.join(tmp, 'broken.pptx')
+            with open(broken_path, 'wb') as f:
+                f.write(b'not a pptx')
+            failing.get_text(broken_path)
+            self.assertEqual(failing.stats()['disk_entries'], 2)
+
+            reopened.invalidate('template.txt')
+            self.assertEqual(reopened.stats()['disk_entries'], 1)
+
+    def test_template_upload_ingestion(self):
+        """測試模板上傳後在背景預處理，/api/templates 返回處理狀態"""
+        import io
+        import time
+
+        content = '1. 目的\n說明\n2. 範圍\n適用範圍'.encode('utf-8')
+        response = self.client.post('/api/upload_template', data={'file': (io.BytesIO(content), 'ingest.txt')},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        filename = response.json['filename']
+        self.assertEqual(response.json['processing']['status'], 'queued')
+
+        try:
+            deadline = time.time() + 10
+            status = None
+            while time.time() < deadline:
+                status = self.client.get(f'/api/templates/{filename}/status').json
+                if status['status'] in ('ready', 'failed'):
+                    break
+                time.sleep(0.05)
+            self.assertEqual(status['status'], 'ready')
+            self.assertEqual([h['title'] for h in status['headings']], ['1. 目的', '2. 範圍'])
+            self.assertEqual(status['metadata']['characters'], len(content.decode('utf-8')))
+
+            listed = next(t for t in self.client.get('/api/templates').json if t['filename'] == filename)
+            self.assertEqual(listed['processing']['status'], 'ready')
+            with self.app.app_context():
+                from app.routes import get_template_text_cache, get_template_ingestor
+                self.assertGreaterEqual(get_template_text_cache().stats()['disk_entries'], 1)
+                self.assertEqual(get_template_ingestor().skeleton(filename), status['headings'])
+                self.assertIsNone(get_template_ingestor().skeleton('missing.txt'))
+        finally:
+            self.client.delete(f'/api/delete_template/{filename}')
+        self.assertEqual(self.client.get(f'/api/templates/{filename}/status').status_code, 404)
+
+        # PPTX 模板：預處理時提取圖片，刪除模板時一併清除
+        from pptx import Presentation
+        from pptx.util import Inches
+        from PIL import Image
+
+        prs = Presentation()
+        slide = prs.slides.add_slide(prs.slide_layouts[5])
+        slide.shapes.title.text = '1. 目的'
+        for color in ('red', 'red', 'blue'):
+            image = io.BytesIO()
+            Image.new('RGB', (8, 8), color).save(image, 'PNG')
+            image.seek(0)
+            slide.shapes.add_picture(image, Inches(1), Inches(1))
+        deck_path = os.path.join(self.app.config['TEMPLATE_STORAGE_FOLDER'], 'ingest.pptx')
+        prs.save(deck_path)
+        with self.app.app_context():
+            from app.routes import get_template_ingestor
+            ingestor = get_template_ingestor()
+            metadata = ingestor.ingest(deck_path)
+            self.assertEqual(metadata['images'], 3)
+            self.assertEqual(metadata['unique_images'], 2)
+            self.assertTrue(os.path.isdir(metadata['image_folder']))
+            ingestor.remove('ingest.pptx')
+            self.assertFalse(os.path.exists(metadata['image_folder']))
+
+    def test_pdf_extraction_modes(self):
+        """測試 PDF 逐頁提取、並行提取與頁數 / 字數上限"""
+        import tempfile
+        from app.services.file_service import FileProcessor, PYMUPDF_AVAILABLE
+        if not PYMUPDF_AVAILABLE:
+            self.skipTest('未安裝 PyMuPDF')
+        import fitz
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'pages.pdf')
+            doc = fitz.open()
+            for number in range(1, 7):
+                doc.new_page().insert_text((72, 72), f"page {number}")
+            doc.save(path)
+            doc.close()
+
+            pages = list(FileProcessor.iter_pdf_pages(path))
+            self.assertEqual(len(pages), 6)
+            sequential = FileProcessor.extract_text_from_pdf(path, workers=1)
+            self.assertEqual(sequential, ''.join(pages))
+            self.assertEqual(FileProcessor.extract_text_from_pdf(path, workers=2), sequential)
+
+            self.assertEqual(FileProcessor.extract_text_from_pdf(path, max_pages=2), ''.join(pages[:2]))
+            self.assertEqual(FileProcessor.extract_text_from_pdf(path, max_chars=5), sequential[:5])
+            self.assertTrue(FileProcessor.extract_text_from_pdf(os.path.join(tmp, 'missing.pdf')).startswith('讀取 PDF 失敗'))
+
+    def test_ooxml_fast_extraction(self):
+        """測試 DOCX / PPTX 快速提取：表格、群組形狀、備註與圖片標記"""
+        import io
+        import tempfile
+        from docx import Document
+        from pptx import Presentation
+        from pptx.util import Inches
+        from PIL import Image
+        from app.services.file_service import FileProcessor
+        from app.services.ooxml_service import extract_pptx_text
+
+        with tempfile.TemporaryDirectory() as tmp:
+            image = io.BytesIO()
+            Image.new('RGB', (8, 8), 'red').save(image, 'PNG')
+            prs = Presentation()
+            slide = prs.slides.add_slide(prs.slide_layouts[1])
+            slide.shapes.title.text = '登入系統'
+            slide.placeholders[1].text = '輸入帳號\n輸入密碼'
+            image.seek(0)
+            slide.shapes.add_picture(image, Inches(1), Inches(1))
+            table = slide.shapes.add_table(1, 2, Inches(1), Inches(4), Inches(4), Inches(1)).table
+            table.cell(0, 0).text = '欄位'
+            table.cell(0, 1).text = '說明'
+            group = slide.shapes.add_group_shape()
+            group.shapes.add_textbox(Inches(5), Inches(5), Inches(1), Inches(1)).text_frame.text = '群組文字'
+            slide.notes_slide.notes_text_frame.text = '講者備註'
+            prs.slides.add_slide(prs.slide_layouts[6])  # 空白投影片不輸出
+            second = prs.slides.add_slide(prs.slide_layouts[5])
+            second.shapes.title.text = '完成'
+            pptx_path = os.path.join(tmp, 'deck.pptx')
+            prs.save(pptx_path)
+
+            text, image_count = FileProcessor.extract_text_from_pptx(
+                pptx_path, include_image_markers=True, include_slide_markers=True)
+            self.assertEqual(image_count, 1)
+            self.assertEqual(text, '[投影片 1]\n登入系統\n輸入帳號\n輸入密碼\n'
+                                   '\n[圖片 1-1: 來自投影片 1]\n\n欄位 | 說明\n群組文字\n備註：講者備註'
+                                   '\n\n[投影片 3]\n完成')
+            self.assertEqual(extract_pptx_text(pptx_path, include_notes=False)[0].split('\n\n')[0],
+                             '登入系統\n輸入帳號\n輸入密碼\n欄位 | 說明\n群組文字')
+
+            doc = Document()
+            doc.add_paragraph('第一段')
+            cells = doc.add_table(rows=1, cols=2).rows[0].cells
+            cells[0].text = '甲'
+            cells[1].text = '乙'
+            doc.add_paragraph('第二段\t結尾')
+            docx_path = os.path.join(tmp, 'doc.docx')
+            doc.save(docx_path)
+            self.assertEqual(FileProcessor.extract_text_from_docx(docx_path), '第一段\n甲 | 乙\n第二段\t結尾')
+
+            # 不是 zip 文件時返回錯誤訊息
+            broken = os.path.join(tmp, 'broken.docx')
+            with open(broken, 'wb') as f:
+                f.write(b'not a zip')
+            self.assertTrue(FileProcessor.extract_text_from_docx(broken).startswith('讀取 DOCX 失敗'))
+
+    def test_extract_text_single_pass_pptx(self):
+        """測試 PPTX 單次解析：圖片標記與圖片文件編號一致"""
+        import io
+        import re
+        import shutil
+        from pptx import Presentation
+        from pptx.util import Inches
+        from PIL import Image
+        from app.services.image_store import ImageManifest
+
+        prs = Presentation()
+        for slide_number, colors in enumerate([('red', 'blue'), ()], start=1):
+            slide = prs.slides.add_slide(prs.slide_layouts[5])
+            slide.shapes.title.text = f"步驟 {slide_number}"
+            for color in colors:
+                image = io.BytesIO()
+                Image.new('RGB', (8, 8), color).save(image, 'JPEG')
+                image.seek(0)
+                slide.shapes.add_picture(image, Inches(1), Inches(1))
+        deck = io.BytesIO()
+        prs.save(deck)
+        deck.seek(0)
+
+        response = self.client.post('/api/extract_text', data={'file': (deck, 'old_sop.pptx')},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        data = response.json
+        self.assertTrue(data['content'].startswith('[投影片 1]\n步驟 1'))
+        markers = re.findall(r'\[圖片 (\d+)-(\d+)', data['content'])
+        self.assertEqual(markers, [('1', '1'), ('1', '2')])
+        self.assertEqual(data['images']['count'], 2)
+
+        folder = os.path.join(self.app.config['OUTPUT_FOLDER'], 'temp_images', data['images']['folder'])
+        try:
+            manifest = ImageManifest.load(folder)
+            self.assertEqual(sorted(manifest.images), ['slide_1_image_1', 'slide_1_image_2'])
+            self.assertTrue(all(os.path.exists(entry['path']) for entry in manifest.images.values()))
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def test_extract_text_from_legacy_doc(self):
+        """測試以 olefile 直接解析 Word 97-2003 文件（片段表、域代碼與表格）"""
+        import struct
+        import tempfile
+        from app.services.file_service import FileProcessor
+
+        compressed = 'SOP Title\rLine\x0btwo\r'
+        unicode_text = '甲\x07乙\x07\x07頁碼 \x13 PAGE \x14' + '3\x15 結尾\r'
+        footnote = '註腳\r'
+        text_offset = 0x800
+        unicode_offset = text_offset + len(compressed)
+        word = bytearray(text_offset) + compressed.encode('cp1252') + (unicode_text + footnote).encode('utf-16-le')
+        struct.pack_into('<HH', word, 0, 0xA5EC, 0xC1)
+        struct.pack_into('<H', word, 0x0A, 0x0200)
+        struct.pack_into('<i', word, 0x4C, len(compressed) + len(unicode_text))
+
+        cps = [0, len(compressed), len(compressed) + len(unicode_text) + len(footnote)]
+        pcds = [(0x40000000 | text_offset * 2), unicode_offset]
+        plc = struct.pack('<3I', *cps) + b''.join(struct.pack('<HIH', 0, fc, 0) for fc in pcds)
+        clx = b'\x01' + struct.pack('<h', 2) + b'\0\0' + b'\x02' + struct.pack('<I', len(plc)) + plc
+        struct.pack_into('<II', word, 0x01A2, 0, len(clx))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'legacy.doc')
+            write_ole_file(path, {'WordDocument': bytes(word), '1Table': clx})
+            self.assertEqual(FileProcessor.extract_text_from_doc(path),
+                             'SOP Title\nLine\ntwo\n甲 | 乙\n頁碼 3 結尾')
+
+            broken = os.path.join(tmp, 'broken.doc')
+            with open(broken, 'wb') as f:
+                f.write(b'not an ole file')
+            self.assertTrue(FileProcessor.extract_text_from_doc(broken).startswith('讀取 DOC 失敗'))
+
+    def test_extract_text_from_legacy_ppt(self):
+        """測試以 olefile 直接解析 PowerPoint 97-2003 文件（持久化目錄與投影片順序）"""
+        import struct
+        import tempfile
+        from app.services.file_service import FileProcessor
+
+        def record(rec_type, body, instance=0):
+            return struct.pack('<HHI', instance << 4, rec_type, len(body)) + body
+
+        def container(rec_type, children, instance=0):
+            body = b''.join(children)
+            return struct.pack('<HHI', 0xF | instance << 4, rec_type, len(body)) + body
+
+        def chars(text):
+            return record(0x0FA0, text.encode('utf-16-le'))
+
+        textbox = container(0x040C, [container(0xF00D, [chars('自訂文字框')])])
+        slide_one = container(0x03EE, [textbox])
+        slide_two = container(0x03EE, [])
+        slide_list = container(0x0FF0, [
+            record(0x03F3, struct.pack('<5I', 3, 0, 0, 256, 0)), chars('步驟二'),
+            record(0x03F3, struct.pack('<5I', 2, 0, 0, 257, 0)), chars('步驟一\r登入系統'),
+            record(0x0FA8, b'Open settings'),
+        ])
+        master_list = container(0x0FF0, [chars('母片標題')], instance=1)
+        document = container(0x03E8, [master_list, slide_list])
+
+        stream = slide_one + slide_two
+        document_offset = len(stream)
+        stream += document
+        directory_offset = len(stream)
+        stream += record(0x1772, struct.pack('<4I', 1 | 3 << 20, document_offset, 0, len(slide_one)))
+        edit_offset = len(stream)
+        stream += record(0x0FF5, struct.pack('<IHBBIIIIHH', 0, 0, 0, 3, 0, directory_offset, 1, 4, 1, 0))
+        current_user = record(0x0FF6, struct.pack('<III', 0x14, 0xE391C05F, edit_offset))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'legacy.ppt')
+            write_ole_file(path, {'PowerPoint Document': stream, 'Current User': current_user})
+            self.assertEqual(FileProcessor.extract_text_from_ppt(path),
+                             '步驟二\n\n步驟一\n登入系統\nOpen settings\n自訂文字框')
+            self.assertEqual(FileProcessor.extract_text(path),
+                             '步驟二\n\n步驟一\n登入系統\nOpen settings\n自訂文字框')
+            self.assertTrue(FileProcessor.extract_text_from_ppt(path, include_slide_markers=True)
+                            .startswith('[投影片 1]\n步驟二\n\n[投影片 2]\n步驟一'))
+
+    def test_image_store_dedupes_and_flags_near_duplicates(self):
+        """測試圖片存放區：重複圖片只存一次、近似截圖被標記、生成 PPTX 時依清單插入圖片"""
+        import io
+        import tempfile
+        import numpy as np
+        from pptx import Presentation
+        from pptx.util import Inches
+        from PIL import Image
+        from app.services.image_service import ImageExtractor
+        from app.services.image_store import ImageStore, ImageManifest
+        from app.services.format_service import FormatConverter
+
+        def png(array):
+            buffer = io.BytesIO()
+            Image.fromarray(array.astype(np.uint8)).save(buffer, 'PNG')
+            return buffer.getvalue()
+
+        gradient = np.tile(np.linspace(0, 255, 160), (90, 1))
+        edited = gradient.copy()
+        edited[40:44, 20:30] = 0  # 同一畫面只改了一小塊
+        checker = np.kron(np.indices((9, 16)).sum(axis=0) % 2, np.ones((10, 10))) * 255
+        logo = np.full((32, 32), 200.0)
+        logo[8:24, 8:24] = 30
+        slides = [[logo, gradient], [logo, edited], [logo, checker]]
+
+        prs = Presentation()
+        for pictures in slides:
+            slide = prs.slides.add_slide(prs.slide_layouts[6])
+            for picture in pictures:
+                slide.shapes.add_picture(io.BytesIO(png(picture)), Inches(1), Inches(1))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            deck = os.path.join(tmp, 'deck.pptx')
+            prs.save(deck)
+            store = ImageStore(os.path.join(tmp, 'store'))
+            folder = os.path.join(tmp, 'upload')
+            images = ImageExtractor.extract_images_from_pptx(deck, folder, store=store)
+            self.assertEqual(len(images), 6)
+
+            objects = [name for _, _, files in os.walk(store.root) for name in files]
+            self.assertEqual(len(objects), 4)
+            self.assertEqual(os.listdir(folder), ['manifest.json'])
+
+            manifest = ImageManifest.load(folder)
+            self.assertEqual(manifest.unique_count(), 4)
+            self.assertEqual(len({manifest.resolve(slide, 1) for slide in (1, 2, 3)}), 1)
+            self.assertEqual(manifest.images['slide_2_image_2'].get('near_duplicate_of'), 'slide_1_image_2')
+            self.assertNotIn('near_duplicate_of', manifest.images['slide_3_image_2'])
+            self.assertEqual(manifest.near_duplicate_count(), 1)
+
+            # 重複上傳不會再寫入新物件
+            ImageExtractor.extract_images_from_pptx(deck, os.path.join(tmp, 'again'), store=store)
+            self.assertEqual(sum(len(files) for _, _, files in os.walk(store.root)), 4)
+
+            output = FormatConverter.markdown_to_pptx('## 步驟\n- 開啟設定\n[圖片 3-2: 來自投影片 3]',
+                                                     {'title': 'SOP'}, folder)
+            pictures = [shape for shape in output.slides[1].shapes if shape.shape_type == 13]
+            self.assertEqual(len(pictures), 1)
+
+    def test_extract_text_lazy_images_served_from_package(self):
+        """測試延遲模式：提取時不寫出圖片，需要時從上傳的 PPTX 中讀取"""
+        import io
+        import shutil
+        from pptx import Presentation
+        from pptx.util import Inches
+        from PIL import Image
+        from app.services.format_service import FormatConverter
+
+        blobs = []
+        prs = Presentation()
+        slide = prs.slides.add_slide(prs.slide_layouts[5])
+        slide.shapes.title.text = "登入"
+        for color in ('red', 'green'):
+            image = io.BytesIO()
+            Image.new('RGB', (12, 12), color).save(image, 'PNG')
+            blobs.append(image.getvalue())
+            slide.shapes.add_picture(io.BytesIO(blobs[-1]), Inches(1), Inches(1))
+        deck = io.BytesIO()
+        prs.save(deck)
+        deck.seek(0)
+
+        self.app.config['IMAGE_EXTRACTION_MODE'] = 'lazy'
+        response = self.client.post('/api/extract_text', data={'file': (deck, 'lazy_sop.pptx')},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        images = response.json['images']
+        self.assertEqual((images['count'], images['unique']), (2, 2))
+
+        folder = os.path.join(self.app.config['OUTPUT_FOLDER'], 'temp_images', images['folder'])
+        try:
+            self.assertEqual(sorted(os.listdir(folder)), ['manifest.json', 'source.pptx'])
+
+            served = self.client.get(f"/api/images/{images['folder']}/slide_1_image_2")
+            self.assertEqual(served.status_code, 200)
+            self.assertEqual(served.mimetype, 'image/png')
+            self.assertEqual(served.data, blobs[1])
+            served.close()
+            self.assertEqual(self.client.get(f"/api/images/{images['folder']}/slide_9_image_1").status_code, 404)
+
+            output = FormatConverter.markdown_to_pptx('## 登入\n[圖片 1-1: 來自投影片 1]', {'title': 'SOP'}, folder)
+            pictures = [shape for shape in output.slides[1].shapes if shape.shape_type == 13]
+            self.assertEqual(pictures[0].image.blob, blobs[0])
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def test_image_optimizer_resizes_and_picks_format(self):
+        """測試圖片優化：按顯示尺寸縮小、依內容選擇 PNG / JPEG、結果快取"""
+        import io
+        import tempfile
+        import numpy as np
+        from pptx import Presentation
+        from pptx.util import Inches
+        from PIL import Image
+        from app.services.image_optimizer import ImageOptimizer
+        from app.services.ppt_injector import PPTXInjector
+
+        with tempfile.TemporaryDirectory() as tmp:
+            optimizer = ImageOptimizer(os.path.join(tmp, 'cache'), dpi=150)
+
+            # 截圖：大面積單色的介面
+            screenshot = Image.new('RGB', (2400, 1500), (240, 240, 240))
+            screenshot.paste((30, 90, 200), (0, 0, 2400, 120))
+            screenshot.paste((255, 255, 255), (200, 300, 2200, 1300))
+            screenshot_path = os.path.join(tmp, 'screenshot.png')
+            screenshot.save(screenshot_path)
+
+            result = optimizer.optimize(screenshot_path, Inches(3.5))
+            self.assertTrue(result.endswith('.png'))
+            with Image.open(result) as img:
+                self.assertEqual(img.size, (525, 328))
+            self.assertEqual(optimizer.optimize(screenshot_path, Inches(3.5)), result)
+            self.assertEqual(optimizer.stats()['cache_hits'], 1)
+
+            # 照片：顏色豐富，改用 JPEG
+            photo = np.random.default_rng(1).integers(0, 256, (1200, 1600, 3), dtype=np.uint8)
+            photo_path = os.path.join(tmp, 'photo.png')
+            Image.fromarray(photo).save(photo_path)
+            result = optimizer.optimize(photo_path, Inches(4), Inches(2))
+            self.assertTrue(result.endswith('.jpg'))
+            with Image.open(result) as img:
+                self.assertEqual(img.size, (400, 300))
+
+            # 透明背景保留為 PNG；已經夠小的圖片直接使用原圖
+            logo = Image.new('RGBA', (1000, 1000), (0, 0, 0, 0))
+            logo.paste((200, 20, 20, 255), (250, 250, 750, 750))
+            logo_bytes = io.BytesIO()
+            logo.save(logo_bytes, 'PNG')
+            result = optimizer.optimize(logo_bytes, Inches(1))
+            with Image.open(result) as img:
+                self.assertEqual((img.mode, img.size), ('RGBA', (150, 150)))
+            icon = io.BytesIO()
+            Image.new('RGB', (64, 64), 'red').save(icon, 'PNG')
+            self.assertIs(optimizer.optimize(icon, Inches(1)), icon)
+
+            # 注入圖片時按放置區域縮小
+            deck_path = os.path.join(tmp, 'deck.pptx')
+            prs = Presentation()
+            prs.slides.add_slide(prs.slide_layouts[6])
+            prs.save(deck_path)
+            output_path = PPTXInjector.inject_images(deck_path, [{'image_path': screenshot_path, 'slide_number': 1}])
+            picture = Presentation(output_path).slides[0].shapes[0]
+            self.assertLessEqual(picture.image.size[0], round(prs.slide_width * 0.45 / 914400 * 150))
+            self.assertLess(len(picture.image.blob), os.path.getsize(screenshot_path))
+
+    def test_image_manifest_records_sizes_and_resolves_markers(self):
+        """測試圖片清單：記錄大小與像素尺寸，markdown_to_pptx 只以清單查找圖片並按尺寸計算高度"""
+        import io
+        import shutil
+        import tempfile
+        from pptx import Presentation
+        from pptx.util import Inches
+        from PIL import Image
+        from app.services.image_service import ImageExtractor
+        from app.services.image_store import ImageStore, ImageManifest
+        from app.services.format_service import FormatConverter
+
+        image = io.BytesIO()
+        Image.new('RGB', (40, 20), 'navy').save(image, 'PNG')
+        blob = image.getvalue()
+        prs = Presentation()
+        slide = prs.slides.add_slide(prs.slide_layouts[6])
+        slide.shapes.add_picture(io.BytesIO(blob), Inches(1), Inches(1))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            deck = os.path.join(tmp, 'deck.pptx')
+            prs.save(deck)
+            modes = {
+                'files': {},
+                'store': {'store': ImageStore(os.path.join(tmp, 'store'))},
+                'lazy': {'lazy': True},
+            }
+            for mode, options in modes.items():
+                folder = os.path.join(tmp, mode)
+                ImageExtractor.extract_images_from_pptx(deck, folder, **options)
+                entry = ImageManifest.load(folder).entry(1, 1)
+                self.assertEqual((entry['bytes'], entry['width'], entry['height']), (len(blob), 40, 20), mode)
+
+            folder = os.path.join(tmp, 'files')
+            # 不在清單中的文件不會被探測到
+            shutil.copy(os.path.join(folder, 'slide_1_image_1.png'), os.path.join(folder, 'slide_1_image_9.png'))
+            output = FormatConverter.markdown_to_pptx('## 步驟\n[圖片 1-1]\n[圖片 1-9]', {'title': 'SOP'}, folder)
+            pictures = [shape for shape in output.slides[1].shapes if shape.shape_type == 13]
+            self.assertEqual(len(pictures), 1)
+            self.assertEqual(pictures[0].height, round(Inches(3.5) / 2))
+
+    def test_markdown_ast_blocks_and_cache(self):
+        """測試 Markdown AST：標題、列表、表格、行內強調、程式碼與圖片標記，按內容雜湊快取"""
+        from app.services.markdown_ast import parse_markdown, flatten, plain_text, ast_cache_info, Run
+
+        content = ("# 標題 **粗**\n第一行\n第二行 <帳號>\n\n- 項目 *斜*\n    - 巢狀\n\n3. 第三\n4. 第四\n\n"
+                   "| 欄位 | 說明 |\n|---|---|\n| a | `b` |\n\n```python\nprint(1 < 2)\n```\n\n[圖片 2-1: 來自投影片 2]\n")
+        before = ast_cache_info()
+        ast = parse_markdown(content)
+        self.assertIs(parse_markdown(content), ast)
+        after = ast_cache_info()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+
+        heading = ast[0]
+        self.assertEqual((heading['type'], heading['level']), ('heading', 1))
+        self.assertEqual(heading['runs'], (Run('標題 '), Run('粗', bold=True)))
+        # 段落中的每一行各自成為段落，非 HTML 的 <帳號> 保留原文
+        self.assertEqual([plain_text(block['runs']) for block in ast[1:3]], ['第一行', '第二行 <帳號>'])
+
+        flat = [(block['type'], depth, marker, plain_text(block.get('runs', ()))) for block, depth, marker in flatten(ast)]
+        self.assertIn(('paragraph', 1, '-', '項目 斜'), flat)
+        self.assertIn(('paragraph', 2, '-', '巢狀'), flat)
+        self.assertIn(('paragraph', 1, '3.', '第三'), flat)
+        self.assertIn(('image', 0, None, '[圖片 2-1: 來自投影片 2]'), flat)
+
+        table = next(block for block in ast if block['type'] == 'table')
+        self.assertEqual([plain_text(cell) for cell in table['header']], ['欄位', '說明'])
+        self.assertEqual(table['rows'][0][1], (Run('b', code=True),))
+        code = next(block for block in ast if block['type'] == 'code')
+        self.assertEqual((code['language'], code['text']), ('python', 'print(1 < 2)'))
+        image = next(block for block in ast if block['type'] == 'image')
+        self.assertEqual((image['slide'], image['index']), ('2', '1'))
+
+    def test_markdown_ast_nested_lists_and_markers(self):
+        """測試 2 空格縮排的巢狀列表，以及與分段輸出檢查一致的圖片標記"""
+        from app.services.markdown_ast import build_ast, flatten, plain_text
+        from app.services.section_service import OUTPUT_IMAGE_MARKER_PATTERN
+        from app.services.format_service import FormatConverter
+
+        content = "- 開啟設定\n  - 帳號\n    - 密碼\n  1. 儲存\n- 完成\n圖片1-3"
+        flat = [(depth, marker, plain_text(block['runs']), block['type'])
+                for block, depth, marker in flatten(build_ast(content))]
+        self.assertEqual(flat, [
+            (1, '-', '開啟設定', 'paragraph'),
+            (2, '-', '帳號', 'paragraph'),
+            (3, '-', '密碼', 'paragraph'),
+            (2, '1.', '儲存', 'paragraph'),
+            (1, '-', '完成', 'paragraph'),
+            (0, None, '圖片1-3', 'image'),
+        ])
+        # 分段優化認為保留了的圖片標記，渲染時也會成為圖片
+        self.assertEqual(OUTPUT_IMAGE_MARKER_PATTERN.findall(content), [('1', '3')])
+
+        doc = FormatConverter.markdown_to_docx(content, {'title': 'SOP'})
+        styles = [(p.style.name, p.text) for p in doc.paragraphs]
+        self.assertIn(('List Bullet 2', '帳號'), styles)
+        self.assertIn(('List Bullet 3', '密碼'), styles)
+        self.assertIn(('List Number 2', '儲存'), styles)
+
+    def test_markdown_renderers_share_ast(self):
+        """測試 DOCX / PPTX / PDF 走訪同一份 AST：只解析一次，表格與粗體在各格式中一致"""
+        import tempfile
+        import fitz
+        from app.services.format_service import FormatConverter
+        from app.services.markdown_ast import ast_cache_info
+
+        content = ("## 登入 **注意**\n- 輸入 *帳號*\n1. 按下登入\n\n"
+                   "| 欄位 | 說明 |\n|---|---|\n| 帳號 | **必填** |\n\n### 小節\n結束 <b>&</b> 1 < 2\n")
+        before = ast_cache_info()
+        doc = FormatConverter.markdown_to_docx(content, {'title': 'SOP'})
+        prs = FormatConverter.markdown_to_pptx(content, {'title': 'SOP'})
+        with tempfile.TemporaryDirectory() as tmp:
+            pdf_path = FormatConverter.markdown_to_pdf(content, {'title': 'SOP'}, os.path.join(tmp, 'out.pdf'))
+            with fitz.open(pdf_path) as pdf:
+                pdf_text = pdf[0].get_text()
+        after = ast_cache_info()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 2)
+
+        styles = [(p.style.name, p.text) for p in doc.paragraphs]
+        self.assertIn(('Heading 2', '登入 注意'), styles)
+        self.assertIn(('List Bullet', '輸入 帳號'), styles)
+        self.assertIn(('List Number', '按下登入'), styles)
+        self.assertIn(('Heading 3', '小節'), styles)
+        self.assertIn(('Normal', '結束 & 1 < 2'), styles)
+        heading = next(p for p in doc.paragraphs if p.text == '登入 注意')
+        self.assertEqual([(run.text, bool(run.bold)) for run in heading.runs], [('登入 ', False), ('注意', True)])
+        self.assertEqual([[cell.text for cell in row.cells] for row in doc.tables[0].rows],
+                         [['欄位', '說明'], ['帳號', '必填']])
+        self.assertTrue(doc.tables[0].rows[1].cells[1].paragraphs[0].runs[0].bold)
+
+        slide = prs.slides[1]
+        self.assertEqual(slide.shapes.title.text, '登入 注意')
+        body = [p.text for p in slide.placeholders[1].text_frame.paragraphs if p.text]
+        self.assertEqual(body, ['輸入 帳號', '1. 按下登入', '欄位 | 說明', '帳號 | 必填', '小節', '結束 & 1 < 2'])
+
+        # 測試環境沒有中文字體，只檢查 ASCII 部分；特殊字元已轉義而不會破壞 reportlab 標記
+        for text in ('• ', '1. ', '& 1 < 2'):
+            self.assertIn(text, pdf_text)
+
 if __name__ == '__main__':
     unittest.main()